@@ -0,0 +1,797 @@
+"""
+asyncio版のWebhookサーバー（aiohttp + asyncpg）
+
+main.py（Flask + gevent + psycopg2 + requests）の代わりに使える配信モード。
+待ち時間のほとんどがLLM・LINE・DBのI/Oなので、1プロセスで数百の会話を同時に扱える。
+
+- 入力検証・「スタート」によるリセット・オーナー/有料/無料の判定と定型文は message_flow を main.py と共有する
+- 履歴キャッシュ・回数制限・サブスクリプションのキャッシュ・プロンプトの組み立ては同じ部品をプロセス内で使う
+- DBは asyncpg のプール、OpenAI・LINE・Stripe は aiohttp で呼ぶ（async_clients）
+
+環境変数は main.py と同じものを読む。起動:
+
+    gunicorn async_app:create_app --worker-class aiohttp.GunicornWebWorker
+"""
+
+import asyncio
+import datetime
+import logging
+import os
+import shlex
+import time
+from collections import OrderedDict
+
+import asyncpg
+from aiohttp import web
+from linebot.webhook import SignatureValidator
+
+from async_clients import (
+    CLIENT_ERRORS, AsyncLineClient, AsyncLLMClient, create_session, iter_stripe_subscriptions,
+)
+from data_access import (
+    CONTEXT_SQL, RESET_SQL, ContextPrefetcher, context_from_rows, context_params, exchange_rows, numbered_query,
+)
+from fast_path import FastPath, OverQuotaCache
+from history_cache import HistoryCache, MemoryHistoryBackend
+from llm_client import CircuitBreaker, CircuitOpenError
+from log_writer import prompt_hash
+from message_flow import (
+    GPT_FALLBACK_TEXT, QUOTA_EXCEEDED_REPLY, SYSTEM_PROMPT, UNEXPECTED_ERROR_REPLY, coalesce, decide,
+    digest_messages, order_events, parse_text_message_events, select_policy, superseded,
+)
+from metrics import CONTENT_TYPE, REGISTRY, count_error, record_stage, stage, trace
+from migrations import dsn_from_env, run_migrations
+from prompt_builder import MemoryDigestStore, PromptBuilder
+from quota import MemoryQuotaBackend, QuotaLimiter, QuotaPolicy
+from streaming import aiter_sse_deltas, deliver_stream_async
+from startup import LazyModule, Startup
+from subscription_index import SUBSCRIPTION_EVENT_TYPES, SubscriptionIndex, latest_rows, should_replace, subscription_to_row
+from user_mailbox import AsyncUserMailbox
+
+# Webhookの署名の検証にしか使わないので、起動後にバックグラウンドで読み込む（main.py を参照）
+stripe = LazyModule("stripe")
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+
+def optional_int(value):
+    return int(value) if value else None
+
+
+# 環境変数取得（意味は main.py と同じ）
+OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE", "https://api.openai.com/v1")
+LINE_API_ENDPOINT = os.environ.get("LINE_API_ENDPOINT", "https://api.line.me")
+STRIPE_API_BASE = os.environ.get("STRIPE_API_BASE", "https://api.stripe.com")
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", 3.05))
+OPENAI_READ_TIMEOUT = float(os.environ.get("OPENAI_READ_TIMEOUT", 20))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 2))
+OPENAI_CIRCUIT_THRESHOLD = int(os.environ.get("OPENAI_CIRCUIT_THRESHOLD", 5))
+OPENAI_CIRCUIT_RESET = float(os.environ.get("OPENAI_CIRCUIT_RESET", 30))
+LINE_API_TIMEOUT = float(os.environ.get("LINE_API_TIMEOUT", 10))
+LINE_STREAMING = os.environ.get("LINE_STREAMING", "0") == "1"
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 4000))
+PROMPT_DIGEST = os.environ.get("PROMPT_DIGEST", "0") == "1"
+DIGEST_MODEL = os.environ.get("DIGEST_MODEL", "gpt-4o-mini")
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", 3000))
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+SUBSCRIPTION_CACHE_TTL = int(os.environ.get("SUBSCRIPTION_CACHE_TTL", 300))
+SUBSCRIPTION_SYNC_INTERVAL = int(os.environ.get("SUBSCRIPTION_SYNC_INTERVAL", 900))
+OWNER_LINE_ID = os.environ.get("OWNER_LINE_ID")
+LINE_DISPATCH_MODE = os.environ.get("LINE_DISPATCH_MODE", "sync")
+LINE_COALESCE_WINDOW = float(os.environ.get("LINE_COALESCE_WINDOW", 1.0))
+LINE_COALESCE_MAX_DELAY = float(os.environ.get("LINE_COALESCE_MAX_DELAY", 3.0))
+LINE_COALESCE_MAX_MESSAGES = int(os.environ.get("LINE_COALESCE_MAX_MESSAGES", 5))
+HISTORY_LIMIT = int(os.environ.get("HISTORY_LIMIT", 10))
+HISTORY_CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", 1000))
+HISTORY_CACHE_TTL = int(os.environ.get("HISTORY_CACHE_TTL", 1800))
+QUOTA_WINDOW_SECONDS = int(os.environ.get("QUOTA_WINDOW_SECONDS", 24 * 60 * 60))
+QUOTA_POLICIES = [
+    QuotaPolicy("owner", optional_int(os.environ.get("QUOTA_OWNER_LIMIT", ""))),
+    QuotaPolicy("paid", optional_int(os.environ.get("QUOTA_PAID_LIMIT", ""))),
+    QuotaPolicy("free", optional_int(os.environ.get("QUOTA_FREE_LIMIT", "5"))),
+]
+OVER_QUOTA_CACHE_SIZE = int(os.environ.get("OVER_QUOTA_CACHE_SIZE", 10000))
+OVER_QUOTA_CACHE_TTL = int(os.environ.get("OVER_QUOTA_CACHE_TTL", 300))
+# asyncモード固有の設定
+ASYNC_DB_POOL_SIZE = int(os.environ.get("ASYNC_DB_POOL_SIZE", 20))
+ASYNC_HTTP_POOL_SIZE = int(os.environ.get("ASYNC_HTTP_POOL_SIZE", 100))
+# 同時に処理するイベントの上限（超えた分は503を返してLINEに再送させる）
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get("ASYNC_MAX_IN_FLIGHT", 500))
+
+INSERT_LOG_SQL = """
+INSERT INTO line_bot_logs (timestamp, sender, lineId, stripeId, message, is_active, prompt_hash)
+VALUES ($1, $2, $3, $4, $5, $6, $7);
+"""
+CONTEXT_QUERY, CONTEXT_PARAM_NAMES = numbered_query(CONTEXT_SQL)
+RESET_QUERY, _ = numbered_query(RESET_SQL)
+
+
+def server_settings_from_pgoptions(value):
+    """libpq の PGOPTIONS（"-c key=value" の並び）を asyncpg の server_settings にする。"""
+    settings = {}
+    tokens = shlex.split(value or "")
+    for flag, setting in zip(tokens, tokens[1:]):
+        if flag == "-c" and "=" in setting:
+            key, _, val = setting.partition("=")
+            settings[key] = val
+    return settings
+
+
+def pool_params_from_env():
+    """DATABASE_URL、なければ DB_HOST などの環境変数から asyncpg の接続引数を作る（dsn_from_env と同じ順）。"""
+    database_url = os.environ.get("DATABASE_URL")
+    if database_url:
+        return {"dsn": database_url}
+    return {
+        "host": os.environ["DB_HOST"],
+        "port": 5432,
+        "database": os.environ["DB_NAME"],
+        "user": os.environ["DB_USER"],
+        "password": os.environ["DB_PASS"],
+    }
+
+
+class AsyncConversationStore:
+    """data_access.ConversationStore のasyncpg版
+
+    書き込みは返信を待たせないようバックグラウンドのタスクで行い、
+    そのユーザーの読み込みの前に書き込み中のタスクを待つ。
+    """
+
+    def __init__(self, pool, history_limit=10):
+        self._pool = pool
+        self._history_limit = history_limit
+        self._pending = {}
+        self._stored_prompts = set()
+        self._counters = {"context_loads": 0, "round_trips": 0, "exchanges": 0, "write_errors": 0}
+
+    async def load_context(self, line_id, since=None, history=True, reply_times=True, subscription=True):
+        if history or reply_times:
+            await self.wait_for_writes(line_id)
+        params = context_params(line_id, self._history_limit, since, history, reply_times, subscription)
+        with stage("db.load_context"):
+            rows = await self._pool.fetch(CONTEXT_QUERY, *(params[name] for name in CONTEXT_PARAM_NAMES))
+        self._counters["context_loads"] += 1
+        self._counters["round_trips"] += 1
+        return context_from_rows(rows, line_id, history, reply_times and since is not None, subscription)
+
+    async def fetch_history(self, line_id):
+        context = await self.load_context(line_id, history=True, reply_times=False, subscription=False)
+        return context.history
+
+    async def fetch_subscription(self, line_id):
+        context = await self.load_context(line_id, history=False, reply_times=False, subscription=True)
+        return context.subscription
+
+    async def fetch_all_reply_times(self, since):
+        rows = await self._pool.fetch(
+            "SELECT lineId, timestamp FROM line_bot_logs WHERE sender='system' AND timestamp > $1;",
+            datetime.datetime.fromtimestamp(since),
+        )
+        self._counters["round_trips"] += 1
+        timestamps_by_user = {}
+        for line_id, timestamp in rows:
+            timestamps_by_user.setdefault(line_id, []).append(timestamp.timestamp())
+        return timestamps_by_user
+
+    def record_exchange(self, line_id, stripe_id, user_timestamp, user_message, reply_timestamp, reply,
+                        sys_prompt=""):
+        """ユーザーの発言とシステムの応答を同じトランザクションで書き込むタスクを始める。"""
+        return self.record_turns(line_id, stripe_id, [(user_timestamp, user_message)], reply_timestamp, reply,
+                                 sys_prompt)
+
+    def record_turns(self, line_id, stripe_id, user_turns, reply_timestamp=None, reply=None, sys_prompt="",
+                     is_active=True):
+        """まとめて応答したユーザーの発言（(時刻, 本文) のリスト）とシステムの応答を書き込むタスクを始める。
+
+        reply がNoneの場合はユーザーの発言だけを書き込む。is_active=False の行は会話履歴に含めない。
+        """
+        digest = prompt_hash(sys_prompt) if sys_prompt else None
+        rows = exchange_rows(line_id, stripe_id, user_turns, reply_timestamp, reply, digest, is_active)
+        task = asyncio.get_running_loop().create_task(self._write(rows, digest, sys_prompt))
+        tasks = self._pending.setdefault(line_id, set())
+        tasks.add(task)
+
+        def done(task):
+            tasks.discard(task)
+            if not tasks and self._pending.get(line_id) is tasks:
+                del self._pending[line_id]
+
+        task.add_done_callback(done)
+        self._counters["exchanges"] += 1
+        return task
+
+    async def wait_for_writes(self, line_id=None):
+        tasks = self._pending.get(line_id, ()) if line_id else [t for ts in self._pending.values() for t in ts]
+        if tasks:
+            await asyncio.gather(*list(tasks), return_exceptions=True)
+
+    async def deactivate(self, line_id, reset_at=None):
+        # 書き込み中の行もリセット時刻より前なので、書き込みを待つ必要はない（ConversationStore.deactivate を参照）
+        with stage("db.deactivate"):
+            await self._pool.execute(RESET_QUERY, line_id, reset_at or datetime.datetime.now())
+        self._counters["round_trips"] += 1
+
+    async def upsert_subscriptions(self, rows):
+        await self._pool.executemany(
+            """
+            INSERT INTO stripe_subscriptions (line_user_id, subscription_id, stripe_customer_id, price_id, status)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (line_user_id) DO UPDATE SET
+                subscription_id = EXCLUDED.subscription_id,
+                stripe_customer_id = EXCLUDED.stripe_customer_id,
+                price_id = EXCLUDED.price_id,
+                status = EXCLUDED.status,
+                updated_at = NOW();
+            """,
+            [(r["line_user_id"], r["subscription_id"], r["stripe_customer_id"], r["price_id"], r["status"])
+             for r in rows],
+        )
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats["pending_writes"] = sum(len(tasks) for tasks in self._pending.values())
+        return stats
+
+    async def _write(self, rows, digest, sys_prompt):
+        try:
+            with stage("db.write_batch"):
+                async with self._pool.acquire() as connection:
+                    async with connection.transaction():
+                        if digest and digest not in self._stored_prompts:
+                            await connection.execute(
+                                "INSERT INTO prompts (hash, content) VALUES ($1, $2) ON CONFLICT (hash) DO NOTHING;",
+                                digest, sys_prompt,
+                            )
+                        await connection.executemany(INSERT_LOG_SQL, rows)
+            if digest:
+                self._stored_prompts.add(digest)
+            self._counters["round_trips"] += 1
+        except Exception as e:
+            logger.error(f"Database error while recording exchange for {rows[0][2]}: {e}")
+            self._counters["write_errors"] += 1
+            count_error("db_write")
+
+
+class AsyncContextPrefetcher(ContextPrefetcher):
+    """ContextPrefetcher のasyncio版（キャッシュにない項目だけを1往復で読み込む）"""
+
+    async def prefetch(self, line_id):
+        request = self._plan(line_id)
+        if request is None:
+            return None
+        try:
+            context = await self._store.load_context(line_id, **request)
+            self._apply(line_id, context)
+        except Exception as e:
+            logger.error(f"Failed to prefetch message context for {line_id}: {e}")
+            self._count("errors")
+            return None
+        self._count("prefetches")
+        return context
+
+
+class RecentEventIds:
+    """処理済みのwebhookEventId（LINEの再送の重複排除用、ttl秒で忘れる）"""
+
+    def __init__(self, ttl=600):
+        self._ttl = ttl
+        self._seen = OrderedDict()
+
+    def add(self, event_id):
+        """初めて見たIDならTrueを返す。"""
+        now = time.monotonic()
+        while self._seen:
+            oldest_id, expires = next(iter(self._seen.items()))
+            if expires > now:
+                break
+            del self._seen[oldest_id]
+        if event_id in self._seen:
+            return False
+        self._seen[event_id] = now + self._ttl
+        return True
+
+    def discard(self, event_id):
+        """記録を取り消す（受け付けなかったイベントの再送を処理できるように）。"""
+        self._seen.pop(event_id, None)
+
+
+def _not_prefetched(*args):
+    # 先読みに失敗したユーザーの同期の読み込みは行わない（呼び出し側で扱う）
+    raise RuntimeError("context was not prefetched")
+
+
+class AsyncLineBot:
+    """asyncモードのアプリケーション本体"""
+
+    def __init__(self, channel_access_token, channel_secret, openai_api_key, stripe_secret_key, price_id,
+                 stripe_webhook_secret=None, startup=None):
+        self.startup = startup or Startup()
+        self._signature_validator = SignatureValidator(channel_secret)
+        self._stripe_secret_key = stripe_secret_key
+        self._stripe_webhook_secret = stripe_webhook_secret
+        self._price_id = price_id
+        self.llm = AsyncLLMClient(
+            openai_api_key,
+            base_url=OPENAI_API_BASE,
+            pool_size=ASYNC_HTTP_POOL_SIZE,
+            connect_timeout=OPENAI_CONNECT_TIMEOUT,
+            read_timeout=OPENAI_READ_TIMEOUT,
+            max_retries=OPENAI_MAX_RETRIES,
+            breaker=CircuitBreaker(failure_threshold=OPENAI_CIRCUIT_THRESHOLD, reset_timeout=OPENAI_CIRCUIT_RESET),
+        )
+        self.line = AsyncLineClient(
+            channel_access_token,
+            endpoint=LINE_API_ENDPOINT,
+            pool_size=ASYNC_HTTP_POOL_SIZE,
+            connect_timeout=OPENAI_CONNECT_TIMEOUT,
+            read_timeout=LINE_API_TIMEOUT,
+        )
+        # 1プロセスで多数の会話を扱うので、キャッシュと回数制限はプロセス内に持つ
+        self.history_cache = HistoryCache(
+            MemoryHistoryBackend(max_users=HISTORY_CACHE_SIZE, ttl=HISTORY_CACHE_TTL), limit=HISTORY_LIMIT,
+        )
+        self.quota_limiter = QuotaLimiter(
+            MemoryQuotaBackend(), QUOTA_POLICIES, _not_prefetched, window=QUOTA_WINDOW_SECONDS,
+        )
+        # ストアは使わない（lookup_async に self.store.fetch_subscription を渡して読む）
+        self.subscription_index = SubscriptionIndex(None, None, price_id, ttl=SUBSCRIPTION_CACHE_TTL)
+        self.over_quota = OverQuotaCache(max_users=OVER_QUOTA_CACHE_SIZE, ttl=OVER_QUOTA_CACHE_TTL)
+        self.fast_path = FastPath(self.over_quota)
+        # 要約はプロセス内に保持し、要約の生成はイベントループに投げる
+        self.prompt_builder = PromptBuilder(
+            SYSTEM_PROMPT,
+            PROMPT_TOKEN_BUDGET,
+            digest_store=MemoryDigestStore(max_users=HISTORY_CACHE_SIZE),
+            summarizer=self._summarize if PROMPT_DIGEST else None,
+        )
+        self.store = None
+        self.prefetcher = None
+        self._pool = None
+        self._stripe_session = None
+        self._loop = None
+        self._tasks = set()
+        # 同じユーザーのメッセージは順番に処理し、続けて届いたものはまとめる（main.py と同じ）
+        self.mailbox = AsyncUserMailbox(
+            self.handle_line_messages,
+            window=LINE_COALESCE_WINDOW,
+            max_delay=LINE_COALESCE_MAX_DELAY,
+            max_batch=LINE_COALESCE_MAX_MESSAGES,
+        )
+        self._seen = RecentEventIds()
+        self._in_flight = 0
+        self._counters = {"accepted": 0, "duplicates": 0, "rejected": 0, "processed": 0, "failed": 0}
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        if os.environ.get("RUN_MIGRATIONS", "1") == "1":
+            with self.startup.track("migrations"):
+                await asyncio.to_thread(self._run_migrations)
+        with self.startup.track("db_pool"):
+            self._pool = await asyncpg.create_pool(
+                **pool_params_from_env(),
+                min_size=1,
+                max_size=ASYNC_DB_POOL_SIZE,
+                server_settings=server_settings_from_pgoptions(os.environ.get("PGOPTIONS")),
+            )
+        self.store = AsyncConversationStore(self._pool, history_limit=HISTORY_LIMIT)
+        self.prefetcher = AsyncContextPrefetcher(
+            self.store, self.history_cache, self.quota_limiter, self.subscription_index,
+        )
+        await self.llm.start()
+        await self.line.start()
+        self._stripe_session = create_session(4, OPENAI_CONNECT_TIMEOUT, LINE_API_TIMEOUT)
+        self._spawn(self._warm_quota_limiter())
+        self._spawn(self._import_stripe())
+        if SUBSCRIPTION_SYNC_INTERVAL > 0:
+            self._spawn(self._sync_subscriptions_periodically(SUBSCRIPTION_SYNC_INTERVAL))
+        self._register_metrics()
+        logger.info("Async line bot started")
+
+    async def close(self):
+        # 処理中のイベントと書き込みを待ってから閉じる
+        tasks = [task for task in self._tasks if not task.get_name().startswith("background:")]
+        if tasks:
+            await asyncio.wait(tasks, timeout=30)
+        for task in self._tasks:
+            if task.get_name().startswith("background:"):
+                task.cancel()
+        if self.store is not None:
+            await self.store.wait_for_writes()
+        await self.llm.close()
+        await self.line.close()
+        if self._stripe_session is not None:
+            await self._stripe_session.close()
+        if self._pool is not None:
+            await self._pool.close()
+
+    # --- HTTPハンドラ ---
+
+    async def hello_world(self, request):
+        return web.Response(text="hello world!")
+
+    async def healthz(self, request):
+        return web.json_response({"status": "ok"})
+
+    async def readyz(self, request):
+        status = self.startup.status()
+        return web.json_response(status, status=200 if status["ready"] else 503)
+
+    async def metrics(self, request):
+        if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+            raise web.HTTPUnauthorized()
+        return web.Response(body=REGISTRY.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    async def callback(self, request):
+        if self.startup.missing_env:
+            # 設定が直るまでLINEに再送させる
+            raise web.HTTPServiceUnavailable()
+        signature = request.headers.get("X-Line-Signature", "")
+        body = await request.text()
+        if not self._signature_validator.validate(body, signature):
+            raise web.HTTPBadRequest()
+        events = parse_text_message_events(body)
+        if LINE_DISPATCH_MODE != "async":
+            # syncモード：処理し終えてから200を返す（main.py と同じ）
+            self._in_flight += len(events)
+            await asyncio.gather(*(self.handle_line_message(event) for _, event in events))
+            return web.Response(text="OK")
+
+        # asyncモード：タスクを作ってすぐに200を返す
+        for event_id, event in events:
+            if event_id and not self._seen.add(event_id):
+                self._counters["duplicates"] += 1
+                continue
+            if self._in_flight >= ASYNC_MAX_IN_FLIGHT:
+                # 再送時に処理できるよう重複の記録を取り消す（dispatcher.py と同じ）
+                if event_id:
+                    self._seen.discard(event_id)
+                self._counters["rejected"] += 1
+                raise web.HTTPServiceUnavailable()
+            self._counters["accepted"] += 1
+            # タスクが動き出す前に数え、同じボディの残りのイベントも上限に含める
+            self._in_flight += 1
+            self._spawn(self.handle_line_message(event))
+        return web.Response(text="OK")
+
+    async def stripe_webhook(self, request):
+        if not self._stripe_webhook_secret or self.startup.missing_env:
+            raise web.HTTPServiceUnavailable()
+        payload = await request.read()
+        signature = request.headers.get("Stripe-Signature", "")
+        # 起動時の読み込みが終わっていなければ、ここでもスレッドで import する
+        stripe_module = await stripe.load_async()
+        try:
+            event = stripe_module.Webhook.construct_event(payload, signature, self._stripe_webhook_secret)
+        except (ValueError, stripe_module.SignatureVerificationError):
+            raise web.HTTPBadRequest()
+        if event["type"] in SUBSCRIPTION_EVENT_TYPES:
+            await self.apply_subscription(event["data"]["object"])
+        return web.Response(text="OK")
+
+    # --- メッセージの処理 ---
+
+    async def handle_line_message(self, event):
+        """1件のイベントを処理する（_in_flight は呼び出し側が増やし、終わったらここで減らす）。"""
+        try:
+            user_id = getattr(event.source, "user_id", None)
+            received = (datetime.datetime.now(), event)
+            if user_id is None:
+                await self.handle_line_messages(user_id, [received])
+            else:
+                # 同じユーザーの処理中のタスクがあれば積むだけで戻る
+                await self.mailbox.submit(user_id, received)
+            self._counters["processed"] += 1
+        except Exception as e:
+            logger.error(f"Unhandled error while processing webhook event: {e}")
+            self._counters["failed"] += 1
+        finally:
+            self._in_flight -= 1
+
+    async def handle_line_messages(self, user_id, received):
+        with trace("line_message", slow_ms=TRACE_SLOW_MS):
+            await self.process_line_messages(user_id, order_events(received))
+
+    async def process_line_messages(self, user_id, timed_events):
+        events = [event for _, event in timed_events]
+        reply_token = events[-1].reply_token
+        replied = False
+        unrecorded_turns = []
+        stripe_id = None
+        try:
+            with stage("validation"):
+                decisions = [decide(event.message.text, user_id) for event in events]
+                reset, decision, included = coalesce(decisions)
+            for skipped in decisions:
+                if skipped.error:
+                    logger.warning(f"Invalid input from user {user_id}")
+                    count_error(skipped.error)
+            reply_text = decision.text
+
+            if reset:
+                reset_at = datetime.datetime.now()
+                await self.deactivate_conversation_history(user_id, reset_at)
+                earlier_turns = [(timed_events[i][0], decisions[i].text) for i in superseded(decisions, included)]
+                if earlier_turns:
+                    self.record_user_turns(user_id, None, earlier_turns, is_active=False)
+            fast_reply = self.fast_path.route(user_id, decision)
+            if fast_reply is not None:
+                reply_text = fast_reply
+            elif decision.action == "converse":
+                user_turns = [(timed_events[i][0], decisions[i].text) for i in included]
+                if reset:
+                    user_turns = [(max(timestamp, reset_at), message) for timestamp, message in user_turns]
+                unrecorded_turns = user_turns
+                with stage("prefetch"):
+                    await self.prefetcher.prefetch(user_id)
+                with stage("subscription"):
+                    subscription = await self.lookup_subscription(user_id)
+                stripe_id = subscription["stripeId"] if subscription else None
+
+                policy = select_policy(user_id, subscription, OWNER_LINE_ID)
+                with stage("quota"):
+                    quota = self.quota_limiter.check(user_id, policy)
+                if quota.allowed:
+                    reply_text, replied = await self.generate_reply(decision.text, user_id, reply_token)
+                else:
+                    reply_text = QUOTA_EXCEEDED_REPLY
+                    self.over_quota.add(user_id, quota.retry_after)
+
+                with stage("record"):
+                    self.record_exchange(user_id, stripe_id, user_turns, datetime.datetime.now(), reply_text)
+                unrecorded_turns = []
+        except Exception as e:
+            logger.error(f"Unexpected error in handle_line_message: {e}")
+            count_error("unexpected")
+            reply_text = UNEXPECTED_ERROR_REPLY
+
+        if unrecorded_turns:
+            # main.py と同じく、応答を生成できなかった場合もユーザーの発言は記録する
+            self.record_user_turns(user_id, stripe_id, unrecorded_turns)
+
+        if not replied:
+            try:
+                with stage("line_reply"):
+                    await self.line.reply(reply_token, [reply_text])
+            except Exception:
+                count_error("line_reply")
+                raise
+
+    async def lookup_subscription(self, user_id):
+        return await self.subscription_index.lookup_async(user_id, self.store.fetch_subscription)
+
+    async def deactivate_conversation_history(self, user_id, reset_at=None):
+        try:
+            await self.store.deactivate(user_id, reset_at)
+            self.history_cache.reset(user_id)
+            self.prompt_builder.reset(user_id)
+        except Exception as e:
+            logger.error(f"Database error in deactivate_conversation_history: {e}")
+
+    async def build_chat_messages(self, prompt, user_id):
+        try:
+            if not self.history_cache.contains(user_id):
+                self.history_cache.prime(user_id, await self.store.fetch_history(user_id))
+            history = self.history_cache.get(user_id, _not_prefetched)
+        except Exception as e:
+            logger.error(f"Database error in get_conversation_history: {e}")
+            history = []
+        with stage("prompt"):
+            messages, stats = self.prompt_builder.build(
+                user_id, history, prompt, window_full=len(history) >= HISTORY_LIMIT,
+            )
+        logger.debug(f"Prompt stats for {user_id}: {stats}")
+        return messages
+
+    async def generate_reply(self, prompt, user_id, reply_token):
+        """応答を生成する。ストリーミング時は返信まで済ませるので (本文, 返信済みか) を返す。"""
+        messages = await self.build_chat_messages(prompt, user_id)
+        if LINE_STREAMING:
+            return await self._generate_streaming(messages, user_id, reply_token), True
+        try:
+            return await self.llm.chat(messages, model="gpt-4o", temperature=1), False
+        except (*CLIENT_ERRORS, CircuitOpenError) as e:
+            logger.error(f"API request failed: {e}")
+            count_error("llm_fallback")
+            return GPT_FALLBACK_TEXT, False
+
+    async def _generate_streaming(self, messages, user_id, reply_token):
+        async def send_reply(text):
+            with stage("line_reply"):
+                await self.line.reply(reply_token, [text])
+
+        async def send_push(text):
+            with stage("line_push"):
+                await self.line.push(user_id, [text])
+
+        def record_usage(usage):
+            self.llm.record_usage("gpt-4o", usage)
+
+        async def timed(deltas, started):
+            first = True
+            async for delta in deltas:
+                if first:
+                    record_stage("llm.first_token", time.perf_counter() - started)
+                    first = False
+                yield delta
+
+        started = time.perf_counter()
+        try:
+            with stage("llm.stream"):
+                async with self.llm.stream(
+                    messages, model="gpt-4o", temperature=1, stream_options={"include_usage": True},
+                ) as response:
+                    deltas = aiter_sse_deltas(response.content, on_usage=record_usage)
+                    return await deliver_stream_async(timed(deltas, started), send_reply, send_push)
+        except (*CLIENT_ERRORS, CircuitOpenError, ValueError) as e:
+            # 最初の返信前に失敗した場合のみここに来る
+            logger.error(f"Streaming API request failed: {e}")
+            count_error("llm_fallback")
+            await send_reply(GPT_FALLBACK_TEXT)
+            return GPT_FALLBACK_TEXT
+
+    def record_exchange(self, user_id, stripe_id, user_turns, reply_timestamp, reply_text):
+        for _, message in user_turns:
+            self.history_cache.append(user_id, "user", message)
+        self.history_cache.append(user_id, "assistant", reply_text)
+        self.quota_limiter.record(user_id, reply_timestamp.timestamp())
+        self.store.record_turns(user_id, stripe_id, user_turns, reply_timestamp, reply_text, SYSTEM_PROMPT)
+
+    def record_user_turns(self, user_id, stripe_id, user_turns, is_active=True):
+        try:
+            if is_active:
+                for _, message in user_turns:
+                    self.history_cache.append(user_id, "user", message)
+            self.store.record_turns(user_id, stripe_id, user_turns, sys_prompt=SYSTEM_PROMPT, is_active=is_active)
+        except Exception as e:
+            logger.error(f"Failed to record user messages for {user_id}: {e}")
+
+    # --- サブスクリプション ---
+
+    async def apply_subscription(self, subscription):
+        row = subscription_to_row(subscription, self._price_id)
+        if row is None:
+            return False
+        current = await self.store.fetch_subscription(row["line_user_id"])
+        if not should_replace(current, row):
+            return False
+        await self.store.upsert_subscriptions([row])
+        self.subscription_index.prime(row["line_user_id"], row)
+        self.over_quota.discard(row["line_user_id"])
+        return True
+
+    async def sync_subscriptions(self):
+        started = time.monotonic()
+        subscriptions = [
+            subscription async for subscription in
+            iter_stripe_subscriptions(self._stripe_session, self._stripe_secret_key, STRIPE_API_BASE)
+        ]
+        rows, scanned = latest_rows(subscriptions, self._price_id)
+        await self.store.upsert_subscriptions(list(rows.values()))
+        for line_user_id, row in rows.items():
+            self.subscription_index.prime(line_user_id, row)
+        self.subscription_index.last_synced_at = time.time()
+        logger.info(
+            f"Subscription index synced: {len(rows)} users from {scanned} subscriptions "
+            f"in {time.monotonic() - started:.2f}s"
+        )
+        return len(rows)
+
+    # --- バックグラウンド処理 ---
+
+    async def _sync_subscriptions_periodically(self, interval):
+        while True:
+            try:
+                await self.sync_subscriptions()
+            except Exception as e:
+                logger.error(f"Subscription index sync failed: {e}")
+            await asyncio.sleep(interval)
+
+    async def _warm_quota_limiter(self):
+        try:
+            with self.startup.track("caches"):
+                timestamps_by_user = await self.store.fetch_all_reply_times(time.time() - QUOTA_WINDOW_SECONDS)
+                self.quota_limiter.warm(timestamps_by_user)
+            logger.info(f"Quota limiter warmed for {len(timestamps_by_user)} users")
+        except Exception:
+            # 失敗はログと /readyz に出ている（最初のメッセージでユーザーごとに読み込む）
+            pass
+
+    async def _import_stripe(self):
+        try:
+            with self.startup.track("stripe"):
+                await stripe.load_async()
+        except Exception:
+            # 失敗はログと /readyz に出ている（最初のWebhookで読み込み直す）
+            pass
+
+    def _summarize(self, previous_summary, turns):
+        # PromptBuilder の要約スレッドから呼ばれるので、イベントループで実行して結果を待つ
+        future = asyncio.run_coroutine_threadsafe(
+            self.llm.chat(digest_messages(previous_summary, turns), model=DIGEST_MODEL, temperature=0), self._loop,
+        )
+        return future.result()
+
+    def _run_migrations(self):
+        import psycopg2
+
+        connection = psycopg2.connect(dsn_from_env())
+        try:
+            applied = run_migrations(connection)
+            if applied:
+                logger.info(f"Applied database migrations: {applied}")
+        finally:
+            connection.close()
+
+    def _spawn(self, coroutine):
+        name = f"background:{coroutine.__name__}" if coroutine.__name__.startswith("_") else coroutine.__name__
+        task = asyncio.get_running_loop().create_task(coroutine, name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats["in_flight"] = self._in_flight
+        stats["max_in_flight"] = ASYNC_MAX_IN_FLIGHT
+        return stats
+
+    def _register_metrics(self):
+        pool = self._pool
+        REGISTRY.register_stats("line_bot_db_pool", lambda: {
+            "in_use": pool.get_size() - pool.get_idle_size(),
+            "idle": pool.get_idle_size(),
+            "max": pool.get_max_size(),
+            "utilization": (pool.get_size() - pool.get_idle_size()) / pool.get_max_size(),
+        }, "Database connection pool")
+        REGISTRY.register_stats("line_bot_history_cache", self.history_cache.stats, "Conversation history cache")
+        REGISTRY.register_stats("line_bot_quota", self.quota_limiter.stats, "Quota limiter")
+        REGISTRY.register_stats("line_bot_over_quota_cache", self.over_quota.stats, "Over-quota users cache")
+        REGISTRY.register_stats("line_bot_fast_path", self.fast_path.stats, "Replies decided without remote I/O")
+        REGISTRY.register_stats("line_bot_llm", self.llm.stats, "LLM client")
+        REGISTRY.register_stats("line_bot_prompt", self.prompt_builder.stats, "Prompt builder")
+        REGISTRY.register_stats("line_bot_data_access", self.store.stats, "Data access")
+        REGISTRY.register_stats("line_bot_prefetch", self.prefetcher.stats, "Context prefetcher")
+        REGISTRY.register_stats("line_bot_mailbox", self.mailbox.stats, "Per-user mailbox")
+        REGISTRY.register_stats("line_bot_dispatcher", self.stats, "Webhook dispatcher")
+
+
+BOT = web.AppKey("bot", AsyncLineBot)
+
+
+async def create_app():
+    startup = Startup()
+    env = startup.require_env(
+        "YOUR_CHANNEL_ACCESS_TOKEN", "YOUR_CHANNEL_SECRET", "OPENAI_API_KEY", "STRIPE_SECRET_KEY", "SUBSCRIPTION_PRICE_ID",
+    )
+    bot = AsyncLineBot(
+        env["YOUR_CHANNEL_ACCESS_TOKEN"],
+        env["YOUR_CHANNEL_SECRET"],
+        env["OPENAI_API_KEY"],
+        env["STRIPE_SECRET_KEY"],
+        env["SUBSCRIPTION_PRICE_ID"],
+        stripe_webhook_secret=os.environ.get("STRIPE_WEBHOOK_SECRET"),
+        startup=startup,
+    )
+    app = web.Application()
+    app[BOT] = bot
+
+    async def lifespan(app):
+        await bot.start()
+        yield
+        await bot.close()
+
+    app.cleanup_ctx.append(lifespan)
+    app.router.add_get("/", bot.hello_world)
+    app.router.add_get("/healthz", bot.healthz)
+    app.router.add_get("/readyz", bot.readyz)
+    app.router.add_get("/metrics", bot.metrics)
+    app.router.add_post("/callback", bot.callback)
+    app.router.add_post("/stripe/webhook", bot.stripe_webhook)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
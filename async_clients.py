@@ -0,0 +1,158 @@
+"""
+asyncio版の外部API呼び出し（aiohttp）
+
+async_app.py から使う。リトライ・サーキットブレーカー・集計は llm_client の同期版と共通で、
+接続はaiohttpのコネクタで使い回す。セッションはイベントループの中で start() して作る。
+"""
+
+import asyncio
+import contextlib
+import logging
+
+import aiohttp
+
+from llm_client import OPENAI_API_BASE, RETRY_STATUS_CODES, BaseLLMClient, parse_retry_after
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+LINE_API_ENDPOINT = "https://api.line.me"
+STRIPE_API_BASE = "https://api.stripe.com"
+
+# 呼び出し側が捕まえる例外（CircuitOpenError は requests.RequestException のサブクラス）
+CLIENT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+def create_session(pool_size=100, connect_timeout=3.05, read_timeout=20.0):
+    """keep-aliveで接続を使い回すClientSessionを作る（実行中のイベントループの中で呼ぶ）。"""
+    connector = aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=30)
+    timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, raise_for_status=False)
+
+
+class AsyncLLMClient(BaseLLMClient):
+    """Chat Completions APIのクライアント（asyncio版）"""
+
+    def __init__(self, api_key, base_url=OPENAI_API_BASE, session=None, pool_size=100, sleep=asyncio.sleep,
+                 **kwargs):
+        super().__init__(api_key, base_url, **kwargs)
+        self.session = session
+        self._pool_size = pool_size
+        self._sleep = sleep
+
+    async def start(self):
+        if self.session is None:
+            self.session = create_session(self._pool_size, self._connect_timeout, self._read_timeout)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def chat(self, messages, model="gpt-4o", **params):
+        """応答本文を返す。失敗した場合は CLIENT_ERRORS か CircuitOpenError を送出する。"""
+        with stage(f"llm.{model}"):
+            async with await self._post({"model": model, "messages": messages, **params}) as response:
+                body = await response.json()
+        self.record_usage(model, body.get("usage"))
+        return body["choices"][0]["message"]["content"].strip()
+
+    @contextlib.asynccontextmanager
+    async def stream(self, messages, model="gpt-4o", **params):
+        """ストリーミングのレスポンスを返す（async with文で使う）。本文の受信中の失敗はリトライしない。"""
+        response = await self._post({"model": model, "messages": messages, "stream": True, **params})
+        try:
+            yield response
+        finally:
+            response.release()
+
+    async def _post(self, payload):
+        started = self._begin()
+        try:
+            return await self._attempt(payload, started)
+        except asyncio.CancelledError:
+            # 取り消された呼び出しは成功とも失敗とも数えず、half-open の試行だけを終える
+            self.breaker.release()
+            raise
+
+    async def _attempt(self, payload, started):
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                response = await self.session.post(self._url, headers=self._headers, json=payload)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+            except Exception:
+                # 同期版と同じく、想定外の失敗も失敗として記録する
+                self.breaker.record_failure()
+                self._count("failures")
+                raise
+            else:
+                if response.status not in RETRY_STATUS_CODES:
+                    try:
+                        response.raise_for_status()
+                    except aiohttp.ClientResponseError:
+                        # 4xx（429以外）はリクエストの問題なので上流の障害として数えない
+                        self.breaker.record_success()
+                        raise
+                    self.breaker.record_success()
+                    return response
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                error = aiohttp.ClientResponseError(
+                    response.request_info, response.history, status=response.status,
+                    message="from LLM API", headers=response.headers,
+                )
+                response.release()
+            await self._sleep(self._next_wait(attempt, started, retry_after, error))
+            attempt += 1
+
+
+class AsyncLineClient:
+    """LINE Messaging APIの返信・push（asyncio版、テキストメッセージのみ）"""
+
+    def __init__(self, channel_access_token, endpoint=LINE_API_ENDPOINT, session=None, pool_size=100,
+                 connect_timeout=3.05, read_timeout=10.0):
+        self._endpoint = endpoint.rstrip("/")
+        self._headers = {"Content-Type": "application/json", "Authorization": f"Bearer {channel_access_token}"}
+        self.session = session
+        self._pool_size = pool_size
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+
+    async def start(self):
+        if self.session is None:
+            self.session = create_session(self._pool_size, self._connect_timeout, self._read_timeout)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def reply(self, reply_token, texts):
+        await self._post("/v2/bot/message/reply", {"replyToken": reply_token, "messages": _text_messages(texts)})
+
+    async def push(self, to, texts):
+        await self._post("/v2/bot/message/push", {"to": to, "messages": _text_messages(texts)})
+
+    async def _post(self, path, payload):
+        async with self.session.post(self._endpoint + path, headers=self._headers, json=payload) as response:
+            response.raise_for_status()
+
+
+def _text_messages(texts):
+    return [{"type": "text", "text": text} for text in texts]
+
+
+async def iter_stripe_subscriptions(session, api_key, api_base=STRIPE_API_BASE, page_size=100):
+    """Stripeの全サブスクリプションを新しい順に返す（starting_after によるページング）。"""
+    url = api_base.rstrip("/") + "/v1/subscriptions"
+    headers = {"Authorization": f"Bearer {api_key}"}
+    params = {"limit": str(page_size), "status": "all"}
+    while True:
+        async with session.get(url, headers=headers, params=params) as response:
+            response.raise_for_status()
+            page = await response.json()
+        for subscription in page["data"]:
+            yield subscription
+        if not page.get("has_more") or not page["data"]:
+            return
+        params["starting_after"] = page["data"][-1]["id"]
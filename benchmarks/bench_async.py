@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+同時に会話できるユーザー数の比較（gevent版 main.py と asyncio版 async_app.py）
+
+LLMの応答が遅い（--latency 秒）状態で、同時に会話するユーザー数を --levels の順に増やしながら
+bench_load.py と同じ負荷（署名付きWebhook・外部サービスは fakes.py の代役）をかける。
+モードごとに、/callback の p95 が --slo-ms 以内でエラーのない最大の同時ユーザー数を報告する。
+
+- gevent: gunicorn main:app --worker-class gevent
+- async:  gunicorn async_app:create_app --worker-class aiohttp.GunicornWebWorker
+
+どちらも --workers のワーカー数で起動する（スレッド数の指定はない）。
+DB接続数はどちらもワーカーあたり20（main.py のプールの上限と ASYNC_DB_POOL_SIZE の既定値）。
+
+    DATABASE_URL=postgresql://localhost/linebot_bench \\
+        python benchmarks/bench_async.py --levels 50,100,200,400 --latency 2.0 --slo-ms 3000 \\
+        --output async-$(git rev-parse --short HEAD).json
+"""
+
+import argparse
+import copy
+import datetime
+import json
+import platform
+import tempfile
+
+import psycopg2
+
+from bench_load import SCHEMA, build_conversations, dsn_from_env, free_port, git_revision, run_config
+
+MODES = {
+    "gevent": ("main:app", "gevent"),
+    "async": ("async_app:create_app", "aiohttp.GunicornWebWorker"),
+}
+
+
+def parse_levels(value):
+    return [int(level) for level in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="gevent,async", help="比較するモードをカンマ区切りで")
+    parser.add_argument("--levels", type=parse_levels, default=parse_levels("25,50,100,200"),
+                        help="同時に会話するユーザー数をカンマ区切りで（小さい順）")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--turns", type=int, default=3, help="1ユーザーあたりの発言数")
+    parser.add_argument("--slo-ms", type=float, default=3000, help="/callback の p95 の目標（ミリ秒）")
+    parser.add_argument("--paid-ratio", type=float, default=0.3, help="有料プランのユーザーの割合")
+    parser.add_argument("--latency", type=float, default=2.0, help="疑似OpenAIの最初のトークンまでの遅延（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="疑似OpenAIのトークンごとの遅延（秒）")
+    parser.add_argument("--streaming", action="store_true", help="LINE_STREAMING=1 で起動する")
+    parser.add_argument("--settle", type=float, default=2.0, help="起動後、計測を始めるまでの待ち時間（秒）")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="アプリに渡す環境変数（例: --set LOG_WRITER_MODE=sync）")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="結果のJSONを書き出すファイル")
+    parser.add_argument("--keep", action="store_true", help="終了後もベンチマーク用スキーマを残す")
+    args = parser.parse_args()
+
+    modes = args.modes.split(",")
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(unknown)}")
+
+    dsn = dsn_from_env()
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "keep")},
+        "results": [],
+        "capacity": {},
+    }
+    print(f"revision={report['revision']} workers={args.workers} latency={args.latency * 1000:.0f}ms "
+          f"slo=p95<{args.slo_ms:.0f}ms streaming={args.streaming}")
+    print(f"{'mode':<8}{'users':>7}{'msgs/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    with tempfile.NamedTemporaryFile("w", prefix="bench_async_", suffix=".log", delete=False) as log_file:
+        try:
+            for mode in modes:
+                app, worker_class = MODES[mode]
+                capacity = 0
+                for level in args.levels:
+                    # bench_load.run_config が読む引数をこのレベル用に作る
+                    level_args = copy.copy(args)
+                    level_args.worker_class = worker_class
+                    level_args.concurrency = level
+                    level_args.think_time = 0.0
+                    level_args.burst = 1
+                    conversations = build_conversations(level, args.seed, args.turns, args.turns)
+                    result = run_config(level_args, dsn, conversations, args.workers, 1, free_port(), log_file, app)
+                    result["mode"] = mode
+                    result["users"] = level
+                    p95 = result["latency_ms"]["p95"]
+                    result["meets_slo"] = result["errors"] == 0 and p95 is not None and p95 <= args.slo_ms
+                    report["results"].append(result)
+                    latency = result["latency_ms"]
+                    print(f"{mode:<8}{level:>7}{result['msgs_per_sec']:>9.2f}{latency['p50'] or 0:>10.1f}"
+                          f"{latency['p95'] or 0:>10.1f}{latency['p99'] or 0:>10.1f}{result['errors']:>8}")
+                    if not result["meets_slo"]:
+                        # これより多い同時ユーザー数では満たせないとみなす
+                        break
+                    capacity = level
+                report["capacity"][mode] = capacity
+        finally:
+            if not args.keep:
+                connection = psycopg2.connect(dsn)
+                with connection.cursor() as cursor:
+                    cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+                connection.commit()
+                connection.close()
+    print("capacity (users within SLO): " + ", ".join(f"{mode}={users}" for mode, users in report["capacity"].items()))
+    print(f"app log: {log_file.name}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
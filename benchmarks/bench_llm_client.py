@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+LLMクライアントのベンチマーク
+
+ローカルの疑似OpenAIサーバー（応答遅延を指定可能）に対して、
+毎回 requests.post で接続する従来の方式と、接続を使い回す LLMClient の
+レイテンシを比較する。--tls を付けると自己署名証明書（openssl コマンドで生成）でHTTPSにする。
+最後に上流が応答しない場合に、タイムアウトとサーキットブレーカーで何秒で諦めるかを計測する。
+
+    python benchmarks/bench_llm_client.py --requests 200 --latency 0.02 --tls
+"""
+
+import argparse
+import json
+import os
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from llm_client import CircuitBreaker, LLMClient  # noqa: E402
+
+BODY = json.dumps({"choices": [{"message": {"content": "ゆっくりで大丈夫です。"}}]}).encode()
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # ヘッダーと本文を別々に書くので、Nagleと遅延ACKの組み合わせで40ms待たされないようにする
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # タイムアウトしたクライアントが切断した後の書き込みエラーは無視する
+        pass
+
+
+def start_server(latency, tls_dir=None):
+    server = MockOpenAIServer(("127.0.0.1", 0), MockOpenAIHandler)
+    server.latency = latency
+    scheme = "http"
+    if tls_dir:
+        cert, key = os.path.join(tls_dir, "cert.pem"), os.path.join(tls_dir, "key.pem")
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+             "-keyout", key, "-out", cert],
+            check=True, capture_output=True,
+        )
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{scheme}://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def summarize(name, durations):
+    ordered = sorted(durations)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print(f"{name:<22}{statistics.median(ordered) * 1000:>10.2f}{p95 * 1000:>10.2f}{statistics.mean(ordered) * 1000:>10.2f}")
+
+
+def measure(call, count):
+    durations = []
+    for _ in range(count):
+        started = time.perf_counter()
+        call()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.02, help="疑似サーバーの応答遅延（秒）")
+    parser.add_argument("--tls", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tls_dir:
+        server, base_url = start_server(args.latency, tls_dir if args.tls else None)
+        verify = os.path.join(tls_dir, "cert.pem") if args.tls else True
+        url = base_url + "/chat/completions"
+        payload = {"model": "gpt-4o", "messages": [{"role": "user", "content": "こんにちは"}]}
+
+        def per_request_connection():
+            response = requests.post(url, json=payload, headers={"Authorization": "Bearer key"}, verify=verify)
+            response.raise_for_status()
+            response.json()
+
+        client = LLMClient("key", base_url=base_url)
+        # REQUESTS_CA_BUNDLE などの環境変数がSessionのverifyより優先されないようにする
+        client.session.trust_env = False
+        client.session.verify = verify
+
+        print(f"requests={args.requests} latency={args.latency * 1000:.0f}ms tls={args.tls}")
+        print(f"{'method':<22}{'p50 ms':>10}{'p95 ms':>10}{'avg ms':>10}")
+        summarize("requests.post", measure(per_request_connection, args.requests))
+        summarize("LLMClient (pooled)", measure(lambda: client.chat(payload["messages"]), args.requests))
+
+        # 上流がハングした場合：従来は応答が返るまで（gunicornのtimeoutまで）待ち続ける
+        server.latency = 2.0
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        hanging = LLMClient("key", base_url=base_url, read_timeout=0.5, max_retries=0, breaker=breaker)
+        hanging.session.trust_env = False
+        hanging.session.verify = verify
+
+        def call_hanging():
+            try:
+                hanging.chat(payload["messages"])
+            except requests.RequestException:
+                pass
+
+        print(f"\nupstream hanging for {server.latency:.0f}s (read timeout 0.5s, breaker opens after 3 failures)")
+        print(f"{'call':<22}{'ms':>10}{'state':>12}")
+        for i in range(1, 7):
+            duration = measure(call_hanging, 1)[0]
+            print(f"{i:<22}{duration * 1000:>10.2f}{breaker.state:>12}")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
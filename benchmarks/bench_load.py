@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+Webhookの負荷試験
+
+main.py の app を gunicorn で起動し、外部サービスはすべてローカルの代役（fakes.py）に向けて、
+複数ユーザーの会話を署名付きのWebhookとして /callback に送る。
+gunicorn のワーカー数×スレッド数の組み合わせごとに、スループット（msgs/sec）、
+/callback の応答時間（p50/p95/p99）、1メッセージあたりのDBのトランザクション数と
+INSERT行数、LLM・LINEの呼び出し数を計測する。
+
+会話は --seed から決まるので、同じ引数なら同じトラフィックになる。
+--output に結果をJSON（コミットハッシュ付き）で書き出し、コミット間で比較できる。
+DBは DATABASE_URL のデータベースに専用スキーマを作り、組み合わせごとに作り直す。
+
+    DATABASE_URL=postgresql://localhost/linebot_bench \\
+        python benchmarks/bench_load.py --configs 1x4,2x4,4x8 --users 40 --concurrency 16 \\
+        --latency 0.5 --output load-$(git rev-parse --short HEAD).json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import queue
+import socket
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psycopg2
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from fakes import FakeServices, fake_subscription, line_signature, line_webhook  # noqa: E402
+from migrations import dsn_from_env, run_migrations  # noqa: E402
+
+SCHEMA = "bench_load"
+CHANNEL_SECRET = "bench-channel-secret"
+PRICE_ID = "price_bench"
+
+USER_MESSAGES = (
+    "最近眠れなくて困っています",
+    "仕事が忙しくて、休む時間がありません",
+    "上司との関係がうまくいかず、毎朝会社に行くのがつらいです",
+    "家族に心配をかけたくないので、誰にも相談できていません",
+    "少し話を聞いてもらえますか",
+    "ありがとうございます。少し気持ちが楽になりました",
+    "どうしたらいいのか自分でもよく分からなくなってしまいました",
+    "週末は何もする気が起きず、ずっと寝ています",
+    "友達に会うのも億劫に感じます",
+    "前はもっと楽しめていたことが、今は楽しくありません",
+)
+
+
+def build_conversations(users, seed, min_turns, max_turns):
+    """ユーザーごとの発言の列を作る。一部のユーザーは「スタート」で会話をリセットしてから話す。"""
+    rng = random.Random(seed)
+    conversations = []
+    for i in range(users):
+        user_id = f"U{i:032x}"
+        turns = []
+        if rng.random() < 0.2:
+            turns.append("スタート")
+        for _ in range(rng.randint(min_turns, max_turns)):
+            sentences = rng.sample(USER_MESSAGES, rng.randint(1, 3))
+            turns.append("。".join(sentences) + "。")
+        conversations.append((user_id, turns))
+    return conversations
+
+
+def reset_schema(dsn, conversations, paid_ratio, seed):
+    """専用スキーマを作り直し、過去の会話ログを投入する。"""
+    connection = psycopg2.connect(dsn, options=f"-c search_path={SCHEMA}")
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA};")
+        connection.commit()
+        run_migrations(connection)
+        with connection.cursor() as cursor:
+            # 24時間より前の会話なので利用回数には数えられない
+            cursor.execute(
+                """
+                INSERT INTO line_bot_logs (timestamp, sender, lineId, message, is_active)
+                SELECT NOW() - INTERVAL '2 days' + g * INTERVAL '1 minute',
+                       CASE WHEN g %% 2 = 0 THEN 'user' ELSE 'system' END,
+                       u.line_id, repeat('以前の会話です。', 10), TRUE
+                FROM unnest(%s) AS u(line_id), generate_series(1, 12) AS g;
+                """,
+                ([user_id for user_id, _ in conversations],),
+            )
+        connection.commit()
+    finally:
+        connection.close()
+    rng = random.Random(seed)
+    return [fake_subscription(user_id, PRICE_ID) for user_id, _ in conversations if rng.random() < paid_ratio]
+
+
+def read_db_stats(dsn):
+    connection = psycopg2.connect(dsn)
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_stat_clear_snapshot();")
+            cursor.execute(
+                "SELECT xact_commit + xact_rollback, tup_inserted FROM pg_stat_database "
+                "WHERE datname = current_database();"
+            )
+            transactions, inserted = cursor.fetchone()
+            statements = None
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements';")
+            if cursor.fetchone():
+                cursor.execute(
+                    "SELECT COALESCE(SUM(calls), 0) FROM pg_stat_statements "
+                    "WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database());"
+                )
+                statements = int(cursor.fetchone()[0])
+    finally:
+        connection.close()
+    return {"transactions": transactions, "inserted": inserted, "statements": statements}
+
+
+def start_app(args, workers, threads, fakes, port, log_file, app="main:app"):
+    env = dict(os.environ)
+    env.pop("REDIS_URL", None)
+    env.update({
+        "YOUR_CHANNEL_ACCESS_TOKEN": "bench-token",
+        "YOUR_CHANNEL_SECRET": CHANNEL_SECRET,
+        "OPENAI_API_KEY": "bench-key",
+        "OPENAI_API_BASE": f"{fakes.url}/v1",
+        "LINE_API_ENDPOINT": fakes.url,
+        "STRIPE_SECRET_KEY": "sk_test_bench",
+        "STRIPE_API_BASE": fakes.url,
+        "SUBSCRIPTION_PRICE_ID": PRICE_ID,
+        "SUBSCRIPTION_SYNC_INTERVAL": "3600",
+        "RUN_MIGRATIONS": "0",
+        "DATABASE_URL": dsn_from_env(),
+        "PGOPTIONS": f"-c search_path={SCHEMA}",
+        "LINE_STREAMING": "1" if args.streaming else "0",
+    })
+    for setting in args.set:
+        key, _, value = setting.partition("=")
+        env[key] = value
+    command = [
+        sys.executable, "-m", "gunicorn", app, "--chdir", ROOT,
+        "--bind", f"127.0.0.1:{port}", "--workers", str(workers), "--threads", str(threads),
+        "--worker-class", args.worker_class, "--timeout", "120", "--log-level", "warning",
+    ]
+    process = subprocess.Popen(command, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {process.returncode} (see {log_file.name})")
+        try:
+            # ソケットはワーカーの起動前から受け付けるので、アプリの読み込みが終わるまで待たされる
+            if requests.get(url + "/", timeout=5).status_code == 200:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    stop_app(process)
+    raise RuntimeError(f"gunicorn did not become ready (see {log_file.name})")
+
+
+def stop_app(process):
+    process.terminate()
+    try:
+        process.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def replay(url, conversations, concurrency, think_time, seed, burst=1, burst_gap=0.05):
+    """ユーザーごとに発言を順番に送る（前の返信を待ってから次を送る）。
+
+    burst が2以上なら、続く burst 件の発言を burst_gap 秒おきに返信を待たずに送る（連投の再現）。
+    """
+    pending = queue.Queue()
+    for conversation in conversations:
+        pending.put(conversation)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def post(session, user_id, text):
+        body = line_webhook(user_id, text)
+        headers = {"Content-Type": "application/json",
+                   "X-Line-Signature": line_signature(CHANNEL_SECRET, body)}
+        started = time.perf_counter()
+        try:
+            response = session.post(url + "/callback", data=body.encode(), headers=headers, timeout=120)
+            status = response.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - started
+        with lock:
+            if status == 200:
+                latencies.append(elapsed)
+            else:
+                errors.append(status)
+
+    def client(index):
+        rng = random.Random(seed * 1000 + index)
+        sessions = [requests.Session() for _ in range(burst)]
+        while True:
+            try:
+                user_id, turns = pending.get_nowait()
+            except queue.Empty:
+                return
+            for start in range(0, len(turns), burst):
+                senders = []
+                for session, text in zip(sessions, turns[start:start + burst]):
+                    if senders:
+                        time.sleep(burst_gap)
+                    sender = threading.Thread(target=post, args=(session, user_id, text))
+                    sender.start()
+                    senders.append(sender)
+                for sender in senders:
+                    sender.join()
+                if think_time:
+                    time.sleep(rng.uniform(0, think_time * 2))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.perf_counter() - started
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_config(args, dsn, conversations, workers, threads, port, log_file, app="main:app"):
+    subscriptions = reset_schema(dsn, conversations, args.paid_ratio, args.seed)
+    fakes = FakeServices(latency=args.latency, token_delay=args.token_delay, subscriptions=subscriptions,
+                         seed=args.seed).start()
+    process, url = start_app(args, workers, threads, fakes, port, log_file, app)
+    try:
+        # 起動時の一括同期や回数制限の読み込みを計測に含めない
+        time.sleep(args.settle)
+        db_before = read_db_stats(dsn)
+        calls_before = fakes.snapshot()
+        latencies, errors, duration = replay(url, conversations, args.concurrency, args.think_time, args.seed,
+                                             args.burst)
+    finally:
+        # 終了時にログの残りが書き込まれ、各接続の統計もDBに反映される
+        stop_app(process)
+        fakes.shutdown()
+    time.sleep(1.0)
+    db_after = read_db_stats(dsn)
+    calls_after = fakes.snapshot()
+
+    messages = len(latencies) + len(errors)
+    ordered = sorted(latencies)
+
+    def per_message(before, after):
+        return None if before is None or after is None else round((after - before) / messages, 2)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+
+    return {
+        "app": app,
+        "workers": workers,
+        "threads": threads,
+        "worker_class": args.worker_class,
+        "messages": messages,
+        "errors": len(errors),
+        "error_kinds": sorted({str(error) for error in errors}),
+        "duration_s": round(duration, 3),
+        "msgs_per_sec": round(messages / duration, 2),
+        "latency_ms": {
+            "p50": ms(percentile(ordered, 0.50)),
+            "p95": ms(percentile(ordered, 0.95)),
+            "p99": ms(percentile(ordered, 0.99)),
+            "mean": ms(statistics.mean(ordered)) if ordered else None,
+            "max": ms(ordered[-1]) if ordered else None,
+        },
+        "db_per_message": {
+            "transactions": per_message(db_before["transactions"], db_after["transactions"]),
+            "statements": per_message(db_before["statements"], db_after["statements"]),
+            "rows_inserted": per_message(db_before["inserted"], db_after["inserted"]),
+        },
+        "upstream_per_message": {
+            key: round((calls_after[key] - calls_before[key]) / messages, 2) for key in ("llm", "line_reply", "line_push")
+        },
+    }
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return revision + ("-dirty" if dirty else "")
+
+
+def parse_configs(value):
+    configs = []
+    for item in value.split(","):
+        workers, _, threads = item.partition("x")
+        configs.append((int(workers), int(threads or 1)))
+    return configs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--configs", type=parse_configs, default=parse_configs("1x4,2x4"),
+                        help="ワーカー数xスレッド数をカンマ区切りで（例: 1x4,2x8）")
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--min-turns", type=int, default=3)
+    parser.add_argument("--max-turns", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=16, help="同時に会話するユーザー数")
+    parser.add_argument("--think-time", type=float, default=0.0, help="発言の間隔の平均（秒）")
+    parser.add_argument("--burst", type=int, default=1, help="返信を待たずに続けて送る発言数（連投の再現）")
+    parser.add_argument("--paid-ratio", type=float, default=0.3, help="有料プランのユーザーの割合")
+    parser.add_argument("--latency", type=float, default=0.5, help="疑似OpenAIの最初のトークンまでの遅延（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="疑似OpenAIのトークンごとの遅延（秒）")
+    parser.add_argument("--streaming", action="store_true", help="LINE_STREAMING=1 で起動する")
+    parser.add_argument("--settle", type=float, default=2.0, help="起動後、計測を始めるまでの待ち時間（秒）")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="アプリに渡す環境変数（例: --set LOG_WRITER_MODE=sync）")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=0, help="gunicorn のポート（0で空いているポート）")
+    parser.add_argument("--output", help="結果のJSONを書き出すファイル")
+    parser.add_argument("--keep", action="store_true", help="終了後もベンチマーク用スキーマを残す")
+    args = parser.parse_args()
+
+    dsn = dsn_from_env()
+    conversations = build_conversations(args.users, args.seed, args.min_turns, args.max_turns)
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "keep", "port")},
+        "messages_planned": sum(len(turns) for _, turns in conversations),
+        "results": [],
+    }
+    print(f"revision={report['revision']} users={args.users} messages={report['messages_planned']} "
+          f"concurrency={args.concurrency} latency={args.latency * 1000:.0f}ms streaming={args.streaming}")
+    print(f"{'config':<10}{'msgs/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'db tx':>8}{'rows':>7}{'llm':>6}{'errors':>8}")
+    with tempfile.NamedTemporaryFile("w", prefix="bench_load_", suffix=".log", delete=False) as log_file:
+        try:
+            for workers, threads in args.configs:
+                result = run_config(args, dsn, conversations, workers, threads, args.port or free_port(), log_file)
+                report["results"].append(result)
+                latency, db = result["latency_ms"], result["db_per_message"]
+                print(f"{workers}x{threads:<8}{result['msgs_per_sec']:>9.2f}{latency['p50'] or 0:>10.1f}"
+                      f"{latency['p95'] or 0:>10.1f}{latency['p99'] or 0:>10.1f}{db['transactions']:>8.2f}"
+                      f"{db['rows_inserted']:>7.2f}{result['upstream_per_message']['llm']:>6.2f}{result['errors']:>8}")
+        finally:
+            if not args.keep:
+                connection = psycopg2.connect(dsn)
+                with connection.cursor() as cursor:
+                    cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+                connection.commit()
+                connection.close()
+    print(f"app log: {log_file.name}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
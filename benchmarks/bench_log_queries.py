@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+line_bot_logs のホットクエリのベンチマーク
+
+ローカルのPostgresに専用スキーマを作って大量の行を投入し、
+マイグレーション（インデックス作成）の前後で3つのクエリのレイテンシを計測する。
+
+    DATABASE_URL=postgresql://localhost/linebot_bench \\
+        python benchmarks/bench_log_queries.py --rows 3000000 --users 20000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from migrations import BASE_SCHEMA_SQL, dsn_from_env, run_migrations  # noqa: E402
+
+SCHEMA = "bench_line_bot_logs"
+
+QUERIES = {
+    "count_24h": (
+        "SELECT COUNT(*) FROM line_bot_logs "
+        "WHERE sender='system' AND lineId=%s AND timestamp > NOW() - INTERVAL '24 HOURS';"
+    ),
+    "history": (
+        "SELECT sender, message FROM line_bot_logs "
+        "WHERE lineId=%s AND is_active=TRUE ORDER BY timestamp DESC LIMIT 10;"
+    ),
+    "reset": "UPDATE line_bot_logs SET is_active=FALSE WHERE lineId=%s AND is_active=TRUE;",
+}
+
+
+def seed(connection, rows, users):
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {SCHEMA};")
+        cursor.execute(BASE_SCHEMA_SQL)
+        # 90日分のログ。ユーザー1人あたり user/system が交互に並び、古い会話の多くは無効
+        cursor.execute(
+            """
+            INSERT INTO line_bot_logs (timestamp, sender, lineId, stripeId, message, is_active, sys_prompt)
+            SELECT NOW() - (random() * INTERVAL '90 days'),
+                   CASE WHEN g %% 2 = 0 THEN 'user' ELSE 'system' END,
+                   'U' || (g %% %s),
+                   NULL,
+                   repeat('メッセージ', 20),
+                   random() < 0.1,
+                   NULL
+            FROM generate_series(1, %s) AS g;
+            """,
+            (users, rows),
+        )
+        cursor.execute("ANALYZE line_bot_logs;")
+    connection.commit()
+
+
+def measure(connection, users, iterations):
+    results = {}
+    with connection.cursor() as cursor:
+        for name, query in QUERIES.items():
+            timings = []
+            for _ in range(iterations):
+                user_id = f"U{random.randrange(users)}"
+                started = time.perf_counter()
+                cursor.execute(query, (user_id,))
+                if cursor.description:
+                    cursor.fetchall()
+                timings.append((time.perf_counter() - started) * 1000)
+                # リセットの影響が次の計測に残らないよう毎回ロールバックする
+                connection.rollback()
+            timings.sort()
+            results[name] = {
+                "p50": statistics.median(timings),
+                "p95": timings[int(len(timings) * 0.95) - 1],
+                "max": timings[-1],
+            }
+    return results
+
+
+def report(label, results):
+    print(f"\n[{label}]")
+    print(f"{'query':<12}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for name, stats in results.items():
+        print(f"{name:<12}{stats['p50']:>10.2f}{stats['p95']:>10.2f}{stats['max']:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=3_000_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--keep", action="store_true", help="終了後もベンチマーク用スキーマを残す")
+    args = parser.parse_args()
+
+    # 本番のテーブルに触れないよう、専用スキーマだけを参照する
+    connection = psycopg2.connect(dsn_from_env(), options=f"-c search_path={SCHEMA}")
+    try:
+        started = time.perf_counter()
+        seed(connection, args.rows, args.users)
+        print(f"Seeded {args.rows:,} rows for {args.users:,} users in {time.perf_counter() - started:.1f}s")
+
+        before = measure(connection, args.users, args.iterations)
+        report("before migrations", before)
+
+        started = time.perf_counter()
+        run_migrations(connection)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE line_bot_logs;")
+        connection.commit()
+        print(f"\nMigrations applied in {time.perf_counter() - started:.1f}s")
+
+        after = measure(connection, args.users, args.iterations)
+        report("after migrations", after)
+
+        print("\nspeedup (p50)")
+        for name in QUERIES:
+            print(f"{name:<12}{before[name]['p50'] / max(after[name]['p50'], 1e-6):>10.1f}x")
+    finally:
+        if not args.keep:
+            with connection.cursor() as cursor:
+                cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+            connection.commit()
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+1メッセージあたりのDBアクセスのベンチマーク
+
+ローカルのPostgresに専用スキーマを作ってログを投入し、1メッセージの処理で行うDBアクセスを比較する。
+
+- legacy: ユーザー行のINSERT、24時間の応答数のCOUNT、履歴のSELECT、システム行のINSERTを
+  それぞれ別の接続取得・コミットで行う従来の方式
+- data_access (cold): キャッシュが空の状態で、ContextPrefetcher の1文の読み込みと2行まとめた書き込み
+- data_access (warm): キャッシュ済みのユーザーで、書き込みのみ
+
+--rtt でクエリ・コミットごとにネットワークの往復遅延を加え、DBが別ホストにある本番に近づけられる。
+
+    DATABASE_URL=postgresql://localhost/linebot_bench \\
+        python benchmarks/bench_message_path.py --users 2000 --messages 500 --rtt 0.001
+"""
+
+import argparse
+import datetime
+import os
+import random
+import statistics
+import sys
+import time
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2 import pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from data_access import ContextPrefetcher, ConversationStore  # noqa: E402
+from history_cache import HistoryCache, MemoryHistoryBackend  # noqa: E402
+from log_writer import LogWriter  # noqa: E402
+from migrations import dsn_from_env, run_migrations  # noqa: E402
+from quota import MemoryQuotaBackend, QuotaLimiter, QuotaPolicy  # noqa: E402
+from subscription_index import PostgresSubscriptionStore, SubscriptionIndex  # noqa: E402
+
+SCHEMA = "bench_message_path"
+HISTORY_LIMIT = 10
+WINDOW = 24 * 60 * 60
+
+
+class Counter:
+    round_trips = 0
+    checkouts = 0
+    rtt = 0.0
+
+    @classmethod
+    def trip(cls):
+        cls.round_trips += 1
+        if cls.rtt:
+            time.sleep(cls.rtt)
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, params=None):
+        Counter.trip()
+        return super().execute(query, params)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault("cursor_factory", CountingCursor)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        Counter.trip()
+        return super().commit()
+
+    def rollback(self):
+        # 読み込みのみのトランザクションの終了やプールへの返却時のロールバックも1往復
+        Counter.trip()
+        return super().rollback()
+
+
+def seed(connection, users):
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {SCHEMA};")
+    connection.commit()
+    run_migrations(connection)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO line_bot_logs (timestamp, sender, lineId, message, is_active)
+            SELECT NOW() - (random() * INTERVAL '30 days'),
+                   CASE WHEN g %% 2 = 0 THEN 'user' ELSE 'system' END,
+                   'U' || (g %% %s),
+                   repeat('メッセージ', 20),
+                   random() < 0.3
+            FROM generate_series(1, %s) AS g;
+            """,
+            (users, users * 40),
+        )
+        cursor.execute(
+            """
+            INSERT INTO stripe_subscriptions (line_user_id, subscription_id, stripe_customer_id, price_id, status)
+            SELECT 'U' || g, 'sub_' || g, 'cus_' || g, 'price', 'active' FROM generate_series(0, %s, 5) AS g;
+            """,
+            (users,),
+        )
+        cursor.execute("ANALYZE;")
+    connection.commit()
+
+
+def legacy_message(connection_pool, user_id):
+    """従来の main.py と同じ4回の接続取得と往復"""
+    now = datetime.datetime.now()
+
+    def checkout():
+        Counter.checkouts += 1
+        return connection_pool.getconn()
+
+    connection = checkout()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO line_bot_logs (timestamp, sender, lineId, stripeId, message, is_active, sys_prompt) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s);",
+            (now, "user", user_id, None, "こんにちは", True, None),
+        )
+    connection.commit()
+    connection_pool.putconn(connection)
+
+    connection = checkout()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT COUNT(*) FROM line_bot_logs WHERE sender='system' AND lineId=%s "
+            "AND timestamp > NOW() - INTERVAL '24 HOURS';",
+            (user_id,),
+        )
+        cursor.fetchone()
+    connection_pool.putconn(connection)
+
+    connection = checkout()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT sender, message FROM line_bot_logs WHERE lineId=%s AND is_active=TRUE "
+            "ORDER BY timestamp DESC LIMIT 10;",
+            (user_id,),
+        )
+        cursor.fetchall()
+    connection_pool.putconn(connection)
+
+    connection = checkout()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO line_bot_logs (timestamp, sender, lineId, stripeId, message, is_active, sys_prompt) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s);",
+            (now, "system", user_id, None, "ゆっくりで大丈夫です。", True, None),
+        )
+    connection.commit()
+    connection_pool.putconn(connection)
+
+
+def build_data_access(connection_pool):
+    def get_connection():
+        Counter.checkouts += 1
+        return connection_pool.getconn()
+
+    writer = LogWriter(get_connection, connection_pool.putconn, synchronous=True)
+    store = ConversationStore(get_connection, connection_pool.putconn, writer, history_limit=HISTORY_LIMIT)
+    history_cache = HistoryCache(MemoryHistoryBackend(max_users=100000), limit=HISTORY_LIMIT)
+    quota_limiter = QuotaLimiter(MemoryQuotaBackend(), [QuotaPolicy("free", 5)], store.fetch_reply_times, window=WINDOW)
+    subscription_index = SubscriptionIndex(
+        PostgresSubscriptionStore(get_connection, connection_pool.putconn), None, "price", ttl=3600, max_entries=100000,
+    )
+    prefetcher = ContextPrefetcher(store, history_cache, quota_limiter, subscription_index)
+
+    def message(user_id):
+        now = datetime.datetime.now()
+        prefetcher.prefetch(user_id)
+        subscription_index.lookup(user_id)
+        quota_limiter.check(user_id, "free")
+        history_cache.get(user_id, store.fetch_history)
+        store.record_exchange(user_id, None, now, "こんにちは", now, "ゆっくりで大丈夫です。")
+        quota_limiter.record(user_id, now.timestamp())
+        history_cache.append(user_id, "user", "こんにちは")
+        history_cache.append(user_id, "assistant", "ゆっくりで大丈夫です。")
+
+    return message
+
+
+def run(name, handle, user_ids):
+    Counter.round_trips = Counter.checkouts = 0
+    durations = []
+    for user_id in user_ids:
+        started = time.perf_counter()
+        handle(user_id)
+        durations.append((time.perf_counter() - started) * 1000)
+    durations.sort()
+    count = len(user_ids)
+    print(
+        f"{name:<22}{Counter.round_trips / count:>8.1f}{Counter.checkouts / count:>10.1f}"
+        f"{statistics.median(durations):>10.2f}{durations[int(count * 0.95) - 1]:>10.2f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--rtt", type=float, default=0.0, help="往復ごとに加える遅延（秒）")
+    parser.add_argument("--keep", action="store_true", help="終了後もベンチマーク用スキーマを残す")
+    args = parser.parse_args()
+
+    dsn = dsn_from_env()
+    setup = psycopg2.connect(dsn, options=f"-c search_path={SCHEMA}")
+    seed(setup, args.users)
+    connection_pool = pool.ThreadedConnectionPool(
+        1, 4, dsn=dsn, options=f"-c search_path={SCHEMA}", connection_factory=CountingConnection,
+    )
+    try:
+        Counter.rtt = args.rtt
+        rng = random.Random(1)
+        cold_users = rng.sample(range(args.users), min(args.messages, args.users))
+        user_ids = [f"U{i}" for i in cold_users]
+
+        print(f"users={args.users} messages={len(user_ids)} rtt={args.rtt * 1000:.1f}ms")
+        print(f"{'method':<22}{'trips':>8}{'checkouts':>10}{'p50 ms':>10}{'p95 ms':>10}")
+        run("legacy", lambda user_id: legacy_message(connection_pool, user_id), user_ids)
+        data_access_message = build_data_access(connection_pool)
+        run("data_access (cold)", data_access_message, user_ids)
+        run("data_access (warm)", data_access_message, user_ids)
+    finally:
+        connection_pool.closeall()
+        if not args.keep:
+            with setup.cursor() as cursor:
+                cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+            setup.commit()
+        setup.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+プロンプト組み立てのベンチマーク
+
+固定10件の履歴をそのまま送る従来の方式と、トークン予算に基づく PromptBuilder で
+1リクエストあたりの入力トークン数と組み立て時間を比較する。
+会話の長さはカウンセリングの実際のやり取りに近い分布（短い相づちと長い相談の混在）で生成する。
+
+    python benchmarks/bench_prompt_builder.py --conversations 1000 --budget 1500
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from prompt_builder import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, PromptBuilder, count_tokens  # noqa: E402
+
+SYSTEM_PROMPT = "あなたは、クライアント中心療法と動機づけ面接に基づいて話を聴くカウンセラーです。" * 8
+
+
+def make_history(rng, turns):
+    history = []
+    for i in range(turns):
+        role = "user" if i % 2 == 0 else "assistant"
+        length = rng.choice([10, 30, 80, 200, 600])
+        history.append({"role": role, "content": "".join(rng.choice("あいうえおかきくけこ。") for _ in range(length))})
+    return history
+
+
+def fixed_window(history, prompt):
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    messages.extend(history[-10:])
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def message_tokens(messages, model):
+    return sum(count_tokens(m["content"], model) + TOKENS_PER_MESSAGE for m in messages) + TOKENS_PER_REPLY
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=1000)
+    parser.add_argument("--budget", type=int, default=1500)
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    samples = [(make_history(rng, 10), "最近よく眠れなくて困っています。") for _ in range(args.conversations)]
+    builder = PromptBuilder(SYSTEM_PROMPT, args.budget, model=args.model)
+
+    results = {}
+    for name, build in (
+        ("fixed_10_rows", lambda history, prompt: fixed_window(history, prompt)),
+        ("token_budget", lambda history, prompt: builder.build(None, history, prompt)[0]),
+    ):
+        tokens, durations = [], []
+        for history, prompt in samples:
+            started = time.perf_counter()
+            messages = build(history, prompt)
+            durations.append(time.perf_counter() - started)
+            tokens.append(message_tokens(messages, args.model))
+        results[name] = (tokens, durations)
+
+    print(f"conversations={args.conversations} budget={args.budget} model={args.model}")
+    print(f"{'method':<16}{'avg tokens':>12}{'p95 tokens':>12}{'max tokens':>12}{'avg build':>14}")
+    for name, (tokens, durations) in results.items():
+        print(
+            f"{name:<16}{statistics.mean(tokens):>12.0f}{percentile(tokens, 0.95):>12}{max(tokens):>12}"
+            f"{statistics.mean(durations) * 1e6:>12.1f}µs"
+        )
+
+
+if __name__ == "__main__":
+    main()
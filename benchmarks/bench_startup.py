@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+起動時間のベンチマーク（Herokuのdynoの再起動・スケールアウトの再現）
+
+1. main.py の import にかかる時間（新しいプロセスで --repeats 回）
+2. gunicorn を起動してから、/ が応答するまで（listen）・/readyz が200になるまで（ready）の時間と、
+   最初のWebhookと2回目のWebhookの /callback の応答時間
+
+2 は、最初のWebhookを / が応答した直後に送る場合（immediate: 起動直後にトラフィックが来る）と、
+/readyz が200になってから送る場合（ready）の両方を計測する。外部サービスは fakes.py の代役に向け、
+DBは bench_load.py と同じ専用スキーマに過去の会話ログを入れてから起動する。
+
+    DATABASE_URL=postgresql://localhost/linebot_bench \\
+        python benchmarks/bench_startup.py --repeats 5 --output startup-$(git rev-parse --short HEAD).json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2
+import requests
+
+from bench_load import (
+    CHANNEL_SECRET, PRICE_ID, ROOT, SCHEMA, build_conversations, dsn_from_env, free_port, git_revision, reset_schema,
+    start_app, stop_app,
+)
+from fakes import FakeServices, line_signature, line_webhook
+
+IMPORT_SNIPPET = (
+    "import sys, time\n"
+    "started = time.perf_counter()\n"
+    "import main\n"
+    "print(time.perf_counter() - started, 'stripe' in sys.modules)\n"
+)
+
+
+def measure_import(dsn):
+    env = dict(os.environ)
+    env.pop("REDIS_URL", None)
+    env.update({
+        "YOUR_CHANNEL_ACCESS_TOKEN": "bench-token",
+        "YOUR_CHANNEL_SECRET": CHANNEL_SECRET,
+        "OPENAI_API_KEY": "bench-key",
+        "STRIPE_SECRET_KEY": "sk_test_bench",
+        "SUBSCRIPTION_PRICE_ID": PRICE_ID,
+        "SUBSCRIPTION_SYNC_INTERVAL": "0",
+        "RUN_MIGRATIONS": "0",
+        "WARM_HTTP_CONNECTIONS": "0",
+        "DATABASE_URL": dsn,
+        "PGOPTIONS": f"-c search_path={SCHEMA}",
+    })
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=ROOT, env=env, capture_output=True,
+                            text=True, check=True).stdout.split()
+    return {"import_ms": float(output[0]) * 1000, "process_ms": (time.perf_counter() - started) * 1000,
+            "stripe_imported": output[1] == "True"}
+
+
+def post_webhook(url, user_id, text):
+    body = line_webhook(user_id, text)
+    headers = {"Content-Type": "application/json", "X-Line-Signature": line_signature(CHANNEL_SECRET, body)}
+    started = time.perf_counter()
+    response = requests.post(url + "/callback", data=body.encode(), headers=headers, timeout=120)
+    return (time.perf_counter() - started) * 1000, response.status_code
+
+
+def wait_ready(url, timeout=60):
+    """/readyz が200になるまで待ってその内容を返す（/readyz がない以前のリビジョンではNone）。"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = requests.get(url + "/readyz", timeout=5)
+            if response.status_code == 200:
+                return response.json()
+            if response.status_code == 404:
+                return None
+        except requests.RequestException:
+            pass
+        time.sleep(0.05)
+    raise RuntimeError("the app did not become ready")
+
+
+def measure_cold_start(args, dsn, conversations, mode, log_file):
+    reset_schema(dsn, conversations, 0.0, args.seed)
+    fakes = FakeServices(latency=args.latency, token_delay=args.token_delay).start()
+    started = time.perf_counter()
+    process, url = start_app(args, args.workers, args.threads, fakes, free_port(), log_file)
+    result = {"mode": mode, "listen_ms": (time.perf_counter() - started) * 1000}
+    try:
+        (first_user, first_turns), (second_user, second_turns) = conversations[:2]
+        if mode == "ready":
+            status = wait_ready(url)
+            if status is not None:
+                result["ready_ms"] = (time.perf_counter() - started) * 1000
+                result["steps"] = {name: step.get("seconds") for name, step in status["steps"].items()}
+        result["first_request_ms"], first_status = post_webhook(url, first_user, first_turns[-1])
+        result["second_request_ms"], second_status = post_webhook(url, second_user, second_turns[-1])
+        if mode == "immediate" and wait_ready(url) is not None:
+            result["ready_ms"] = (time.perf_counter() - started) * 1000
+        result["errors"] = [status for status in (first_status, second_status) if status != 200]
+    finally:
+        stop_app(process)
+        fakes.shutdown()
+    return result
+
+
+def summarize(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return {"median": round(statistics.median(values), 1), "min": round(min(values), 1),
+            "max": round(max(values), 1)}
+
+
+def median_ms(summary):
+    return f"{summary['median']:.1f}" if summary else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--modes", default="immediate,ready", help="immediate / ready をカンマ区切りで")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=2)
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--users", type=int, default=200, help="過去の会話ログを入れておくユーザー数")
+    parser.add_argument("--latency", type=float, default=0.2, help="疑似OpenAIの最初のトークンまでの遅延（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.0)
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="アプリに渡す環境変数（例: --set DB_POOL_MIN_CONN=1）")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="結果のJSONを書き出すファイル")
+    args = parser.parse_args()
+    args.streaming = False
+
+    dsn = dsn_from_env()
+    conversations = build_conversations(args.users, args.seed, 1, 1)
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "import": [],
+        "cold_start": [],
+    }
+    print(f"revision={report['revision']} repeats={args.repeats} workers={args.workers}x{args.threads}")
+    with tempfile.NamedTemporaryFile("w", prefix="bench_startup_", suffix=".log", delete=False) as log_file:
+        try:
+            reset_schema(dsn, conversations, 0.0, args.seed)
+            for _ in range(args.repeats):
+                report["import"].append(measure_import(dsn))
+            imports = summarize([result["import_ms"] for result in report["import"]])
+            print(f"import main: {imports['median']:.1f} ms (min {imports['min']:.1f}, "
+                  f"stripe imported: {report['import'][0]['stripe_imported']})")
+
+            print(f"{'mode':<11}{'listen ms':>11}{'ready ms':>10}{'1st req ms':>12}{'2nd req ms':>12}{'errors':>8}")
+            for mode in args.modes.split(","):
+                results = [measure_cold_start(args, dsn, conversations, mode, log_file) for _ in range(args.repeats)]
+                report["cold_start"] += results
+                row = {key: summarize([result.get(key) for result in results])
+                       for key in ("listen_ms", "ready_ms", "first_request_ms", "second_request_ms")}
+                errors = sum(len(result["errors"]) for result in results)
+                print(f"{mode:<11}{median_ms(row['listen_ms']):>11}{median_ms(row['ready_ms']):>10}"
+                      f"{median_ms(row['first_request_ms']):>12}{median_ms(row['second_request_ms']):>12}{errors:>8}")
+                report[f"summary_{mode}"] = row
+        finally:
+            connection = psycopg2.connect(dsn)
+            with connection.cursor() as cursor:
+                cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+            connection.commit()
+            connection.close()
+    print(f"app log: {log_file.name}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+入力検証のベンチマーク
+
+以前の実装（小文字化＋4つの正規表現を順に適用）と validation.MessageValidator で、
+通常のメッセージの1件あたりの検証時間と、意図的に作った最悪ケースの入力（最大長）での検証時間を比較する。
+
+    python benchmarks/bench_validation.py --messages 20000
+"""
+
+import argparse
+import os
+import random
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from validation import MessageValidator, ValidationError  # noqa: E402
+
+MAX_LENGTH = 2000
+SENTENCES = (
+    "最近眠れなくて困っています。",
+    "仕事が忙しくて、休む時間がありません。",
+    "上司との関係がうまくいかず、毎朝会社に行くのがつらいです。",
+    "家族に心配をかけたくないので、誰にも相談できていません。",
+    "少し話を聞いてもらえますか？",
+    "ありがとうございます。",
+    "I can't sleep well these days.",
+)
+ADVERSARIAL_INPUTS = {
+    "open_tags": "<script>" * (MAX_LENGTH // 8),
+    "open_prefixes": "<script" * (MAX_LENGTH // 7),
+    "tag_ends": "<script" + ">" * (MAX_LENGTH - 7),
+    "close_prefixes": "<script>" + "</scrip" * ((MAX_LENGTH - 8) // 7),
+    "full_width": "＜ｓｃｒｉｐｔ＞" * (MAX_LENGTH // 8),
+    "japanese": "あ" * MAX_LENGTH,
+}
+
+
+def legacy_validate(message):
+    if not message or not isinstance(message, str):
+        raise ValueError("Invalid message format")
+    if len(message) > 2000:
+        raise ValueError("Message too long")
+    if not message.strip():
+        raise ValueError("Empty message")
+    dangerous_patterns = [
+        r'<script.*?>.*?</script>',
+        r'javascript:',
+        r'vbscript:',
+        r'data:text/html',
+    ]
+    message_lower = message.lower()
+    for pattern in dangerous_patterns:
+        if re.search(pattern, message_lower, re.IGNORECASE | re.DOTALL):
+            raise ValueError("Potentially dangerous content detected")
+    return message.strip()
+
+
+def time_per_call(validate, messages, repeat=1):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for message in messages:
+            try:
+                validate(message)
+            except ValueError:
+                pass
+    return (time.perf_counter() - started) / (len(messages) * repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5, help="最悪ケースの入力ごとの繰り返し回数")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    messages = ["".join(rng.choice(SENTENCES) for _ in range(rng.randint(1, 6))) for _ in range(args.messages)]
+    validator = MessageValidator()
+    implementations = {"legacy": legacy_validate, "compiled": validator.validate}
+
+    print(f"typical messages (n={len(messages)}, mean {statistics.mean(map(len, messages)):.0f} chars)")
+    for name, validate in implementations.items():
+        print(f"  {name:<10}{time_per_call(validate, messages) * 1e6:>10.2f} us/msg")
+
+    print(f"worst-case inputs ({MAX_LENGTH} chars)")
+    print(f"  {'input':<16}" + "".join(f"{name:>14}" for name in implementations))
+    for input_name, message in ADVERSARIAL_INPUTS.items():
+        row = [time_per_call(validate, [message], args.repeat) * 1000 for validate in implementations.values()]
+        print(f"  {input_name:<16}" + "".join(f"{ms:>11.3f} ms" for ms in row))
+    try:
+        validator.validate(ADVERSARIAL_INPUTS["open_tags"])
+    except ValidationError as e:
+        print(f"open_tags rejected by rule: {e.rule}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+ベンチマーク用の外部サービスの代役
+
+1つのHTTPサーバーで次のエンドポイントに応答し、呼び出し回数を数える。
+
+- POST /v1/chat/completions: OpenAI互換。最初のトークンまでの遅延とトークンごとの遅延を指定でき、
+  "stream": true ならSSE（chunked）で返す
+- POST /v2/bot/message/reply, /v2/bot/message/push: LINE Messaging API
+- GET /v1/subscriptions: Stripeのサブスクリプション一覧（1ページ）
+
+main.py には OPENAI_API_BASE={url}/v1、LINE_API_ENDPOINT={url}、STRIPE_API_BASE={url} で向ける。
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY_SENTENCES = (
+    "毎日忙しくて眠る時間もないと感じていらっしゃるのですね。",
+    "それはとてもお辛い状況だと思います。",
+    "少しでも休める時間を見つけたいというお気持ちが伝わってきます。",
+    "今いちばん困っていることは何でしょうか？",
+    "お話しできる範囲で構いませんので、教えてください。",
+    "ゆっくりで大丈夫です。",
+)
+
+
+class FakeServicesHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.endswith("/chat/completions"):
+            self.server.count("llm")
+            self._chat_completions(json.loads(body))
+        elif self.path == "/v2/bot/message/reply":
+            self.server.count("line_reply")
+            self._send_json({})
+        elif self.path == "/v2/bot/message/push":
+            self.server.count("line_push")
+            self._send_json({})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/v1/subscriptions":
+            self.server.count("stripe_list")
+            self._send_json({"object": "list", "url": "/v1/subscriptions", "has_more": False,
+                             "data": self.server.subscriptions})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def _chat_completions(self, request):
+        server = self.server
+        text = server.reply_text()
+        tokens = [text[i:i + 3] for i in range(0, len(text), 3)]
+        usage = {"prompt_tokens": len(json.dumps(request["messages"], ensure_ascii=False)) // 2,
+                 "completion_tokens": len(tokens)}
+        time.sleep(server.latency)
+        if not request.get("stream"):
+            time.sleep(server.token_delay * len(tokens))
+            self._send_json({"choices": [{"message": {"role": "assistant", "content": text}}], "usage": usage})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for token in tokens:
+            self._write_chunk({"choices": [{"delta": {"content": token}}]})
+            time.sleep(server.token_delay)
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self._write_chunk({"choices": [], "usage": usage})
+        self._write_chunk("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, payload):
+        data = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+        line = f"data: {data}\n\n".encode()
+        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServices(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.5, token_delay=0.01, subscriptions=(), seed=0):
+        super().__init__(("127.0.0.1", 0), FakeServicesHandler)
+        self.latency = latency
+        self.token_delay = token_delay
+        self.subscriptions = list(subscriptions)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = {"llm": 0, "line_reply": 0, "line_push": 0, "stripe_list": 0}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-services", daemon=True).start()
+        return self
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def reply_text(self):
+        with self._lock:
+            return "".join(self._random.sample(REPLY_SENTENCES, self._random.randint(2, 5)))
+
+    def handle_error(self, request, client_address):
+        # 負荷試験の終了時にクライアントが切断した後の書き込みエラーは無視する
+        pass
+
+
+def fake_subscription(line_user_id, price_id, status="active"):
+    """Stripeの一覧APIが返すSubscriptionオブジェクト（subscription_to_row が読む項目のみ）"""
+    suffix = line_user_id[-8:]
+    return {
+        "id": f"sub_{suffix}",
+        "object": "subscription",
+        "customer": f"cus_{suffix}",
+        "status": status,
+        "metadata": {"line_user": line_user_id},
+        "items": {"object": "list", "data": [{"price": {"id": price_id}}]},
+    }
+
+
+def line_webhook(user_id, text, timestamp=None):
+    """テキストメッセージ1件のLINE Webhookのボディ（JSON文字列）を作る。"""
+    timestamp = int((timestamp or time.time()) * 1000)
+    event = {
+        "type": "message",
+        "mode": "active",
+        "timestamp": timestamp,
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": uuid.uuid4().hex.upper()[:26],
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+        "message": {"id": str(timestamp), "type": "text", "text": text},
+    }
+    return json.dumps({"destination": "Ubench", "events": [event]}, ensure_ascii=False)
+
+
+def line_signature(channel_secret, body):
+    """X-Line-Signature ヘッダーの値（ボディのHMAC-SHA256をBase64にしたもの）"""
+    digest = hmac.new(channel_secret.encode(), body.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
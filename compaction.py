@@ -0,0 +1,396 @@
+"""
+line_bot_logs のアーカイブと圧縮
+
+会話履歴・回数制限のクエリが読まない行を、gzip圧縮したJSONL（1行1ログ）に書き出してから
+line_bot_logs から削除する。対象は次のどちらかに当たる行。
+
+  - retain_before より古い行
+  - 会話履歴に含まれなくなった行（is_active=FALSE、または「スタート」のリセット時刻より前）のうち、
+    inactive_before より古い行（回数制限は履歴に含まれない応答も数えるので、ウィンドウ内の行は残す）
+
+サーバーサイドカーソルで chunk_size 行ずつ id の順に読み、1チャンクを1ファイルに書いてから
+同じトランザクションで削除するので、メモリ使用量は行数によらず一定になる。
+チャンクごとに manifest.json を書き換えるので、中断しても `--resume` で続きから再開できる
+（書き出したが manifest に載る前に中断したチャンクは、DBに行が残っていなければ取り込み、
+残っていれば書き直す）。稼働中のサービスの横で動かせるよう、行数/秒の上限とチャンク間の休止を入れ、
+ロック待ちはすぐに諦めてやり直す。
+
+パーティションテーブルの場合は、範囲がすべて retain_before より前で空になった月のパーティションを削除する。
+
+    DATABASE_URL=postgresql://localhost/linebot \\
+        python compaction.py --archive-dir /var/backups/line_bot_logs --retain-days 180 --vacuum
+"""
+
+import argparse
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+from migrations import dsn_from_env, run_migrations
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_COLUMNS = ("id", "timestamp", "sender", "lineId", "stripeId", "message", "is_active", "prompt_hash",
+                   "sys_prompt")
+
+# %(after)s より後の id から、アーカイブの対象を id の順に読む（最後の列は行のバイト数）
+CANDIDATE_SQL = """
+SELECT l.id, l.timestamp, l.sender, l.lineId, l.stripeId, l.message, l.is_active, l.prompt_hash, l.sys_prompt,
+       pg_column_size(l.*)
+  FROM line_bot_logs l
+  LEFT JOIN conversation_resets r ON r.line_id = l.lineId
+ WHERE l.id > %(after)s
+   AND (l.timestamp < %(retain_before)s
+        OR (l.timestamp < %(inactive_before)s AND (l.is_active IS FALSE OR l.timestamp < r.reset_at)))
+ ORDER BY l.id
+ LIMIT %(limit)s;
+"""
+
+PARTITIONS_SQL = """
+SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), pg_total_relation_size(c.oid)
+  FROM pg_inherits i
+  JOIN pg_class c ON c.oid = i.inhrelid
+ WHERE i.inhparent = to_regclass('line_bot_logs');
+"""
+
+_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+try:
+    from psycopg2.errors import LockNotAvailable, QueryCanceled
+    _RETRYABLE_ERRORS = (LockNotAvailable, QueryCanceled)
+except ImportError:  # psycopg2 がない環境（テストの収集など）
+    _RETRYABLE_ERRORS = ()
+
+
+class RateLimiter:
+    """1秒あたりの行数を rows_per_second 以下にする（0以下で無制限）"""
+
+    def __init__(self, rows_per_second, clock=time.monotonic, sleep=time.sleep):
+        self._rows_per_second = rows_per_second
+        self._clock = clock
+        self._sleep = sleep
+        self._started = clock()
+        self._rows = 0
+
+    def wait(self, rows):
+        self._rows += rows
+        if self._rows_per_second <= 0:
+            return 0.0
+        delay = self._started + self._rows / self._rows_per_second - self._clock()
+        if delay > 0:
+            self._sleep(delay)
+            return delay
+        return 0.0
+
+
+class ArchiveRun:
+    """アーカイブ先のディレクトリ（manifest.json とチャンクのファイル）"""
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+
+    @classmethod
+    def create(cls, archive_dir, retain_before, inactive_before):
+        started = datetime.datetime.now()
+        path = os.path.join(archive_dir, f"line_bot_logs-{started:%Y%m%dT%H%M%S}")
+        os.makedirs(path)
+        run = cls(path, {
+            "started_at": started.isoformat(),
+            "retain_before": retain_before.isoformat(),
+            "inactive_before": inactive_before.isoformat(),
+            "chunks": [],
+            "finished_at": None,
+        })
+        run.save()
+        return run
+
+    @classmethod
+    def latest_unfinished(cls, archive_dir):
+        for path in sorted(glob.glob(os.path.join(archive_dir, "line_bot_logs-*")), reverse=True):
+            with open(os.path.join(path, cls.MANIFEST)) as f:
+                manifest = json.load(f)
+            if manifest["finished_at"] is None:
+                return cls(path, manifest)
+        return None
+
+    @property
+    def retain_before(self):
+        return datetime.datetime.fromisoformat(self.manifest["retain_before"])
+
+    @property
+    def inactive_before(self):
+        return datetime.datetime.fromisoformat(self.manifest["inactive_before"])
+
+    @property
+    def last_id(self):
+        chunks = self.manifest["chunks"]
+        return chunks[-1]["last_id"] if chunks else 0
+
+    def next_chunk_path(self):
+        return os.path.join(self.path, f"chunk-{len(self.manifest['chunks']) + 1:06d}.jsonl.gz")
+
+    def add_chunk(self, path, first_id, last_id, rows, row_bytes):
+        self.manifest["chunks"].append({
+            "file": os.path.basename(path),
+            "first_id": first_id,
+            "last_id": last_id,
+            "rows": rows,
+            "row_bytes": row_bytes,
+            "archive_bytes": os.path.getsize(path),
+        })
+        self.save()
+
+    def finish(self, report):
+        self.manifest["finished_at"] = datetime.datetime.now().isoformat()
+        self.manifest["report"] = report
+        self.save()
+
+    def save(self):
+        # 書き換えの途中で中断しても壊れないよう、一時ファイルから置き換える
+        path = os.path.join(self.path, self.MANIFEST)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+
+def read_chunk(path):
+    """チャンクのファイルから (id, 行のバイト数) のリストを返す。"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f]
+    return [(row["id"], row["_bytes"]) for row in rows]
+
+
+def _archive_row(row):
+    record = dict(zip(ARCHIVE_COLUMNS, row))
+    if record["timestamp"] is not None:
+        record["timestamp"] = record["timestamp"].isoformat()
+    record["_bytes"] = row[-1]
+    return json.dumps(record, ensure_ascii=False)
+
+
+class LogCompactor:
+    def __init__(self, connection, run, chunk_size=1000, fetch_size=200, rate_limiter=None, pause=0.1,
+                 lock_timeout_ms=1000, max_retries=5, sleep=time.sleep):
+        self._connection = connection
+        self.run = run
+        self._chunk_size = chunk_size
+        self._fetch_size = fetch_size
+        self._rate_limiter = rate_limiter or RateLimiter(0)
+        self._pause = pause
+        self._lock_timeout_ms = lock_timeout_ms
+        self._max_retries = max_retries
+        self._sleep = sleep
+        self.report = {"chunks": 0, "rows": 0, "row_bytes": 0, "archive_bytes": 0, "retries": 0,
+                       "adopted_chunks": 0, "dropped_partitions": [], "partition_bytes": 0}
+
+    def compact(self, max_chunks=None):
+        """対象の行をすべて（max_chunks を指定した場合はそのチャンク数まで）アーカイブし、報告を返す。"""
+        self._adopt_orphan_chunk()
+        while max_chunks is None or self.report["chunks"] < max_chunks:
+            rows = self._archive_next_chunk()
+            if not rows:
+                break
+            self._rate_limiter.wait(rows)
+            if self._pause:
+                self._sleep(self._pause)
+        return self.report
+
+    def _adopt_orphan_chunk(self):
+        # 前回の実行が削除をコミットした後、manifest に載せる前に中断していた場合
+        path = self.run.next_chunk_path()
+        if not os.path.exists(path):
+            return
+        rows = read_chunk(path)
+        ids = [row_id for row_id, _ in rows]
+        with self._connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM line_bot_logs WHERE id = ANY(%s) LIMIT 1;", (ids,))
+            remaining = cursor.fetchone()
+        self._connection.rollback()
+        if remaining:
+            # 削除がロールバックされているので、次のチャンクとして書き直す
+            os.remove(path)
+            return
+        self.run.add_chunk(path, ids[0], ids[-1], len(rows), sum(size for _, size in rows))
+        self.report["adopted_chunks"] += 1
+        logger.info(f"Adopted archived chunk {os.path.basename(path)} ({len(rows)} rows)")
+
+    def _archive_next_chunk(self):
+        for attempt in range(self._max_retries + 1):
+            try:
+                return self._try_archive_next_chunk()
+            except _RETRYABLE_ERRORS as e:
+                self._connection.rollback()
+                if attempt == self._max_retries:
+                    raise
+                # ロック待ちでサービスのリクエストを止めないよう、すぐに諦めて間を空けてやり直す
+                self.report["retries"] += 1
+                logger.warning(f"Chunk after id {self.run.last_id} was not archived, retrying: {e}")
+                self._sleep(min(2 ** attempt, 30) * max(self._pause, 0.1))
+        return 0
+
+    def _try_archive_next_chunk(self):
+        path = self.run.next_chunk_path()
+        params = {"after": self.run.last_id, "retain_before": self.run.retain_before,
+                  "inactive_before": self.run.inactive_before, "limit": self._chunk_size}
+        ids = []
+        row_bytes = 0
+        with self._connection.cursor() as cursor:
+            cursor.execute(f"SET LOCAL lock_timeout = {int(self._lock_timeout_ms)};")
+        # 名前付きカーソルで fetch_size 行ずつ読み、そのままファイルに書き出す
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as archive:
+            with self._connection.cursor(name="line_bot_logs_compaction") as cursor:
+                cursor.itersize = self._fetch_size
+                cursor.execute(CANDIDATE_SQL, params)
+                for row in cursor:
+                    archive.write(_archive_row(row) + "\n")
+                    ids.append(row[0])
+                    row_bytes += row[-1]
+        if not ids:
+            os.remove(path + ".tmp")
+            self._connection.rollback()
+            return 0
+        _fsync(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        with self._connection.cursor() as cursor:
+            cursor.execute("DELETE FROM line_bot_logs WHERE id = ANY(%s);", (ids,))
+        self._connection.commit()
+        self.run.add_chunk(path, ids[0], ids[-1], len(ids), row_bytes)
+
+        self.report["chunks"] += 1
+        self.report["rows"] += len(ids)
+        self.report["row_bytes"] += row_bytes
+        self.report["archive_bytes"] += os.path.getsize(path)
+        logger.info(f"Archived {len(ids)} rows (ids {ids[0]}..{ids[-1]}) to {os.path.basename(path)}")
+        return len(ids)
+
+    def drop_empty_partitions(self):
+        """範囲がすべて retain_before より前で、空になったパーティションを削除する。"""
+        with self._connection.cursor() as cursor:
+            cursor.execute(PARTITIONS_SQL)
+            partitions = cursor.fetchall()
+        self._connection.commit()
+        for name, bound, size in partitions:
+            match = _UPPER_BOUND.search(bound or "")
+            if not match or datetime.datetime.fromisoformat(match.group(1)) > self.run.retain_before:
+                continue
+            try:
+                with self._connection.cursor() as cursor:
+                    cursor.execute(f"SET LOCAL lock_timeout = {int(self._lock_timeout_ms)};")
+                    cursor.execute(f"SELECT 1 FROM {name} LIMIT 1;")
+                    if cursor.fetchone():
+                        self._connection.rollback()
+                        continue
+                    cursor.execute(f"ALTER TABLE line_bot_logs DETACH PARTITION {name};")
+                    cursor.execute(f"DROP TABLE {name};")
+                self._connection.commit()
+            except _RETRYABLE_ERRORS as e:
+                self._connection.rollback()
+                logger.warning(f"Partition {name} was not dropped: {e}")
+                continue
+            self.report["dropped_partitions"].append(name)
+            self.report["partition_bytes"] += size
+            logger.info(f"Dropped empty partition {name} ({size} bytes)")
+        return self.report["dropped_partitions"]
+
+
+def _fsync(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def relation_size(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT COALESCE(SUM(pg_total_relation_size(c.oid)), 0) FROM pg_class c "
+            "WHERE c.oid = to_regclass('line_bot_logs') "
+            "OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass('line_bot_logs'));"
+        )
+        size = cursor.fetchone()[0]
+    connection.commit()
+    return int(size)
+
+
+def vacuum(connection):
+    """削除した行の領域を再利用できるようにする（VACUUM FULLと違いテーブルをロックしない）。"""
+    previous_autocommit = connection.autocommit
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM (ANALYZE) line_bot_logs;")
+    finally:
+        connection.autocommit = previous_autocommit
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Archive and delete line_bot_logs rows the bot no longer reads")
+    parser.add_argument("--archive-dir", required=True)
+    parser.add_argument("--retain-days", type=float, default=180,
+                        help="archive every row older than this (days)")
+    parser.add_argument("--inactive-after", type=float,
+                        default=int(os.environ.get("QUOTA_WINDOW_SECONDS", 24 * 60 * 60)),
+                        help="archive inactive/reset rows older than this (seconds, at least the quota window)")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--max-rows-per-second", type=float, default=2000)
+    parser.add_argument("--pause", type=float, default=0.1, help="sleep between chunks (seconds)")
+    parser.add_argument("--lock-timeout-ms", type=int, default=1000)
+    parser.add_argument("--max-chunks", type=int)
+    parser.add_argument("--resume", action="store_true", help="continue the latest unfinished run")
+    parser.add_argument("--vacuum", action="store_true", help="run VACUUM (ANALYZE) afterwards")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    import psycopg2
+
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args(argv)
+    connection = psycopg2.connect(dsn_from_env())
+    try:
+        run_migrations(connection)
+        run = ArchiveRun.latest_unfinished(args.archive_dir) if args.resume else None
+        if run is None:
+            now = datetime.datetime.now()
+            os.makedirs(args.archive_dir, exist_ok=True)
+            run = ArchiveRun.create(
+                args.archive_dir,
+                retain_before=now - datetime.timedelta(days=args.retain_days),
+                inactive_before=now - datetime.timedelta(seconds=args.inactive_after),
+            )
+        else:
+            logger.info(f"Resuming {run.path} after id {run.last_id}")
+        size_before = relation_size(connection)
+        compactor = LogCompactor(
+            connection, run,
+            chunk_size=args.chunk_size,
+            rate_limiter=RateLimiter(args.max_rows_per_second),
+            pause=args.pause,
+            lock_timeout_ms=args.lock_timeout_ms,
+        )
+        report = compactor.compact(max_chunks=args.max_chunks)
+        compactor.drop_empty_partitions()
+        if args.vacuum:
+            vacuum(connection)
+        report["relation_bytes_before"] = size_before
+        report["relation_bytes_after"] = relation_size(connection)
+        # row_bytes: 削除した行の大きさ（VACUUM後に再利用できる）、relation_bytes_*: ディスク上の大きさ
+        report["bytes_reclaimed"] = report["row_bytes"] + report["partition_bytes"]
+        if args.max_chunks is None or report["chunks"] < args.max_chunks:
+            run.finish(report)
+        print(json.dumps(report, ensure_ascii=False, indent=1))
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
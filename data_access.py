@@ -0,0 +1,284 @@
+"""
+1メッセージあたりのDBアクセス
+
+メッセージの処理に必要な読み込み（直近の会話履歴・ウィンドウ内のシステム応答時刻・
+サブスクリプション状態）を1つのSQL文にまとめ、キャッシュにないものだけを1往復で取得する。
+書き込みはユーザーの発言とシステムの応答を同じバッチ（同じトランザクション）にまとめる。
+"""
+
+import datetime
+import logging
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTION_KEYS = ("line_user_id", "subscription_id", "stripe_customer_id", "price_id", "status")
+
+# 「スタート」によるリセットの時刻。これより前の行は会話履歴に含めない
+# （行を一括でUPDATEする代わりに、ユーザーごとに1行を書き換える）
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS conversation_resets (
+    line_id VARCHAR(50) PRIMARY KEY,
+    reset_at TIMESTAMP NOT NULL
+);
+"""
+
+RESET_SQL = """
+INSERT INTO conversation_resets (line_id, reset_at) VALUES (%(line_id)s, %(reset_at)s)
+ON CONFLICT (line_id) DO UPDATE SET reset_at = GREATEST(conversation_resets.reset_at, EXCLUDED.reset_at);
+"""
+
+# 3種類の行を1文で返す（1列目で区別する）。json_aggで1行にまとめるより計画・実行とも軽い。
+# 不要な部分は %(load_*)s がFALSEになり、実行時に評価されない
+CONTEXT_SQL = """
+(SELECT 1 AS part, id, timestamp, sender, message, NULL, NULL FROM line_bot_logs
+ WHERE %(load_history)s AND lineId = %(line_id)s AND is_active = TRUE
+   AND timestamp >= COALESCE((SELECT reset_at FROM conversation_resets WHERE line_id = %(line_id)s), '-infinity')
+ ORDER BY timestamp DESC, id DESC
+ LIMIT %(history_limit)s)
+UNION ALL
+(SELECT 2, NULL, timestamp, NULL, NULL, NULL, NULL FROM line_bot_logs
+ WHERE %(load_reply_times)s AND sender = 'system' AND lineId = %(line_id)s AND timestamp > %(since)s)
+UNION ALL
+(SELECT 3, NULL, NULL, subscription_id, stripe_customer_id, price_id, status FROM stripe_subscriptions
+ WHERE %(load_subscription)s AND line_user_id = %(line_id)s);
+"""
+
+_HISTORY, _REPLY, _SUBSCRIPTION = 1, 2, 3
+
+
+@dataclass
+class MessageContext:
+    """load_context の結果。読み込まなかった項目はNone"""
+    history: Optional[list] = None
+    reply_times: Optional[list] = None
+    # 読み込んだがサブスクリプションがない場合もNoneなので、subscription_loadedで区別する
+    subscription: Optional[dict] = None
+    subscription_loaded: bool = False
+
+
+def to_turn(sender, message):
+    return {"role": "user" if sender == "user" else "assistant", "content": message}
+
+
+def context_params(line_id, history_limit, since, history, reply_times, subscription):
+    return {
+        "line_id": line_id,
+        "history_limit": history_limit,
+        "since": datetime.datetime.fromtimestamp(since or 0),
+        "load_history": history,
+        "load_reply_times": reply_times and since is not None,
+        "load_subscription": subscription,
+    }
+
+
+def context_from_rows(rows, line_id, history, reply_times, subscription):
+    """CONTEXT_SQL の結果（psycopg2のタプル・asyncpgのRecordどちらでも）を MessageContext にする。"""
+    context = MessageContext()
+    if history:
+        # 最新の会話が最後に来るように並べる
+        turns = sorted((row[2], row[1], row[3], row[4]) for row in rows if row[0] == _HISTORY)
+        context.history = [to_turn(sender, message) for _, _, sender, message in turns]
+    if reply_times:
+        context.reply_times = sorted(row[2].timestamp() for row in rows if row[0] == _REPLY)
+    if subscription:
+        row = next((row for row in rows if row[0] == _SUBSCRIPTION), None)
+        context.subscription = dict(zip(SUBSCRIPTION_KEYS, (line_id,) + tuple(row[3:]))) if row else None
+        context.subscription_loaded = True
+    return context
+
+
+def exchange_rows(line_id, stripe_id, user_turns, reply_timestamp, reply, sys_prompt, is_active=True):
+    """1回の応答で書き込むログの行（ユーザーの発言を時刻順に並べ、最後にシステムの応答）
+
+    reply がNoneの場合（エラーで応答を生成できなかった場合など）はユーザーの発言だけにする。
+    """
+    rows = [(timestamp, "user", line_id, stripe_id, message, is_active, sys_prompt)
+            for timestamp, message in user_turns]
+    if reply is not None:
+        rows.append((reply_timestamp, "system", line_id, stripe_id, reply, is_active, sys_prompt))
+    return rows
+
+
+def numbered_query(sql):
+    """%(name)s 形式のSQLを asyncpg の $1, $2 ... 形式にし、(SQL, 引数名の順) を返す。"""
+    names = []
+
+    def replace(match):
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+        return f"${names.index(name) + 1}"
+
+    return re.sub(r"%\((\w+)\)s", replace, sql).replace("%%", "%"), tuple(names)
+
+
+class ConversationStore:
+    """line_bot_logs と stripe_subscriptions への読み書き
+
+    書き込みは log_writer に任せ、読み込みの前にそのユーザーの未書き込みの行があれば書き込む。
+    """
+
+    def __init__(self, get_connection, put_connection, log_writer, history_limit=10):
+        self._get_connection = get_connection
+        self._put_connection = put_connection
+        self._log_writer = log_writer
+        self._history_limit = history_limit
+        self._lock = threading.Lock()
+        self._counters = {"context_loads": 0, "round_trips": 0, "exchanges": 0}
+
+    def load_context(self, line_id, since=None, history=True, reply_times=True, subscription=True):
+        """必要な項目を1往復で読み込む。since は応答時刻を数え始めるepoch秒。"""
+        if (history or reply_times) and self._log_writer.has_pending(line_id):
+            self._log_writer.flush()
+        params = context_params(line_id, self._history_limit, since, history, reply_times, subscription)
+        with stage("db.load_context"):
+            connection = self._get_connection()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(CONTEXT_SQL, params)
+                    rows = cursor.fetchall()
+                connection.rollback()
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                self._put_connection(connection)
+        self._count("context_loads")
+        self._count("round_trips")
+        return context_from_rows(rows, line_id, history, reply_times and since is not None, subscription)
+
+    def fetch_history(self, line_id):
+        return self.load_context(line_id, history=True, reply_times=False, subscription=False).history
+
+    def fetch_reply_times(self, line_id, since):
+        return self.load_context(line_id, since=since, history=False, reply_times=True, subscription=False).reply_times
+
+    def fetch_all_reply_times(self, since):
+        """ウィンドウ内の全ユーザーのシステム応答時刻を {lineId: [epoch秒]} で返す。"""
+        connection = self._get_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT lineId, timestamp FROM line_bot_logs WHERE sender='system' AND timestamp > %s;",
+                    (datetime.datetime.fromtimestamp(since),),
+                )
+                timestamps_by_user = {}
+                for line_id, timestamp in cursor.fetchall():
+                    timestamps_by_user.setdefault(line_id, []).append(timestamp.timestamp())
+            connection.rollback()
+        finally:
+            self._put_connection(connection)
+        self._count("round_trips")
+        return timestamps_by_user
+
+    def record_exchange(self, line_id, stripe_id, user_timestamp, user_message, reply_timestamp, reply,
+                        sys_prompt=""):
+        """ユーザーの発言とシステムの応答を同じトランザクションで書き込むよう積む。"""
+        self.record_turns(line_id, stripe_id, [(user_timestamp, user_message)], reply_timestamp, reply, sys_prompt)
+
+    def record_turns(self, line_id, stripe_id, user_turns, reply_timestamp=None, reply=None, sys_prompt="",
+                     is_active=True):
+        """まとめて応答したユーザーの発言（(時刻, 本文) のリスト）とシステムの応答を同じトランザクションで書き込むよう積む。
+
+        reply がNoneの場合はユーザーの発言だけを書き込む。is_active=False の行は会話履歴に含めない。
+        """
+        self._log_writer.write_many(
+            exchange_rows(line_id, stripe_id, user_turns, reply_timestamp, reply, sys_prompt, is_active)
+        )
+        self._count("exchanges")
+
+    def deactivate(self, line_id, reset_at=None):
+        """会話をリセットする（時刻が reset_at より前の行を会話履歴に含めないようにする）。
+
+        行は書き換えずにユーザーごとのリセット時刻だけを更新するので、履歴の長さによらず1行の書き込みで済む。
+        ログライターのバッファに残っている行もそれより前の時刻なので、書き込みを待たずに対象になる。
+        """
+        with stage("db.deactivate"):
+            connection = self._get_connection()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(RESET_SQL, {"line_id": line_id, "reset_at": reset_at or datetime.datetime.now()})
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                self._put_connection(connection)
+        self._count("round_trips")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _count(self, key):
+        with self._lock:
+            self._counters[key] += 1
+
+
+class ContextPrefetcher:
+    """キャッシュにない項目だけを ConversationStore.load_context で1往復で読み込み、各キャッシュに入れる
+
+    すべてキャッシュ済みならDBにはアクセスしない。
+    読み込みに失敗した場合は何もせず、各キャッシュの通常の読み込みに任せる。
+    """
+
+    def __init__(self, store, history_cache, quota_limiter, subscription_index, clock=time.time):
+        self._store = store
+        self._history_cache = history_cache
+        self._quota_limiter = quota_limiter
+        self._subscription_index = subscription_index
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._counters = {"prefetches": 0, "skipped": 0, "errors": 0}
+
+    def prefetch(self, line_id):
+        request = self._plan(line_id)
+        if request is None:
+            return None
+        try:
+            context = self._store.load_context(line_id, **request)
+            self._apply(line_id, context)
+        except Exception as e:
+            logger.error(f"Failed to prefetch message context for {line_id}: {e}")
+            self._count("errors")
+            return None
+        self._count("prefetches")
+        return context
+
+    def _plan(self, line_id):
+        """load_context に渡す引数を返す。すべてキャッシュ済みならNone。"""
+        need_history = not self._history_cache.contains(line_id)
+        need_reply_times = not self._quota_limiter.is_loaded(line_id)
+        need_subscription = not self._subscription_index.is_cached(line_id)
+        if not (need_history or need_reply_times or need_subscription):
+            self._count("skipped")
+            return None
+        return {
+            "since": self._clock() - self._quota_limiter.window,
+            "history": need_history,
+            "reply_times": need_reply_times,
+            "subscription": need_subscription,
+        }
+
+    def _apply(self, line_id, context):
+        if context.history is not None:
+            self._history_cache.prime(line_id, context.history)
+        if context.reply_times is not None:
+            self._quota_limiter.prime(line_id, context.reply_times)
+        if context.subscription_loaded:
+            self._subscription_index.prime(line_id, context.subscription)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _count(self, key):
+        with self._lock:
+            self._counters[key] += 1
@@ -0,0 +1,144 @@
+"""
+LINE Webhookイベントの非同期ディスパッチャ
+
+/callback は署名を検証してイベントを有界キューに積むだけで即座に200を返し、
+ワーカープールがイベントを処理する。
+webhookEventIdで重複を排除し、LINEの再送イベントを二重に処理しない。
+"""
+
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# ワーカー停止用の番兵
+_STOP = object()
+
+
+class EventDispatcher:
+    """有界キュー + ワーカープールでイベントを処理する"""
+
+    def __init__(self, handle_event, workers=4, queue_size=100, dedup_ttl=600, enqueue_timeout=0.5):
+        self._handle_event = handle_event
+        self._worker_count = workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._dedup_ttl = dedup_ttl
+        self._enqueue_timeout = enqueue_timeout
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._accepting = False
+        self._in_flight = 0
+        self._counters = {
+            "submitted": 0,
+            "duplicates": 0,
+            "rejected": 0,
+            "processed": 0,
+            "failed": 0,
+        }
+        self._max_queue_wait = 0.0
+        self._total_queue_wait = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._accepting:
+                return
+            self._accepting = True
+        for i in range(self._worker_count):
+            worker = threading.Thread(target=self._run, name=f"line-event-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        logger.info(f"Event dispatcher started with {self._worker_count} workers")
+
+    def submit(self, event_id, event):
+        """イベントをキューに積む。
+
+        重複イベントの場合はFalseを返す。キューが満杯の場合はqueue.Fullを送出する
+        （呼び出し側は5xxを返してLINEに再送させる）。
+        """
+        if not self._accepting:
+            raise queue.Full("Dispatcher is not accepting events")
+        if event_id is not None and not self._mark_seen(event_id):
+            with self._lock:
+                self._counters["duplicates"] += 1
+            return False
+        try:
+            self._queue.put((time.monotonic(), event), timeout=self._enqueue_timeout)
+        except queue.Full:
+            with self._lock:
+                self._counters["rejected"] += 1
+                # 再送時に処理できるよう重複記録を取り消す
+                if event_id is not None:
+                    self._seen.pop(event_id, None)
+            logger.warning("Event queue is full, rejecting webhook event")
+            raise
+        with self._lock:
+            self._counters["submitted"] += 1
+        return True
+
+    def shutdown(self, timeout=30):
+        """受付を止め、キューに残ったイベントを処理し終えてからワーカーを止める。"""
+        with self._lock:
+            if not self._accepting:
+                return
+            self._accepting = False
+        for _ in self._workers:
+            self._queue.put((time.monotonic(), _STOP))
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+        remaining = self._queue.qsize()
+        if remaining:
+            logger.warning(f"Event dispatcher stopped with {remaining} unprocessed events")
+        self._workers = []
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["in_flight"] = self._in_flight
+            stats["max_queue_wait_seconds"] = self._max_queue_wait
+            stats["total_queue_wait_seconds"] = self._total_queue_wait
+        stats["queue_depth"] = self._queue.qsize()
+        stats["queue_capacity"] = self._queue.maxsize
+        stats["workers"] = self._worker_count
+        return stats
+
+    def _mark_seen(self, event_id):
+        now = time.monotonic()
+        with self._lock:
+            while self._seen:
+                oldest_id, expires = next(iter(self._seen.items()))
+                if expires > now:
+                    break
+                del self._seen[oldest_id]
+            if event_id in self._seen:
+                return False
+            self._seen[event_id] = now + self._dedup_ttl
+            return True
+
+    def _run(self):
+        while True:
+            enqueued_at, event = self._queue.get()
+            if event is _STOP:
+                self._queue.task_done()
+                return
+            waited = time.monotonic() - enqueued_at
+            with self._lock:
+                self._in_flight += 1
+                self._total_queue_wait += waited
+                self._max_queue_wait = max(self._max_queue_wait, waited)
+            try:
+                self._handle_event(event)
+                outcome = "processed"
+            except Exception as e:
+                logger.error(f"Unhandled error while processing webhook event: {e}")
+                outcome = "failed"
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                self._queue.task_done()
+            with self._lock:
+                self._counters[outcome] += 1
@@ -0,0 +1,90 @@
+"""
+リモートのI/Oを行わずに返信が決まるメッセージの振り分け
+
+定型文で返すメッセージ（ユーザーIDがない・入力検証に失敗した）と、回数制限を超えていることが
+分かっているユーザーのメッセージは、履歴の読み込み・サブスクリプションの確認・OpenAIの呼び出し・
+ログの書き込みをせずにその場で返信する。
+
+回数制限を超えたユーザーは、制限の判定で拒否されたときに OverQuotaCache に入れ、
+利用できるようになる時刻（QuotaDecision.retry_after）まで覚えておく。ただし有料プランへの変更は
+別のワーカーで受け取ることもあるので、覚えておくのは最長 ttl 秒にする。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from message_flow import QUOTA_EXCEEDED_REPLY
+
+
+class OverQuotaCache:
+    """回数制限を超えているユーザーと、制限が解ける時刻（最大 max_users 人、古いものから忘れる）"""
+
+    def __init__(self, max_users=10000, ttl=300, clock=time.time):
+        self._max_users = max_users
+        self._ttl = ttl
+        self._clock = clock
+        self._expires = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0, "discarded": 0}
+
+    def add(self, user_id, retry_after):
+        """retry_after 秒後（最長 ttl 秒後）まで user_id を制限中として扱う。"""
+        if not user_id or self._ttl <= 0 or retry_after <= 0:
+            return
+        expires = self._clock() + min(retry_after, self._ttl)
+        with self._lock:
+            self._expires.pop(user_id, None)
+            self._expires[user_id] = expires
+            while len(self._expires) > self._max_users:
+                self._expires.popitem(last=False)
+                self._counters["evicted"] += 1
+
+    def blocked(self, user_id):
+        with self._lock:
+            expires = self._expires.get(user_id)
+            if expires is None:
+                self._counters["misses"] += 1
+                return False
+            if expires <= self._clock():
+                del self._expires[user_id]
+                self._counters["expired"] += 1
+                self._counters["misses"] += 1
+                return False
+            self._counters["hits"] += 1
+            return True
+
+    def discard(self, user_id):
+        """サブスクリプションが変わったときなどに、制限中の扱いをやめる。"""
+        with self._lock:
+            if self._expires.pop(user_id, None) is not None:
+                self._counters["discarded"] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, users=len(self._expires))
+
+
+class FastPath:
+    """判定（message_flow.decide の結果）から、I/Oなしで返せる返信を決める"""
+
+    def __init__(self, over_quota):
+        self.over_quota = over_quota
+        self._counters = {"canned": 0, "over_quota": 0, "slow": 0}
+        self._lock = threading.Lock()
+
+    def route(self, user_id, decision):
+        """I/Oなしで返信が決まる場合はその本文を、決まらない場合（リセット・応答の生成）はNoneを返す。"""
+        if decision.action == "reply":
+            kind, text = "canned", decision.text
+        elif decision.action == "converse" and self.over_quota.blocked(user_id):
+            kind, text = "over_quota", QUOTA_EXCEEDED_REPLY
+        else:
+            kind, text = "slow", None
+        with self._lock:
+            self._counters[kind] += 1
+        return text
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
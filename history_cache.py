@@ -0,0 +1,219 @@
+"""
+ユーザーごとの会話履歴キャッシュ
+
+lineIdごとに直近の有効な会話（role/content）を保持する。
+log_to_databaseからの書き込みと同時に更新し（write-through）、
+「スタート」で空にするので、多くのリクエストはDBを読まずにプロンプトを組み立てられる。
+バックエンドは差し替え可能で、複数のgunicornワーカーで共有する場合はRedis互換のサーバーを使う。
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryHistoryBackend:
+    """プロセス内のLRU + TTLバックエンド"""
+
+    def __init__(self, max_users=1000, ttl=1800):
+        self._max_users = max_users
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires, turns = entry
+            if expires <= time.monotonic():
+                del self._entries[user_id]
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(user_id)
+            return list(turns)
+
+    def set(self, user_id, turns, limit):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self._ttl, list(turns[-limit:]))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self._max_users:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def append(self, user_id, turn, limit):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return False
+            turns = entry[1]
+            turns.append(turn)
+            del turns[:-limit]
+            self._entries[user_id] = (time.monotonic() + self._ttl, turns)
+            self._entries.move_to_end(user_id)
+            return True
+
+    def delete(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class RedisHistoryBackend:
+    """Redis互換サーバーのリストに履歴を保持するバックエンド
+
+    履歴が空であることを表すため、空のリストの代わりに空文字の要素を1つ置く。
+    """
+
+    _EMPTY = ""
+
+    def __init__(self, client, ttl=1800, prefix="line-bot:history:"):
+        self._client = client
+        self._ttl = ttl
+        self._prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+
+        return cls(redis.Redis.from_url(url, decode_responses=True), **kwargs)
+
+    def _key(self, user_id):
+        return f"{self._prefix}{user_id}"
+
+    def get(self, user_id):
+        items = self._client.lrange(self._key(user_id), 0, -1)
+        if not items:
+            return None
+        return [json.loads(item) for item in items if item != self._EMPTY]
+
+    def set(self, user_id, turns, limit):
+        key = self._key(user_id)
+        values = [json.dumps(turn, ensure_ascii=False) for turn in turns[-limit:]] or [self._EMPTY]
+        pipe = self._client.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.rpush(key, *values)
+        pipe.expire(key, self._ttl)
+        pipe.execute()
+
+    def append(self, user_id, turn, limit):
+        key = self._key(user_id)
+        appended = []
+
+        def update(pipe):
+            # キャッシュされていないユーザーには追記しない（次回DBから読み込む）
+            if not pipe.exists(key):
+                return
+            pipe.multi()
+            pipe.rpush(key, json.dumps(turn, ensure_ascii=False))
+            pipe.lrem(key, 0, self._EMPTY)
+            pipe.ltrim(key, -limit, -1)
+            pipe.expire(key, self._ttl)
+            appended.append(True)
+
+        self._client.transaction(update, key)
+        return bool(appended)
+
+    def delete(self, user_id):
+        self._client.delete(self._key(user_id))
+
+    def size(self):
+        return None
+
+
+class HistoryCache:
+    """直近 limit 件の会話履歴をキャッシュし、ヒット/ミスを数える"""
+
+    def __init__(self, backend, limit=10):
+        self._backend = backend
+        self._limit = limit
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "appends": 0, "resets": 0, "primed": 0, "errors": 0}
+
+    def get(self, user_id, loader):
+        """キャッシュから履歴を返す。なければ loader(user_id) で読み込んでキャッシュする。
+
+        loaderが例外を送出した場合はキャッシュせずにそのまま送出する。
+        """
+        try:
+            turns = self._backend.get(user_id)
+        except Exception as e:
+            logger.error(f"History cache read failed: {e}")
+            self._count("errors")
+            turns = None
+        if turns is not None:
+            self._count("hits")
+            return turns
+
+        self._count("misses")
+        turns = loader(user_id)
+        try:
+            self._backend.set(user_id, turns, self._limit)
+        except Exception as e:
+            logger.error(f"History cache write failed: {e}")
+            self._count("errors")
+        return list(turns)
+
+    def contains(self, user_id):
+        try:
+            return self._backend.get(user_id) is not None
+        except Exception as e:
+            logger.error(f"History cache read failed: {e}")
+            self._count("errors")
+            return False
+
+    def prime(self, user_id, turns):
+        """他のデータとまとめてDBから読み込んだ履歴をキャッシュに入れる。"""
+        try:
+            self._backend.set(user_id, turns, self._limit)
+            self._count("primed")
+        except Exception as e:
+            logger.error(f"History cache write failed: {e}")
+            self._count("errors")
+
+    def append(self, user_id, role, content):
+        try:
+            if self._backend.append(user_id, {"role": role, "content": content}, self._limit):
+                self._count("appends")
+        except Exception as e:
+            # 追記に失敗した履歴は古くなるので破棄して次回DBから読み直す
+            logger.error(f"History cache append failed: {e}")
+            self._count("errors")
+            self.invalidate(user_id)
+
+    def reset(self, user_id):
+        """会話をリセットしたユーザーの履歴を「空」としてキャッシュする。"""
+        try:
+            self._backend.set(user_id, [], self._limit)
+            self._count("resets")
+        except Exception as e:
+            logger.error(f"History cache reset failed: {e}")
+            self._count("errors")
+            self.invalidate(user_id)
+
+    def invalidate(self, user_id):
+        try:
+            self._backend.delete(user_id)
+        except Exception as e:
+            logger.error(f"History cache invalidate failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        stats["size"] = self._backend.size()
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
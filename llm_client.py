@@ -0,0 +1,280 @@
+"""
+OpenAI APIなど外部HTTP APIの呼び出し
+
+接続を使い回すSession（コネクションプール）、接続/読み込みのタイムアウト、
+429/5xxに対するRetry-Afterを考慮したジッター付きのリトライ、
+上流が落ちている間は呼び出さずにすぐ失敗させるサーキットブレーカーをまとめる。
+LINEの返信にも同じプールを使えるよう、line-bot-sdk用のHttpClientも用意する。
+"""
+
+import email.utils
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+
+from metrics import REGISTRY, stage
+
+logger = logging.getLogger(__name__)
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+
+# リトライの対象とするステータスコード
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+LLM_TOKENS = REGISTRY.counter("line_bot_llm_tokens", "Tokens reported by the completion API", ("model", "kind"))
+
+
+class CircuitOpenError(requests.RequestException):
+    """サーキットブレーカーが開いているため呼び出さなかった"""
+
+
+def create_session(pool_size=10):
+    """keep-aliveで接続を使い回すSessionを作る（リトライは呼び出し側で行う）。"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def parse_retry_after(value, now=None):
+    """Retry-Afterヘッダー（秒数またはHTTP日付）を秒数にする。解釈できない場合はNone。"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - (time.time() if now is None else now))
+
+
+class CircuitBreaker:
+    """連続した失敗が failure_threshold に達すると reset_timeout 秒間呼び出しを止める
+
+    reset_timeout 経過後は1件だけ試しに通し（half-open）、成功すれば閉じ、失敗すれば再び開く。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.opened = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self._reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if self._clock() - self._opened_at < self._reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def release(self):
+        """結果を記録せずに試行を終える（呼び出しが取り消された場合）。"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self._failure_threshold:
+                if self._state != self.OPEN:
+                    self.opened += 1
+                    logger.warning(f"Circuit opened after {self._failures} consecutive failures")
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+
+
+class BaseLLMClient:
+    """同期版（LLMClient）とasyncio版（async_clients.AsyncLLMClient）で共通の設定・リトライ判定・集計
+
+    1回の呼び出しは最大 max_retries 回までリトライし、待ち時間は
+    min(max_backoff, backoff * 2**attempt) の範囲のジッター（Retry-Afterがあればそれ以上）。
+    リトライしても deadline 秒を超える場合はその時点で失敗とする。
+    """
+
+    def __init__(self, api_key, base_url=OPENAI_API_BASE, connect_timeout=3.05, read_timeout=20.0,
+                 max_retries=2, backoff=0.5, max_backoff=8.0, deadline=45.0, breaker=None, clock=time.monotonic):
+        self._url = base_url.rstrip("/") + "/chat/completions"
+        self._headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._deadline = deadline
+        self.breaker = breaker or CircuitBreaker()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._counters = {"requests": 0, "retries": 0, "failures": 0, "short_circuited": 0,
+                          "prompt_tokens": 0, "completion_tokens": 0}
+
+    def record_usage(self, model, usage):
+        """応答の usage（ストリーミングでは最後のチャンク）のトークン数を数える。"""
+        if not usage:
+            return
+        for kind in ("prompt_tokens", "completion_tokens"):
+            tokens = usage.get(kind) or 0
+            LLM_TOKENS.inc(tokens, model=model, kind=kind)
+            with self._lock:
+                self._counters[kind] += tokens
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["circuit_open"] = self.breaker.state != CircuitBreaker.CLOSED
+        stats["circuit_state"] = self.breaker.state
+        stats["circuit_opened"] = self.breaker.opened
+        return stats
+
+    def _begin(self):
+        """呼び出しを始める。サーキットが開いている場合は CircuitOpenError を送出する。"""
+        if not self.breaker.allow():
+            self._count("short_circuited")
+            raise CircuitOpenError("LLM API circuit is open")
+        self._count("requests")
+        return self._clock()
+
+    def _next_wait(self, attempt, started, retry_after, error):
+        """次のリトライまでの待ち時間を返す。諦める場合は失敗として数え、errorを送出する。"""
+        wait = random.uniform(0, min(self._max_backoff, self._backoff * 2 ** attempt))
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        if attempt >= self._max_retries or self._clock() - started + wait > self._deadline:
+            self.breaker.record_failure()
+            self._count("failures")
+            raise error
+        logger.warning(f"LLM API request failed ({error}), retrying in {wait:.2f}s")
+        self._count("retries")
+        return wait
+
+    def _count(self, key):
+        with self._lock:
+            self._counters[key] += 1
+
+
+class LLMClient(BaseLLMClient):
+    """Chat Completions APIのクライアント（requests.Sessionで接続を使い回す）"""
+
+    def __init__(self, api_key, base_url=OPENAI_API_BASE, session=None, pool_size=10, sleep=time.sleep, **kwargs):
+        super().__init__(api_key, base_url, **kwargs)
+        self.session = session or create_session(pool_size)
+        self._timeout = (self._connect_timeout, self._read_timeout)
+        self._sleep = sleep
+
+    def chat(self, messages, model="gpt-4o", **params):
+        """応答本文を返す。失敗した場合は requests.RequestException を送出する。"""
+        with stage(f"llm.{model}"):
+            with self._post({"model": model, "messages": messages, **params}) as response:
+                body = response.json()
+        self.record_usage(model, body.get("usage"))
+        return body["choices"][0]["message"]["content"].strip()
+
+    def stream(self, messages, model="gpt-4o", **params):
+        """ストリーミングのレスポンスを返す（with文で閉じること）。
+
+        リトライは応答のステータスを受け取るまでで、本文の受信中の失敗はリトライしない。
+        """
+        return self._post({"model": model, "messages": messages, "stream": True, **params}, stream=True)
+
+    def close(self):
+        self.session.close()
+
+    def _post(self, payload, stream=False):
+        started = self._begin()
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                response = self.session.post(self._url, headers=self._headers, json=payload,
+                                             timeout=self._timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            except Exception:
+                # リトライしない想定外の失敗（本文の途中切断・リダイレクトの繰り返しなど）も失敗として記録する
+                # （記録しないと half-open の試行が終わらず、サーキットが閉じなくなる）
+                self.breaker.record_failure()
+                self._count("failures")
+                raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    try:
+                        response.raise_for_status()
+                    except requests.HTTPError:
+                        # 4xx（429以外）はリクエストの問題なので上流の障害として数えない
+                        response.close()
+                        self.breaker.record_success()
+                        raise
+                    self.breaker.record_success()
+                    return response
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                error = requests.HTTPError(f"{response.status_code} from LLM API", response=response)
+                response.close()
+
+            self._sleep(self._next_wait(attempt, started, retry_after, error))
+            attempt += 1
+
+
+class SessionHttpClient(RequestsHttpClient):
+    """共有のSessionで接続を使い回すline-bot-sdk用のHttpClient
+
+    LineBotApiはクラスを受け取ってインスタンス化するので、functools.partialで
+    sessionを束縛して渡す。
+    """
+
+    def __init__(self, session, timeout=RequestsHttpClient.DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.session = session
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(url, headers=headers, params=params, stream=stream,
+                                    timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(url, headers=headers, data=data,
+                                     timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(url, headers=headers, data=data,
+                                       timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
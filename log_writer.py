@@ -0,0 +1,194 @@
+"""
+line_bot_logs へのバッチ書き込み
+
+行をメモリ上のバッファに貯め、件数または時間のしきい値でまとめてINSERTする。
+システムプロンプトは prompts テーブルに1度だけ保存し、ログ行からはハッシュで参照する。
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from collections import deque
+
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# テーブルとカラムは migrations.py で作る（ライターからはDDLを実行しない）
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS prompts (
+    hash CHAR(64) PRIMARY KEY,
+    content TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+ALTER TABLE line_bot_logs ADD COLUMN IF NOT EXISTS prompt_hash CHAR(64);
+"""
+
+
+def prompt_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class LogWriter:
+    """バッファ付きのログライター
+
+    synchronous=True の場合は write のたびにその場で書き込む（テスト用）。
+    バッファが max_buffer を超えた場合は、呼び出し元のスレッドで書き込まずに古い行から捨てて dropped に数える
+    （DBが落ちている間もWebhookの処理を待たせない）。
+    """
+
+    def __init__(self, get_connection, put_connection, batch_size=100, flush_interval=1.0,
+                 max_buffer=10000, synchronous=False):
+        self._get_connection = get_connection
+        self._put_connection = put_connection
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_buffer = max_buffer
+        self._synchronous = synchronous
+        self._buffer = deque()
+        self._writing = ()
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._known_prompts = {}
+        self._stored_prompts = set()
+        self._thread = None
+        self._running = False
+        self._counters = {"written": 0, "batches": 0, "failed_flushes": 0, "dropped": 0}
+
+    def start(self):
+        if self._synchronous or self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def close(self, timeout=10):
+        """バックグラウンドスレッドを止め、残りの行を書き込む。"""
+        if self._thread is not None:
+            with self._condition:
+                self._running = False
+                self._condition.notify_all()
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def write(self, timestamp, sender, line_id, stripe_id, message, is_active=True, sys_prompt=""):
+        self.write_many([(timestamp, sender, line_id, stripe_id, message, is_active, sys_prompt)])
+
+    def write_many(self, rows):
+        """複数行を同じバッチ（同じトランザクション）で書き込まれるようにまとめて積む。
+
+        rows の各要素は write の引数と同じ順のタプル。
+        """
+        # 末尾の要素は「次の行と同じバッチに入れる」印
+        rows = [self._row(*row) + (i < len(rows) - 1,) for i, row in enumerate(rows)]
+        with self._condition:
+            self._buffer.extend(rows)
+            overflow = len(self._buffer) - self._max_buffer
+            if overflow > 0:
+                for _ in range(overflow):
+                    self._buffer.popleft()
+                self._counters["dropped"] += overflow
+                logger.warning(f"Log buffer is full, dropped {overflow} rows")
+            if len(self._buffer) >= self._batch_size:
+                self._condition.notify()
+        if self._synchronous:
+            self.flush()
+
+    def has_pending(self, line_id):
+        """まだ書き込まれていない（書き込み中を含む）行がそのユーザーにあるか。"""
+        with self._condition:
+            return any(row[2] == line_id for row in self._buffer) or any(row[2] == line_id for row in self._writing)
+
+    def flush(self):
+        """バッファにある行をすべて書き込む。失敗した場合はFalseを返す。"""
+        with self._flush_lock:
+            while True:
+                with self._condition:
+                    if not self._buffer:
+                        return True
+                    batch = [self._buffer.popleft() for _ in range(min(self._batch_size, len(self._buffer)))]
+                    while batch[-1][8] and self._buffer:
+                        batch.append(self._buffer.popleft())
+                    self._writing = batch
+                try:
+                    with stage("db.write_batch"):
+                        self._write_batch(batch)
+                except Exception as e:
+                    logger.error(f"Database error in log writer flush: {e}")
+                    self._requeue(batch)
+                    return False
+                finally:
+                    with self._condition:
+                        self._writing = ()
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._counters)
+            stats["buffered"] = len(self._buffer)
+        return stats
+
+    def _row(self, timestamp, sender, line_id, stripe_id, message, is_active=True, sys_prompt=""):
+        digest = None
+        if sys_prompt:
+            digest = self._known_prompts.get(sys_prompt)
+            if digest is None:
+                digest = prompt_hash(sys_prompt)
+                self._known_prompts[sys_prompt] = digest
+        return (timestamp, sender, line_id, stripe_id, message, is_active, digest, sys_prompt or None)
+
+    def _requeue(self, batch):
+        with self._condition:
+            self._counters["failed_flushes"] += 1
+            room = self._max_buffer - len(self._buffer)
+            if room < len(batch):
+                self._counters["dropped"] += len(batch) - max(room, 0)
+                batch = batch[len(batch) - max(room, 0):]
+            self._buffer.extendleft(reversed(batch))
+
+    def _write_batch(self, batch):
+        from psycopg2.extras import execute_values
+
+        connection = self._get_connection()
+        try:
+            with connection.cursor() as cursor:
+                prompts = {row[6]: row[7] for row in batch if row[6] and row[6] not in self._stored_prompts}
+                if prompts:
+                    execute_values(
+                        cursor,
+                        "INSERT INTO prompts (hash, content) VALUES %s ON CONFLICT (hash) DO NOTHING;",
+                        list(prompts.items()),
+                    )
+                execute_values(
+                    cursor,
+                    """
+                    INSERT INTO line_bot_logs (timestamp, sender, lineId, stripeId, message, is_active, prompt_hash)
+                    VALUES %s;
+                    """,
+                    [row[:7] for row in batch],
+                    page_size=len(batch),
+                )
+            connection.commit()
+            self._stored_prompts.update(prompts)
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            self._put_connection(connection)
+        with self._condition:
+            self._counters["written"] += len(batch)
+            self._counters["batches"] += 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._running and len(self._buffer) < self._batch_size:
+                    self._condition.wait(self._flush_interval)
+                running = self._running
+            ok = self.flush()
+            if not running:
+                return
+            # 書き込みに失敗している間はDBを叩き続けない
+            if not ok:
+                time.sleep(self._flush_interval)
@@ -12,54 +12,170 @@ from linebot.models import (
 import requests
 import logging
 logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__) # stripeの情報の確認
-import stripe
-import psycopg2
-from psycopg2 import pool
+logger = logging.getLogger(__name__)
 import datetime
-import re
+import time
+import json
+import queue
+import atexit
+import threading
+from functools import partial
+from dispatcher import EventDispatcher
+from streaming import deliver_stream, iter_sse_deltas
+from history_cache import HistoryCache, MemoryHistoryBackend, RedisHistoryBackend
+from log_writer import LogWriter
+from migrations import dsn_from_env, run_migrations
+from quota import MemoryQuotaBackend, QuotaLimiter, QuotaPolicy, RedisQuotaBackend
+from prompt_builder import PostgresDigestStore, PromptBuilder
+from data_access import ContextPrefetcher, ConversationStore
+from fast_path import FastPath, OverQuotaCache
+from message_flow import (
+    GPT_FALLBACK_TEXT, INVALID_INPUT_REPLY, QUOTA_EXCEEDED_REPLY, SYSTEM_PROMPT as sys_prompt,
+    UNEXPECTED_ERROR_REPLY, coalesce, decide, digest_messages, order_events, parse_text_message_events, select_policy,
+    superseded,
+)
+from metrics import CONTENT_TYPE, REGISTRY, count_error, record_stage, stage, trace
+from llm_client import CircuitBreaker, LLMClient, SessionHttpClient, create_session
+from subscription_index import (
+    PostgresSubscriptionStore, SubscriptionIndex, SUBSCRIPTION_EVENT_TYPES,
+)
+from startup import LazyModule, Startup, warm_http
+from user_mailbox import UserMailbox
 
 app = Flask(__name__)
+# 起動時の初期化（DB接続・keep-alive接続・キャッシュの準備はバックグラウンドで行い、/readyz に出す）
+startup = Startup()
 
-# 環境変数取得
-YOUR_CHANNEL_ACCESS_TOKEN = os.environ["YOUR_CHANNEL_ACCESS_TOKEN"]
-YOUR_CHANNEL_SECRET = os.environ["YOUR_CHANNEL_SECRET"]
-line_bot_api = LineBotApi(YOUR_CHANNEL_ACCESS_TOKEN)
+# 環境変数取得（必須の変数がなくてもimportは続け、/readyz で知らせる）
+REQUIRED_ENV = startup.require_env(
+    "YOUR_CHANNEL_ACCESS_TOKEN", "YOUR_CHANNEL_SECRET", "OPENAI_API_KEY", "STRIPE_SECRET_KEY", "SUBSCRIPTION_PRICE_ID",
+)
+YOUR_CHANNEL_ACCESS_TOKEN = REQUIRED_ENV["YOUR_CHANNEL_ACCESS_TOKEN"]
+YOUR_CHANNEL_SECRET = REQUIRED_ENV["YOUR_CHANNEL_SECRET"]
 handler = WebhookHandler(YOUR_CHANNEL_SECRET)
 
-OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
-GPT4_API_URL = 'https://api.openai.com/v1/chat/completions'
-
-stripe.api_key = os.environ["STRIPE_SECRET_KEY"]
-STRIPE_PRICE_ID = os.environ["SUBSCRIPTION_PRICE_ID"]
+OPENAI_API_KEY = REQUIRED_ENV["OPENAI_API_KEY"]
+OPENAI_API_BASE = os.environ.get("OPENAI_API_BASE", "https://api.openai.com/v1")
+# 外部APIの接続プールとタイムアウト（秒）、リトライ回数、サーキットブレーカー
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 10))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", 3.05))
+OPENAI_READ_TIMEOUT = float(os.environ.get("OPENAI_READ_TIMEOUT", 20))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 2))
+OPENAI_CIRCUIT_THRESHOLD = int(os.environ.get("OPENAI_CIRCUIT_THRESHOLD", 5))
+OPENAI_CIRCUIT_RESET = float(os.environ.get("OPENAI_CIRCUIT_RESET", 30))
+LINE_API_TIMEOUT = float(os.environ.get("LINE_API_TIMEOUT", 10))
+# 負荷試験で疑似サーバーに向ける場合などに変更する
+LINE_API_ENDPOINT = os.environ.get("LINE_API_ENDPOINT", "https://api.line.me")
+
+llm_client = LLMClient(
+    OPENAI_API_KEY,
+    base_url=OPENAI_API_BASE,
+    pool_size=HTTP_POOL_SIZE,
+    connect_timeout=OPENAI_CONNECT_TIMEOUT,
+    read_timeout=OPENAI_READ_TIMEOUT,
+    max_retries=OPENAI_MAX_RETRIES,
+    breaker=CircuitBreaker(failure_threshold=OPENAI_CIRCUIT_THRESHOLD, reset_timeout=OPENAI_CIRCUIT_RESET),
+)
+# LINEへの返信もkeep-aliveの接続を使い回す（reply tokenは使い捨てなのでリトライはしない）
+line_session = create_session(HTTP_POOL_SIZE)
+line_bot_api = LineBotApi(
+    YOUR_CHANNEL_ACCESS_TOKEN,
+    endpoint=LINE_API_ENDPOINT,
+    timeout=(OPENAI_CONNECT_TIMEOUT, LINE_API_TIMEOUT),
+    http_client=partial(SessionHttpClient, line_session),
+)
+# 起動時にOpenAIとLINEへ開いておくkeep-alive接続の数（0で開かない）
+WARM_HTTP_CONNECTIONS = int(os.environ.get("WARM_HTTP_CONNECTIONS", 2))
+# 1にするとGPTの応答をストリーミングし、最初の文ができた時点で返信する
+LINE_STREAMING = os.environ.get("LINE_STREAMING", "0") == "1"
+# プロンプト全体のトークン予算と、予算に入らない古い会話の要約
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 4000))
+PROMPT_DIGEST = os.environ.get("PROMPT_DIGEST", "0") == "1"
+DIGEST_MODEL = os.environ.get("DIGEST_MODEL", "gpt-4o-mini")
+# 要約をプロセス内に保持する秒数（他のワーカーでのリセットはこの時間内に反映される）
+DIGEST_CACHE_TTL = int(os.environ.get("DIGEST_CACHE_TTL", 60))
+# この時間（ミリ秒）以上かかったリクエストは、段階ごとの内訳をINFOでログに出す
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", 3000))
+# 設定すると /metrics に Authorization: Bearer <METRICS_TOKEN> を要求する
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# stripe はimportに時間がかかる（0.5秒以上）ので、起動後にバックグラウンドで読み込む
+def configure_stripe(module):
+    module.api_key = REQUIRED_ENV["STRIPE_SECRET_KEY"]
+    if os.environ.get("STRIPE_API_BASE"):
+        module.api_base = os.environ["STRIPE_API_BASE"]
+
+stripe = LazyModule("stripe", configure_stripe)
+STRIPE_PRICE_ID = REQUIRED_ENV["SUBSCRIPTION_PRICE_ID"]
+# Stripe Webhookの署名シークレット（未設定の場合 /stripe/webhook は無効）
+STRIPE_WEBHOOK_SECRET = os.environ.get("STRIPE_WEBHOOK_SECRET")
+# サブスクリプションインデックスのキャッシュTTLと一括同期の間隔（秒、0で同期しない）
+SUBSCRIPTION_CACHE_TTL = int(os.environ.get("SUBSCRIPTION_CACHE_TTL", 300))
+SUBSCRIPTION_SYNC_INTERVAL = int(os.environ.get("SUBSCRIPTION_SYNC_INTERVAL", 900))
 
 # オーナー（管理者）のLINE ID（環境変数から取得、設定されていない場合はNone）
 OWNER_LINE_ID = os.environ.get("OWNER_LINE_ID")
 
-# データベース接続プール
+# Webhookの処理方式（sync: リクエスト内で処理 / async: キューに積んでワーカーで処理）
+LINE_DISPATCH_MODE = os.environ.get("LINE_DISPATCH_MODE", "sync")
+LINE_DISPATCH_WORKERS = int(os.environ.get("LINE_DISPATCH_WORKERS", 4))
+LINE_DISPATCH_QUEUE_SIZE = int(os.environ.get("LINE_DISPATCH_QUEUE_SIZE", 100))
+
+# 同じユーザーのメッセージは順番に処理し、応答の生成中に届いたものはまとめて1回で応答する
+# （最初のメッセージは待たずに処理する。生成中に届いたものは最後のメッセージから WINDOW 秒、
+#   その最初のメッセージからは最大 MAX_DELAY 秒待つ。WINDOW=0 で待たない）
+LINE_COALESCE_WINDOW = float(os.environ.get("LINE_COALESCE_WINDOW", 1.0))
+LINE_COALESCE_MAX_DELAY = float(os.environ.get("LINE_COALESCE_MAX_DELAY", 3.0))
+LINE_COALESCE_MAX_MESSAGES = int(os.environ.get("LINE_COALESCE_MAX_MESSAGES", 5))
+
+# 会話履歴キャッシュ（REDIS_URLを設定すると複数ワーカーで共有）
+HISTORY_LIMIT = int(os.environ.get("HISTORY_LIMIT", 10))
+HISTORY_CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", 1000))
+HISTORY_CACHE_TTL = int(os.environ.get("HISTORY_CACHE_TTL", 1800))
+REDIS_URL = os.environ.get("REDIS_URL")
+
+if REDIS_URL:
+    history_cache = HistoryCache(RedisHistoryBackend.from_url(REDIS_URL, ttl=HISTORY_CACHE_TTL), limit=HISTORY_LIMIT)
+else:
+    history_cache = HistoryCache(MemoryHistoryBackend(max_users=HISTORY_CACHE_SIZE, ttl=HISTORY_CACHE_TTL), limit=HISTORY_LIMIT)
+
+# ログのバッチ書き込み（LOG_WRITER_MODE=sync でその場で書き込む）
+LOG_WRITER_MODE = os.environ.get("LOG_WRITER_MODE", "async")
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", 100))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", 1.0))
+LOG_BUFFER_SIZE = int(os.environ.get("LOG_BUFFER_SIZE", 10000))
+
+# 利用回数制限（空欄は無制限）。REDIS_URLを設定すると複数ワーカーで共有
+def optional_int(value):
+    return int(value) if value else None
+
+QUOTA_WINDOW_SECONDS = int(os.environ.get("QUOTA_WINDOW_SECONDS", 24 * 60 * 60))
+QUOTA_POLICIES = [
+    QuotaPolicy("owner", optional_int(os.environ.get("QUOTA_OWNER_LIMIT", ""))),
+    QuotaPolicy("paid", optional_int(os.environ.get("QUOTA_PAID_LIMIT", ""))),
+    QuotaPolicy("free", optional_int(os.environ.get("QUOTA_FREE_LIMIT", "5"))),
+]
+# 回数制限を超えたユーザーは制限が解けるまで（最長 TTL 秒）DBやOpenAIを使わずに返信する
+OVER_QUOTA_CACHE_SIZE = int(os.environ.get("OVER_QUOTA_CACHE_SIZE", 10000))
+OVER_QUOTA_CACHE_TTL = int(os.environ.get("OVER_QUOTA_CACHE_TTL", 300))
+
+# データベース接続プール（MIN_CONN本の接続は起動時に開き、使い終わっても閉じずに残す）
+DB_POOL_MIN_CONN = int(os.environ.get("DB_POOL_MIN_CONN", 2))
+DB_POOL_MAX_CONN = int(os.environ.get("DB_POOL_MAX_CONN", 20))
 connection_pool = None
+connection_pool_lock = threading.Lock()
 
 def init_connection_pool():
     global connection_pool
+    import psycopg2.pool
+
     try:
-        database_url = os.environ.get('DATABASE_URL')
-        if database_url:
-            connection_pool = psycopg2.pool.ThreadedConnectionPool(
-                minconn=1,
-                maxconn=20,
-                dsn=database_url
-            )
-        else:
-            dsn = f"host={os.environ['DB_HOST']} " \
-                  f"port=5432 " \
-                  f"dbname={os.environ['DB_NAME']} " \
-                  f"user={os.environ['DB_USER']} " \
-                  f"password={os.environ['DB_PASS']}"
-            connection_pool = psycopg2.pool.ThreadedConnectionPool(
-                minconn=1,
-                maxconn=20,
-                dsn=dsn
-            )
+        pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn=DB_POOL_MIN_CONN,
+            maxconn=DB_POOL_MAX_CONN,
+            dsn=dsn_from_env()
+        )
+        connection_pool = pool
         logger.info("Database connection pool initialized successfully")
     except Exception as e:
         logger.error(f"Failed to initialize connection pool: {e}")
@@ -68,11 +184,16 @@ def init_connection_pool():
 def get_connection():
     global connection_pool
     if connection_pool is None:
-        init_connection_pool()
+        # 起動直後に複数のスレッドから呼ばれても、プールは1つだけ作る
+        with connection_pool_lock:
+            if connection_pool is None:
+                init_connection_pool()
     try:
-        return connection_pool.getconn()
+        with stage("db.checkout"):
+            return connection_pool.getconn()
     except Exception as e:
         logger.error(f"Failed to get connection from pool: {e}")
+        count_error("db_checkout")
         raise
 
 def put_connection(connection):
@@ -80,259 +201,433 @@ def put_connection(connection):
     if connection_pool and connection:
         connection_pool.putconn(connection)
 
+# コネクションプールの使用状況（/metrics 用）
+def connection_pool_stats():
+    pool = connection_pool
+    if pool is None:
+        return {}
+    in_use = len(pool._used)
+    return {"in_use": in_use, "idle": len(pool._pool), "max": pool.maxconn, "utilization": in_use / pool.maxconn}
+
+# 起動時に接続プールを作り、接続できることを確かめる
+def warm_connection_pool():
+    connection = get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1;")
+        connection.rollback()
+    finally:
+        put_connection(connection)
+
+# 起動時にスキーママイグレーションを適用する（RUN_MIGRATIONS=0 で無効）
+def apply_migrations():
+    connection = get_connection()
+    try:
+        applied = run_migrations(connection)
+        if applied:
+            logger.info(f"Applied database migrations: {applied}")
+    finally:
+        put_connection(connection)
+
+startup.step("db_pool", warm_connection_pool)
+if os.environ.get("RUN_MIGRATIONS", "1") == "1":
+    startup.step("migrations", apply_migrations)
+
+log_writer = LogWriter(
+    get_connection,
+    put_connection,
+    batch_size=LOG_BATCH_SIZE,
+    flush_interval=LOG_FLUSH_INTERVAL,
+    max_buffer=LOG_BUFFER_SIZE,
+    synchronous=LOG_WRITER_MODE == "sync",
+)
+log_writer.start()
+# 終了時にバッファに残ったログを書き込む
+atexit.register(log_writer.close)
+
+# line_bot_logs と stripe_subscriptions への読み書き（1メッセージあたりの往復を最小にする）
+conversation_store = ConversationStore(get_connection, put_connection, log_writer, history_limit=HISTORY_LIMIT)
+
+# LINEユーザーIDをキーにしたサブスクリプションのローカルインデックス
+subscription_index = SubscriptionIndex(
+    PostgresSubscriptionStore(get_connection, put_connection),
+    stripe,
+    STRIPE_PRICE_ID,
+    ttl=SUBSCRIPTION_CACHE_TTL,
+)
+
 @app.route("/")
 def hello_world():
     return "hello world!"
 
+# 生存確認（プロセスが応答できれば200）
+@app.route("/healthz")
+def healthz():
+    return json.dumps({"status": "ok"}), 200, {"Content-Type": "application/json"}
+
+# 起動時の初期化が終わり、必須の設定がそろっていれば200（それまでは503）。依存先の状態も返す
+@app.route("/readyz")
+def readyz():
+    status = startup.status()
+    return json.dumps(status), 200 if status["ready"] else 503, {"Content-Type": "application/json"}
+
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        abort(401)
+    return REGISTRY.render(), 200, {"Content-Type": CONTENT_TYPE}
+
 @app.route("/callback", methods=['POST'])
 def callback():
+    if startup.missing_env:
+        # 設定が直るまでLINEに再送させる
+        abort(503)
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
     # app.logger.info("Request body: " + body)
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+    if event_dispatcher is None:
+        try:
+            handler.handle(body, signature)
+        except InvalidSignatureError:
+            abort(400)
+        return 'OK'
+
+    # asyncモード：署名を検証してキューに積み、すぐに200を返す
+    if not handler.parser.signature_validator.validate(body, signature):
         abort(400)
+    for event_id, event in parse_text_message_events(body):
+        try:
+            event_dispatcher.submit(event_id, event)
+        except queue.Full:
+            # 503を返してLINEに再送させる（処理済みのイベントは重複排除される）
+            abort(503)
     return 'OK'
 
-# 入力検証関数
-def validate_message(message):
-    if not message or not isinstance(message, str):
-        raise ValueError("Invalid message format")
-    
-    # メッセージ長制限
-    if len(message) > 2000:
-        raise ValueError("Message too long")
-    
-    # 空文字やスペースのみのチェック
-    if not message.strip():
-        raise ValueError("Empty message")
-    
-    # 危険な文字列パターンのチェック
-    dangerous_patterns = [
-        r'<script.*?>.*?</script>',  # XSS
-        r'javascript:',  # JavaScript injection
-        r'vbscript:',   # VBScript injection
-        r'data:text/html',  # Data URI XSS
-    ]
-    
-    message_lower = message.lower()
-    for pattern in dangerous_patterns:
-        if re.search(pattern, message_lower, re.IGNORECASE | re.DOTALL):
-            raise ValueError("Potentially dangerous content detected")
-    
-    return message.strip()
-
-sys_prompt = "You will be playing the role of a supportive, Japanese-speaking counselor. Here is the conversation history so far:\n\n<conversation_history>\n{{CONVERSATION_HISTORY}}\n</conversation_history>\n\nThe user has just said:\n<user_statement>\n{{QUESTION}}\n</user_statement>\n\nPlease carefully review the conversation history and the user's latest statement. Your goal is to provide supportive counseling while following this specific method:\n\n1. Listen-Back 1: After the user makes a statement, paraphrase it into a single sentence while adding a new nuance or interpretation. \n2. Wait for the user's reply to your Listen-Back 1.\n3. Listen-Back 2: After receiving the user's response, further paraphrase their reply, condensing it into one sentence and adding another layer of meaning or interpretation.\n4. Once you've done Listen-Back 1 and Listen-Back 2 and received a response from the user, you may then pose a question from the list below, in the specified order. Do not ask a question out of order.\n5. After the user answers your question, return to Listen-Back 1 - paraphrase their answer in one sentence and introduce a new nuance or interpretation. \n6. You can ask your next question only after receiving a response to your Listen-Back 1, providing your Listen-Back 2, and getting another response from the user.\n\nIn essence, never ask consecutive questions. Always follow the pattern of Listen-Back 1, user response, Listen-Back 2, another user response before moving on to the next question.\n\nHere is the order in which you should ask questions:\n1. Start by asking the user about something they find particularly troubling.\n2. Then, inquire about how they'd envision the ideal outcome. \n3. Proceed by asking about what little they've already done.\n4. Follow up by exploring other actions they're currently undertaking.\n5. Delve into potential resources that could aid in achieving their goals.\n6. Discuss the immediate actions they can take to move closer to their aspirations.\n7. Lastly, encourage them to complete the very first step in that direction with some positive feedback, and ask if you can close the conversation.\n\n<example>\nUser: I'm so busy I don't even have time to sleep.\nYou: You are having trouble getting enough sleep.\nUser: Yes.\nYou: You are so busy that you want to manage to get some sleep.\nUser: Yes.\nYou: In what way do you have problems when you get less sleep?\n</example>\n\n<example>  \nUser: I get sick when I get less sleep.\nYou: You are worried about getting sick.\nUser: Yes.\nYou: You feel that sleep time is important to stay healthy.\nUser: That is right.\nYou: What do you hope to become?\n</example>\n\n<example>\nUser: I want to be free from suffering. But I cannot relinquish responsibility.\nYou: You want to be free from suffering, but at the same time you can't give up your responsibility.\nUser: Exactly.\nYou: You are searching for your own way forward.\nUser: Maybe so.\nYou: When do you think you are getting closer to the path you should be on, even if only a little?  \n</example>\n\nPlease follow the above procedures strictly for the consultation."
+# Stripeのサブスクリプション変更をインデックスに反映する
+@app.route("/stripe/webhook", methods=['POST'])
+def stripe_webhook():
+    if not STRIPE_WEBHOOK_SECRET or startup.missing_env:
+        abort(503)
+    payload = request.get_data()
+    signature = request.headers.get('Stripe-Signature', '')
+    try:
+        event = stripe.Webhook.construct_event(payload, signature, STRIPE_WEBHOOK_SECRET)
+    except (ValueError, stripe.SignatureVerificationError):
+        abort(400)
+    if event['type'] in SUBSCRIPTION_EVENT_TYPES:
+        subscription = event['data']['object']
+        if subscription_index.apply_subscription(subscription):
+            # 有料プランに変わったユーザーを回数制限中として扱わないようにする
+            over_quota_cache.discard((subscription.get('metadata') or {}).get('line_user'))
+    return 'OK'
 
-def generate_gpt4_response(prompt, userId):
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {OPENAI_API_KEY}'
-    }
+def build_chat_messages(prompt, userId):
     # 過去の会話履歴を取得
     conversation_history = get_conversation_history(userId)
-    # sys_promptを会話の最初に追加
-    conversation_history.insert(0, {"role": "system", "content": sys_prompt})
-    # ユーザーからの最新のメッセージを追加
-    conversation_history.append({"role": "user", "content": prompt})
-
-    data = {
-        'model': "gpt-4o",
-        'messages': conversation_history,
-        'temperature': 1
-    }
+    # sys_prompt・要約・履歴・最新のメッセージをトークン予算内で組み立てる
+    with stage("prompt"):
+        messages, stats = prompt_builder.build(
+            userId, conversation_history, prompt, window_full=len(conversation_history) >= HISTORY_LIMIT
+        )
+    logger.debug(f"Prompt stats for {userId}: {stats}")
+    return messages
+
+# 予算に入らなかった古い会話を、これまでの要約と合わせて要約し直す
+def summarize_conversation(previous_summary, turns):
+    return llm_client.chat(digest_messages(previous_summary, turns), model=DIGEST_MODEL, temperature=0)
+
+prompt_builder = PromptBuilder(
+    sys_prompt,
+    PROMPT_TOKEN_BUDGET,
+    digest_store=PostgresDigestStore(
+        get_connection, put_connection, max_users=HISTORY_CACHE_SIZE, ttl=DIGEST_CACHE_TTL,
+    ),
+    summarizer=summarize_conversation if PROMPT_DIGEST else None,
+)
+
+def generate_gpt4_response(prompt, userId):
+    conversation_history = build_chat_messages(prompt, userId)
     # ここでconversation_historyの内容をログに出力
     # app.logger.info("Conversation history sent to : " + str(conversation_history))
     # 旧："gpt-4-1106-preview"
 
     try:
-        response = requests.post(GPT4_API_URL, headers=headers, json=data)
-        response.raise_for_status()  # Check if the request was successful
-        response_json = response.json() # This line has been moved here
-        # Add this line to log the response from  API
-        # app.logger.info("Response from  API: " + str(response_json))
-        return response_json['choices'][0]['message']['content'].strip()
+        # タイムアウト・リトライ・サーキットブレーカーはllm_clientが扱う
+        return llm_client.chat(conversation_history, model="gpt-4o", temperature=1)
     except requests.RequestException as e:
-        # app.logger.error(f" API request failed: {e}")
-        return "Sorry, I couldn't understand that."
+        logger.error(f"API request failed: {e}")
+        count_error("llm_fallback")
+        return GPT_FALLBACK_TEXT
 
-        
-def get_system_responses_in_last_24_hours(userId):
-    # この関数の中でデータベースにアクセスして、指定されたユーザーに対する過去24時間以内のシステムの応答数を取得します。
-    connection = None
+# ストリーミングで生成し、最初の文をreply token、残りをpushで送る。組み立てた全文を返す
+def generate_gpt4_response_streaming(prompt, userId, reply_token):
+    messages = build_chat_messages(prompt, userId)
+
+    def send_reply(text):
+        with stage("line_reply"):
+            line_bot_api.reply_message(reply_token, TextSendMessage(text=text))
+
+    def send_push(text):
+        with stage("line_push"):
+            line_bot_api.push_message(userId, TextSendMessage(text=text))
+
+    def record_usage(usage):
+        llm_client.record_usage("gpt-4o", usage)
+
+    started = time.perf_counter()
     try:
-        connection = get_connection()
-        cursor = connection.cursor()
-        try:
-            query = """
-            SELECT COUNT(*) FROM line_bot_logs 
-            WHERE sender='system' AND lineId=%s AND timestamp > NOW() - INTERVAL '24 HOURS';
-            """
-            cursor.execute(query, (userId,))
-            result = cursor.fetchone()
-            return result[0]
-        except Exception as e:
-            logger.error(f"Database error in get_system_responses_in_last_24_hours: {e}")
-            return 0
-        finally:
-            cursor.close()
-    except Exception as e:
-        logger.error(f"Connection error in get_system_responses_in_last_24_hours: {e}")
-        return 0
-    finally:
-        if connection:
-            put_connection(connection)
+        with stage("llm.stream"):
+            with llm_client.stream(
+                messages, model="gpt-4o", temperature=1, stream_options={"include_usage": True},
+            ) as response:
+                deltas = iter_sse_deltas(response.iter_lines(), on_usage=record_usage)
+                return deliver_stream(timed_deltas(deltas, started), send_reply, send_push)
+    except (requests.RequestException, ValueError) as e:
+        # 最初の返信前に失敗した場合のみここに来る
+        logger.error(f"Streaming API request failed: {e}")
+        count_error("llm_fallback")
+        send_reply(GPT_FALLBACK_TEXT)
+        return GPT_FALLBACK_TEXT
+
+# 最初のトークンが届くまでの時間を記録する
+def timed_deltas(deltas, started):
+    first = True
+    for delta in deltas:
+        if first:
+            record_stage("llm.first_token", time.perf_counter() - started)
+            first = False
+        yield delta
+
+# 応答を生成する。ストリーミング時は返信まで済ませるので (本文, 返信済みか) を返す
+def generate_reply(prompt, userId, reply_token):
+    if LINE_STREAMING:
+        return generate_gpt4_response_streaming(prompt, userId, reply_token), True
+    return generate_gpt4_response(prompt, userId), False
 
-def deactivate_conversation_history(userId):
-    connection = None
+        
+# 起動時にウィンドウ内の全ユーザーのシステム応答時刻を読み込み、利用回数制限を作り直す
+# （同じユーザーのサブスクリプションも、最近応答したユーザーから順にキャッシュに読み込む）
+def warm_caches():
+    timestamps_by_user = conversation_store.fetch_all_reply_times(time.time() - QUOTA_WINDOW_SECONDS)
+    quota_limiter.warm(timestamps_by_user)
+    logger.info(f"Quota limiter warmed for {len(timestamps_by_user)} users")
+    recent_users = sorted(timestamps_by_user, key=lambda user: max(timestamps_by_user[user]), reverse=True)
+    warmed = subscription_index.warm(recent_users)
+    logger.info(f"Subscription index warmed for {warmed} users")
+
+# 起動時にStripeと一括同期してから、定期的な同期を始める（マイグレーションの後に実行する）
+def sync_subscriptions():
+    subscription_index.sync()
+    subscription_index.start_periodic_sync(SUBSCRIPTION_SYNC_INTERVAL)
+
+# 起動時にOpenAIとLINEへのkeep-alive接続を開いておく
+def warm_http_connections():
+    if WARM_HTTP_CONNECTIONS > 0:
+        warm_http(llm_client.session, OPENAI_API_BASE, WARM_HTTP_CONNECTIONS)
+        warm_http(line_session, LINE_API_ENDPOINT, WARM_HTTP_CONNECTIONS)
+
+def deactivate_conversation_history(userId, reset_at=None):
     try:
-        connection = get_connection()
-        cursor = connection.cursor()
-        try:
-            query = """
-            UPDATE line_bot_logs SET is_active=FALSE 
-            WHERE lineId=%s;
-            """
-            cursor.execute(query, (userId,))
-            connection.commit()
-        except Exception as e:
-            logger.error(f"Database error in deactivate_conversation_history: {e}")
-            connection.rollback()
-        finally:
-            cursor.close()
+        conversation_store.deactivate(userId, reset_at)
+        history_cache.reset(userId)
+        prompt_builder.reset(userId)
     except Exception as e:
-        logger.error(f"Connection error in deactivate_conversation_history: {e}")
+        logger.error(f"Database error in deactivate_conversation_history: {e}")
         # データベース接続エラーでもアプリケーションを継続
-        pass
-    finally:
-        if connection:
-            put_connection(connection)
 
 # LINEからのメッセージを処理し、必要に応じてStripeの情報も確認します。
 @handler.add(MessageEvent, message=TextMessage)
 def handle_line_message(event):
     userId = getattr(event.source, 'user_id', None)
+    received = (datetime.datetime.now(), event)
+    if userId is None:
+        handle_line_messages(userId, [received])
+        return
+    # 処理中のメッセージがあればメールボックスに積むだけで戻る（処理中の呼び出し元がまとめて処理する）
+    user_mailbox.submit(userId, received)
+
+def handle_line_messages(userId, received):
+    # 段階ごとの所要時間を計測し、遅いリクエストは内訳をログに出す
+    with trace("line_message", slow_ms=TRACE_SLOW_MS):
+        process_line_messages(userId, order_events(received))
+
+def process_line_messages(userId, timed_events):
+    events = [event for _, event in timed_events]
+    # 返信には最後のメッセージのreply tokenを使う
+    reply_token = events[-1].reply_token
+    replied = False
+    # 応答と一緒に記録できていないユーザーの発言（エラーの場合は発言だけを記録する）
+    unrecorded_turns = []
+    stripe_id = None
 
     try:
-        # 入力検証
-        validated_message = validate_message(event.message.text)
-        
-        if validated_message == "スタート" and userId:
-            deactivate_conversation_history(userId)
-            reply_text = "頼りにしてくださりありがとうございます。今日はどんなお話をうかがいましょうか？"
-        else:
-            # 現在のタイムスタンプを取得
-            current_timestamp = datetime.datetime.now()
-
-            if userId:
+        # 入力検証とリセット・定型文の判定（asyncモードと共有）
+        with stage("validation"):
+            decisions = [decide(event.message.text, userId) for event in events]
+            reset, decision, included = coalesce(decisions)
+        for skipped in decisions:
+            if skipped.error:
+                logger.warning(f"Invalid input from user {userId}")
+                count_error(skipped.error)
+        reply_text = decision.text
+
+        if reset:
+            reset_at = datetime.datetime.now()
+            deactivate_conversation_history(userId, reset_at)
+            # 最後の「スタート」より前のメッセージは応答に使わないが、リセット前の無効な行としてログに残す
+            earlier_turns = [(timed_events[i][0], decisions[i].text) for i in superseded(decisions, included)]
+            if earlier_turns:
+                record_user_turns(userId, None, earlier_turns, is_active=False)
+        # 定型文や回数制限中のユーザーへの返信はI/Oなしで決める
+        fast_reply = fast_path.route(userId, decision)
+        if fast_reply is not None:
+            reply_text = fast_reply
+        elif decision.action == "converse":
+            validated_message = decision.text
+            # 各メッセージの受信時刻（送信順）。リセット後のメッセージはリセット時刻以降として記録する
+            user_turns = [(timed_events[i][0], decisions[i].text) for i in included]
+            if reset:
+                user_turns = [(max(timestamp, reset_at), message) for timestamp, message in user_turns]
+            unrecorded_turns = user_turns
+
+            # キャッシュにない履歴・応答回数・サブスクリプションを1往復でまとめて読み込む
+            with stage("prefetch"):
+                context_prefetcher.prefetch(userId)
+            with stage("subscription"):
                 subscription_details = get_subscription_details_for_user(userId, STRIPE_PRICE_ID)
-                stripe_id = subscription_details['stripeId'] if subscription_details else None
-                subscription_status = subscription_details['status'] if subscription_details else None
-
-                log_to_database(current_timestamp, 'user', userId, stripe_id, validated_message, True, sys_prompt)  # is_activeをTrueで保存
-
-                # オーナーIDの場合は無制限で利用可能
-                if userId == OWNER_LINE_ID:
-                    reply_text = generate_gpt4_response(validated_message, userId)
-                elif subscription_status == "active": ####################本番はactive################
-                    reply_text = generate_gpt4_response(validated_message, userId)
-                else:
-                    # オーナーIDでない場合のみ24時間制限をチェック
-                    response_count = get_system_responses_in_last_24_hours(userId)
-                    if response_count < 5: 
-                        reply_text = generate_gpt4_response(validated_message, userId)
-                    else:
-                        reply_text = "利用回数の上限に達しました。24時間後に再度お試しください。こちらから回数無制限の有料プランに申し込むこともできます：https://line-login-3fbeac7c6978.herokuapp.com/"
+            stripe_id = subscription_details['stripeId'] if subscription_details else None
+
+            # オーナー・有料・無料ごとの回数制限をチェック（既定ではオーナーと有料は無制限）
+            policy = select_policy(userId, subscription_details, OWNER_LINE_ID)
+            with stage("quota"):
+                quota = quota_limiter.check(userId, policy)
+            if quota.allowed:
+                reply_text, replied = generate_reply(validated_message, userId, reply_token)
             else:
-                reply_text = "エラーが発生しました。"
+                reply_text = QUOTA_EXCEEDED_REPLY
+                over_quota_cache.add(userId, quota.retry_after)
 
-            # メッセージをログに保存
-            log_to_database(current_timestamp, 'system', userId, stripe_id, reply_text, True, sys_prompt)  # is_activeをTrueで保存
+            # ユーザーの発言と応答をまとめてログに保存（is_activeはTrue）
+            with stage("record"):
+                record_exchange(userId, stripe_id, user_turns, datetime.datetime.now(), reply_text)
+            unrecorded_turns = []
 
     except ValueError as e:
         # 入力検証エラーの場合
         logger.warning(f"Invalid input from user {userId}: {e}")
-        reply_text = "申し訳ございませんが、メッセージの形式に問題があります。もう一度お試しください。"
+        count_error("validation")
+        reply_text = INVALID_INPUT_REPLY
     except Exception as e:
         # その他のエラー
         logger.error(f"Unexpected error in handle_line_message: {e}")
-        reply_text = "申し訳ございません。一時的なエラーが発生しました。しばらくしてから再度お試しください。"
+        count_error("unexpected")
+        reply_text = UNEXPECTED_ERROR_REPLY
 
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+    if unrecorded_turns:
+        record_user_turns(userId, stripe_id, unrecorded_turns)
 
-# stripeの情報を参照
+    if not replied:
+        try:
+            with stage("line_reply"):
+                line_bot_api.reply_message(reply_token, TextSendMessage(text=reply_text))
+        except Exception:
+            count_error("line_reply")
+            raise
+
+# stripeの情報を参照（ローカルインデックスを引くだけでStripe APIは呼ばない）
 def get_subscription_details_for_user(userId, STRIPE_PRICE_ID):
-    subscriptions = stripe.Subscription.list(limit=100)
-    for subscription in subscriptions.data:
-        if subscription["items"]["data"][0]["price"]["id"] == STRIPE_PRICE_ID and subscription["metadata"].get("line_user") == userId:
-            return {
-                'status': subscription["status"],
-                'stripeId': subscription["customer"]
-            }
-    return None
+    return subscription_index.lookup(userId)
 
 # Stripeの情報を確認する関数
 def check_subscription_status(userId):
     return get_subscription_details_for_user(userId, STRIPE_PRICE_ID)
 
-# データをdbに入れる関数
-def log_to_database(timestamp, sender, userId, stripeId, message, is_active=True, sys_prompt=''):
-    connection = None
+# ユーザーの発言（(時刻, 本文) のリスト）とシステムの応答をdbに入れる関数（同じトランザクションで書き込まれる）
+def record_exchange(userId, stripeId, user_turns, reply_timestamp, reply_text):
+    # 会話履歴キャッシュにも書き込む（キャッシュ済みのユーザーのみ）
+    for _, message in user_turns:
+        history_cache.append(userId, 'user', message)
+    history_cache.append(userId, 'assistant', reply_text)
+    # システム応答は利用回数としても記録する（まとめて応答した場合も1回）
+    quota_limiter.record(userId, reply_timestamp.timestamp())
+    # 実際の書き込みはログライターがまとめて行う
+    conversation_store.record_turns(userId, stripeId, user_turns, reply_timestamp, reply_text, sys_prompt)
+
+# 応答を生成できなかった（またはリセットで使わなかった）ユーザーの発言だけをdbに入れる関数
+# （エラーの文言はシステムの応答として記録しない。記録すると利用回数に数えられるため）
+def record_user_turns(userId, stripeId, user_turns, is_active=True):
     try:
-        connection = get_connection()
-        cursor = connection.cursor()
-        try:
-            query = """
-            INSERT INTO line_bot_logs (timestamp, sender, lineId, stripeId, message, is_active, sys_prompt) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s);
-            """
-            cursor.execute(query, (timestamp, sender, userId, stripeId, message, is_active, sys_prompt))
-            connection.commit()
-        except Exception as e:
-            logger.error(f"Database error in log_to_database: {e}")
-            connection.rollback()
-        finally:
-            cursor.close()
+        if is_active:
+            for _, message in user_turns:
+                history_cache.append(userId, 'user', message)
+        conversation_store.record_turns(userId, stripeId, user_turns, sys_prompt=sys_prompt, is_active=is_active)
     except Exception as e:
-        logger.error(f"Connection error in log_to_database: {e}")
-        # データベース接続エラーでもアプリケーションを継続
-        pass
-    finally:
-        if connection:
-            put_connection(connection)
+        logger.error(f"Failed to record user messages for {userId}: {e}")
 
-# 会話履歴を参照する関数
+# 会話履歴を参照する関数（キャッシュになければDBから読み込む）
 def get_conversation_history(userId):
-    conversations = []
-    connection = None
     try:
-        connection = get_connection()
-        cursor = connection.cursor()
-        try:
-            query = """
-            SELECT sender, message FROM line_bot_logs 
-            WHERE lineId=%s AND is_active=TRUE 
-            ORDER BY timestamp DESC LIMIT 10;
-            """
-            cursor.execute(query, (userId,))
-            
-            results = cursor.fetchall()
-            for result in results:
-                role = 'user' if result[0] == 'user' else 'assistant'
-                conversations.append({"role": role, "content": result[1]})
-        except Exception as e:
-            logger.error(f"Database error in get_conversation_history: {e}")
-        finally:
-            cursor.close()
+        return history_cache.get(userId, conversation_store.fetch_history)
     except Exception as e:
-        logger.error(f"Connection error in get_conversation_history: {e}")
-    finally:
-        if connection:
-            put_connection(connection)
+        logger.error(f"Database error in get_conversation_history: {e}")
+        return []
+
+# 利用回数制限（起動時にDBから作り直す）
+if REDIS_URL:
+    quota_backend = RedisQuotaBackend.from_url(REDIS_URL, window=QUOTA_WINDOW_SECONDS)
+else:
+    quota_backend = MemoryQuotaBackend()
+quota_limiter = QuotaLimiter(
+    quota_backend, QUOTA_POLICIES, conversation_store.fetch_reply_times, window=QUOTA_WINDOW_SECONDS,
+)
+context_prefetcher = ContextPrefetcher(conversation_store, history_cache, quota_limiter, subscription_index)
+over_quota_cache = OverQuotaCache(max_users=OVER_QUOTA_CACHE_SIZE, ttl=OVER_QUOTA_CACHE_TTL)
+fast_path = FastPath(over_quota_cache)
+startup.step("caches", warm_caches)
+startup.step("stripe", stripe.load)
+if SUBSCRIPTION_SYNC_INTERVAL > 0:
+    startup.step("subscriptions", sync_subscriptions)
+# 外部APIに届かなくても最初のリクエストで接続するだけなので、readyの条件にはしない
+startup.step("http", warm_http_connections, required=False)
+startup.probe("db_pool", connection_pool_stats)
+startup.probe("llm", lambda: {"circuit_state": llm_client.breaker.state})
+startup.probe("subscriptions", lambda: {"last_synced_at": subscription_index.last_synced_at})
+
+user_mailbox = UserMailbox(
+    handle_line_messages,
+    window=LINE_COALESCE_WINDOW,
+    max_delay=LINE_COALESCE_MAX_DELAY,
+    max_batch=LINE_COALESCE_MAX_MESSAGES,
+)
 
-    # 最新の会話が最後に来るように反転
-    return conversations[::-1]
+# asyncモードのディスパッチャ（syncモードではNone）
+event_dispatcher = None
+if LINE_DISPATCH_MODE == "async":
+    event_dispatcher = EventDispatcher(
+        handle_line_message,
+        workers=LINE_DISPATCH_WORKERS,
+        queue_size=LINE_DISPATCH_QUEUE_SIZE,
+    )
+    event_dispatcher.start()
+    # 終了時にキューに残ったイベントを処理し切る
+    atexit.register(event_dispatcher.shutdown)
+
+# 各コンポーネントの stats() を /metrics に出す
+REGISTRY.register_stats("line_bot_db_pool", connection_pool_stats, "Database connection pool")
+REGISTRY.register_stats("line_bot_history_cache", history_cache.stats, "Conversation history cache")
+REGISTRY.register_stats("line_bot_quota", quota_limiter.stats, "Quota limiter")
+REGISTRY.register_stats("line_bot_over_quota_cache", over_quota_cache.stats, "Over-quota users cache")
+REGISTRY.register_stats("line_bot_fast_path", fast_path.stats, "Replies decided without remote I/O")
+REGISTRY.register_stats("line_bot_log_writer", log_writer.stats, "Batched log writer")
+REGISTRY.register_stats("line_bot_llm", llm_client.stats, "LLM client")
+REGISTRY.register_stats("line_bot_prompt", prompt_builder.stats, "Prompt builder")
+REGISTRY.register_stats("line_bot_data_access", conversation_store.stats, "Data access")
+REGISTRY.register_stats("line_bot_prefetch", context_prefetcher.stats, "Context prefetcher")
+REGISTRY.register_stats("line_bot_mailbox", user_mailbox.stats, "Per-user mailbox")
+if event_dispatcher is not None:
+    REGISTRY.register_stats("line_bot_dispatcher", event_dispatcher.stats, "Webhook dispatcher")
+
+startup.start()
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
@@ -0,0 +1,117 @@
+"""
+1メッセージの処理の判断（同期版の main.py と asyncio版の async_app.py で共有）
+
+入力検証、「スタート」によるリセット、オーナー・有料・無料の判定と定型文をまとめる。
+I/Oは行わず、DB・LLM・LINEの呼び出しはそれぞれのモードが行う。
+"""
+
+import json
+from dataclasses import dataclass
+
+from linebot.models import MessageEvent
+
+from validation import validate_message
+
+# 会話をリセットするコマンド
+RESET_COMMAND = "スタート"
+
+RESET_REPLY = "頼りにしてくださりありがとうございます。今日はどんなお話をうかがいましょうか？"
+QUOTA_EXCEEDED_REPLY = "利用回数の上限に達しました。24時間後に再度お試しください。こちらから回数無制限の有料プランに申し込むこともできます：https://line-login-3fbeac7c6978.herokuapp.com/"
+NO_USER_REPLY = "エラーが発生しました。"
+INVALID_INPUT_REPLY = "申し訳ございませんが、メッセージの形式に問題があります。もう一度お試しください。"
+UNEXPECTED_ERROR_REPLY = "申し訳ございません。一時的なエラーが発生しました。しばらくしてから再度お試しください。"
+# 応答の失敗時に返す文言
+GPT_FALLBACK_TEXT = "Sorry, I couldn't understand that."
+
+SYSTEM_PROMPT = "You will be playing the role of a supportive, Japanese-speaking counselor. Here is the conversation history so far:\n\n<conversation_history>\n{{CONVERSATION_HISTORY}}\n</conversation_history>\n\nThe user has just said:\n<user_statement>\n{{QUESTION}}\n</user_statement>\n\nPlease carefully review the conversation history and the user's latest statement. Your goal is to provide supportive counseling while following this specific method:\n\n1. Listen-Back 1: After the user makes a statement, paraphrase it into a single sentence while adding a new nuance or interpretation. \n2. Wait for the user's reply to your Listen-Back 1.\n3. Listen-Back 2: After receiving the user's response, further paraphrase their reply, condensing it into one sentence and adding another layer of meaning or interpretation.\n4. Once you've done Listen-Back 1 and Listen-Back 2 and received a response from the user, you may then pose a question from the list below, in the specified order. Do not ask a question out of order.\n5. After the user answers your question, return to Listen-Back 1 - paraphrase their answer in one sentence and introduce a new nuance or interpretation. \n6. You can ask your next question only after receiving a response to your Listen-Back 1, providing your Listen-Back 2, and getting another response from the user.\n\nIn essence, never ask consecutive questions. Always follow the pattern of Listen-Back 1, user response, Listen-Back 2, another user response before moving on to the next question.\n\nHere is the order in which you should ask questions:\n1. Start by asking the user about something they find particularly troubling.\n2. Then, inquire about how they'd envision the ideal outcome. \n3. Proceed by asking about what little they've already done.\n4. Follow up by exploring other actions they're currently undertaking.\n5. Delve into potential resources that could aid in achieving their goals.\n6. Discuss the immediate actions they can take to move closer to their aspirations.\n7. Lastly, encourage them to complete the very first step in that direction with some positive feedback, and ask if you can close the conversation.\n\n<example>\nUser: I'm so busy I don't even have time to sleep.\nYou: You are having trouble getting enough sleep.\nUser: Yes.\nYou: You are so busy that you want to manage to get some sleep.\nUser: Yes.\nYou: In what way do you have problems when you get less sleep?\n</example>\n\n<example>  \nUser: I get sick when I get less sleep.\nYou: You are worried about getting sick.\nUser: Yes.\nYou: You feel that sleep time is important to stay healthy.\nUser: That is right.\nYou: What do you hope to become?\n</example>\n\n<example>\nUser: I want to be free from suffering. But I cannot relinquish responsibility.\nYou: You want to be free from suffering, but at the same time you can't give up your responsibility.\nUser: Exactly.\nYou: You are searching for your own way forward.\nUser: Maybe so.\nYou: When do you think you are getting closer to the path you should be on, even if only a little?  \n</example>\n\nPlease follow the above procedures strictly for the consultation."
+
+
+@dataclass
+class Decision:
+    """メッセージをどう扱うか
+
+    action は "reset"（会話をリセットして text を返す）、"converse"（text を入力として応答を生成する）、
+    "reply"（定型文 text をそのまま返す）のいずれか。error はメトリクスに数えるエラーの種類。
+    """
+    action: str
+    text: str
+    error: str = None
+
+
+def decide(text, user_id):
+    """入力を検証し、リセット・応答の生成・定型文のどれにするかを決める。"""
+    try:
+        validated = validate_message(text)
+    except ValueError:
+        return Decision("reply", INVALID_INPUT_REPLY, error="validation")
+    if validated == RESET_COMMAND and user_id:
+        return Decision("reset", RESET_REPLY)
+    if not user_id:
+        return Decision("reply", NO_USER_REPLY)
+    return Decision("converse", validated)
+
+
+def coalesce(decisions):
+    """同じユーザーが続けて送ったメッセージの判定（decide の結果）を1つにまとめる。
+
+    (reset, decision, included) を返す。reset は応答の前に会話をリセットするか、
+    included は応答の生成に使うメッセージの位置（decisions の添字）。
+    最後の「スタート」より前のメッセージは使わず、検証に失敗したメッセージは飛ばす。
+    応答の生成に使うメッセージは改行でつないで1つの入力にする。
+    """
+    last_reset = max((i for i, decision in enumerate(decisions) if decision.action == "reset"), default=-1)
+    included = [i for i in range(last_reset + 1, len(decisions)) if decisions[i].action == "converse"]
+    if included:
+        text = "\n".join(decisions[i].text for i in included)
+        return last_reset >= 0, Decision("converse", text), included
+    if last_reset >= 0:
+        return True, decisions[last_reset], []
+    return False, decisions[-1], []
+
+
+def superseded(decisions, included):
+    """最後の「スタート」より前にあり、応答の生成に使わないメッセージの位置（coalesce の included 以外の発言）
+
+    応答には使わないが、ユーザーの発言として無効な行でログに残す。
+    """
+    return [i for i, decision in enumerate(decisions) if decision.action == "converse" and i not in included]
+
+
+def order_events(received):
+    """(受信時刻, MessageEvent) のリストを送信順に並べ、(記録する時刻, MessageEvent) のリストにする。
+
+    順番はLINEのタイムスタンプで決め、記録する時刻は受信時刻を小さい順に割り当てる
+    （同じユーザーのリクエストが前後して届いても、ログの時刻の順と送信順が一致する）。
+    """
+    events = sorted((event for _, event in received), key=lambda event: event.timestamp or 0)
+    return list(zip(sorted(timestamp for timestamp, _ in received), events))
+
+
+def select_policy(user_id, subscription, owner_line_id):
+    """回数制限のポリシー名（owner / paid / free）を返す。subscription は {'status', 'stripeId'} またはNone。"""
+    if owner_line_id and user_id == owner_line_id:
+        return "owner"
+    if subscription and subscription["status"] == "active":
+        return "paid"
+    return "free"
+
+
+def digest_messages(previous_summary, turns):
+    """予算に入らなかった古い会話を、これまでの要約と合わせて要約し直すためのmessages"""
+    transcript = "\n".join(
+        f"{'ユーザー' if turn['role'] == 'user' else 'カウンセラー'}: {turn['content']}" for turn in turns
+    )
+    return [
+        {"role": "system", "content": "カウンセリングの会話記録を、後の応答に必要な事実・感情・話題の流れが分かるよう日本語で300字以内に要約してください。"},
+        {"role": "user", "content": f"これまでの要約:\n{previous_summary or 'なし'}\n\n追加の会話:\n{transcript}"},
+    ]
+
+
+# Webhookのボディからテキストメッセージイベントを (webhookEventId, MessageEvent) で取り出す
+def parse_text_message_events(body):
+    events = []
+    for event_json in json.loads(body).get('events', []):
+        if event_json.get('type') != 'message' or event_json.get('message', {}).get('type') != 'text':
+            continue
+        events.append((event_json.get('webhookEventId'), MessageEvent.new_from_json_dict(event_json)))
+    return events
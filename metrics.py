@@ -0,0 +1,269 @@
+"""
+Prometheus形式のメトリクスとリクエストごとの処理段階の計測
+
+外部ライブラリは使わず、カウンター・ヒストグラム・ゲージをプロセス内に持ち、
+/metrics でテキスト形式（version 0.0.4）を返す。
+stage() で囲んだ処理の所要時間はヒストグラムに記録し、trace() の中であれば
+そのリクエストの段階ごとの内訳としても残す。
+内訳はcontextvarsで持つので、スレッドごと・asyncioのタスクごとに分かれる。
+"""
+
+import bisect
+import contextvars
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 既定のヒストグラムの境界（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames) or not all(name in labels for name in self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = self.header()
+        lines.extend(f"{self.name}_total{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                     for key, value in items)
+        return lines
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = self.header()
+        lines.extend(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                     for key, value in items)
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [境界ごとの件数..., +Infの件数, 合計, 件数]
+                entry = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def snapshot(self, **labels):
+        """(件数, 合計) を返す。"""
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return (entry[-1], entry[-2]) if entry else (0, 0.0)
+
+    def render(self):
+        with self._lock:
+            items = sorted((key, list(entry)) for key, entry in self._values.items())
+        lines = self.header()
+        for key, entry in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), entry):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(entry[-2])}")
+            lines.append(f"{self.name}_count{labels} {entry[-1]}")
+        return lines
+
+
+class Registry:
+    """メトリクスと、収集時に値を読む関数（collector）をまとめて出力する"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_stats(self, prefix, stats_fn, documentation=""):
+        """stats() の数値の項目を {prefix}_{key} のゲージとして出力する。"""
+        self._collectors.append((prefix, stats_fn, documentation))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for prefix, stats_fn, documentation in collectors:
+            try:
+                stats = stats_fn() or {}
+            except Exception as e:
+                logger.error(f"Failed to collect {prefix} metrics: {e}")
+                continue
+            for key, value in sorted(stats.items()):
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{key}"
+                lines.append(f"# HELP {name} {documentation or prefix} {key}")
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "line_bot_stage_seconds", "Time spent in each stage of the message pipeline", ("stage",),
+)
+ERRORS = REGISTRY.counter("line_bot_errors", "Errors and fallbacks by kind", ("kind",))
+
+_current = contextvars.ContextVar("line_bot_trace", default=None)
+
+
+class Trace:
+    """1リクエスト分の段階ごとの所要時間"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add(self, stage, seconds):
+        self.spans.append((stage, seconds))
+
+    def summary(self):
+        total = (time.perf_counter() - self.started) * 1000
+        spans = " ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in self.spans)
+        return total, f"{self.name} total={total:.1f}ms {spans}"
+
+
+def current_trace():
+    return _current.get()
+
+
+@contextmanager
+def trace(name, slow_ms=None):
+    """リクエスト全体を囲む。終了時に段階ごとの内訳をログに出す（slow_ms以上はINFO、それ以外はDEBUG）。"""
+    current = Trace(name)
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        total, line = current.summary()
+        STAGE_SECONDS.observe(total / 1000, stage=name)
+        if slow_ms is not None and total >= slow_ms:
+            logger.info(f"Slow request: {line}")
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug(line)
+
+
+@contextmanager
+def stage(name):
+    """処理の段階を計測する。例外が送出された場合も時間は記録する。"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def record_stage(name, seconds):
+    STAGE_SECONDS.observe(seconds, stage=name)
+    current = current_trace()
+    if current is not None:
+        current.add(name, seconds)
+
+
+def count_error(kind):
+    ERRORS.inc(kind=kind)
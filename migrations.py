@@ -0,0 +1,276 @@
+"""
+データベースのスキーママイグレーション
+
+バージョン付きのマイグレーションを順に適用し、schema_migrationsに記録する。
+起動時に実行されるほか、`python migrations.py` で単体でも実行できる。
+`python migrations.py partition` で line_bot_logs を月単位のパーティションテーブルに変換する。
+"""
+
+import datetime
+import logging
+import os
+import sys
+
+import data_access
+import log_writer
+import prompt_builder
+import subscription_index
+
+logger = logging.getLogger(__name__)
+
+# 複数のワーカーが同時にマイグレーションしないためのアドバイザリロックのキー
+MIGRATION_LOCK_KEY = 727001
+
+BASE_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS line_bot_logs (
+    id SERIAL PRIMARY KEY,
+    timestamp TIMESTAMP,
+    sender VARCHAR(10),
+    lineId VARCHAR(50),
+    stripeId VARCHAR(50),
+    message TEXT,
+    is_active BOOLEAN DEFAULT TRUE,
+    sys_prompt TEXT
+);
+"""
+
+# ホットなクエリに合わせたインデックス
+#   - 24時間以内のシステム応答数: WHERE sender='system' AND lineId=? AND timestamp > ?
+#   - 会話履歴: WHERE lineId=? AND is_active AND timestamp >= (リセット時刻) ORDER BY timestamp DESC LIMIT ?
+#   （「スタート」のリセットは conversation_resets の1行を書き換えるだけで line_bot_logs は更新しない）
+HOT_QUERY_INDEXES = {
+    "idx_line_bot_logs_system_recent":
+        "ON line_bot_logs (lineId, timestamp) WHERE sender = 'system'",
+    "idx_line_bot_logs_active_history":
+        "ON line_bot_logs (lineId, timestamp DESC) WHERE is_active",
+}
+
+
+def _execute(sql):
+    def apply(cursor):
+        cursor.execute(sql)
+    return apply
+
+
+def _create_hot_query_indexes(cursor):
+    partitioned = _is_partitioned(cursor, "line_bot_logs")
+    for name, definition in HOT_QUERY_INDEXES.items():
+        # CONCURRENTLYが中断されると無効なインデックスが残るので作り直す
+        cursor.execute(
+            "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = %s AND NOT i.indisvalid;",
+            (name,),
+        )
+        if cursor.fetchone():
+            cursor.execute(f"DROP INDEX IF EXISTS {name};")
+        # パーティションテーブルにはCONCURRENTLYを使えない
+        concurrently = "" if partitioned else "CONCURRENTLY "
+        cursor.execute(f"CREATE INDEX {concurrently}IF NOT EXISTS {name} {definition};")
+
+
+# (バージョン, 名前, 適用関数, トランザクション内で実行するか)
+MIGRATIONS = [
+    (1, "create_line_bot_logs", _execute(BASE_SCHEMA_SQL), True),
+    (2, "create_prompts", _execute(log_writer.SCHEMA_SQL), True),
+    (3, "create_stripe_subscriptions", _execute(subscription_index.SCHEMA_SQL), True),
+    (4, "hot_query_indexes", _create_hot_query_indexes, False),
+    (5, "create_conversation_digests", _execute(prompt_builder.SCHEMA_SQL), True),
+    (6, "create_conversation_resets", _execute(data_access.SCHEMA_SQL), True),
+]
+
+
+def _is_partitioned(cursor, table):
+    cursor.execute(
+        "SELECT c.relkind = 'p' FROM pg_class c "
+        "WHERE c.oid = to_regclass(%s);",
+        (table,),
+    )
+    result = cursor.fetchone()
+    return bool(result and result[0])
+
+
+def run_migrations(connection):
+    """未適用のマイグレーションを順に適用し、適用したバージョンのリストを返す。"""
+    applied = []
+    previous_autocommit = connection.autocommit
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_KEY,))
+            try:
+                cursor.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        name VARCHAR(100) NOT NULL,
+                        applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+                    );
+                    """
+                )
+                cursor.execute("SELECT version FROM schema_migrations;")
+                done = {row[0] for row in cursor.fetchall()}
+                for version, name, apply, transactional in MIGRATIONS:
+                    if version in done:
+                        continue
+                    logger.info(f"Applying migration {version}: {name}")
+                    if transactional:
+                        cursor.execute("BEGIN;")
+                        try:
+                            apply(cursor)
+                            _record(cursor, version, name)
+                            cursor.execute("COMMIT;")
+                        except Exception:
+                            cursor.execute("ROLLBACK;")
+                            raise
+                    else:
+                        apply(cursor)
+                        _record(cursor, version, name)
+                    applied.append(version)
+                if _is_partitioned(cursor, "line_bot_logs"):
+                    cursor.execute("BEGIN;")
+                    try:
+                        ensure_partitions(cursor)
+                        cursor.execute("COMMIT;")
+                    except Exception:
+                        cursor.execute("ROLLBACK;")
+                        raise
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_KEY,))
+    finally:
+        connection.autocommit = previous_autocommit
+    return applied
+
+
+def _record(cursor, version, name):
+    cursor.execute(
+        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s);",
+        (version, name),
+    )
+
+
+def _month_start(day, offset=0):
+    month_index = day.year * 12 + day.month - 1 + offset
+    return datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+
+# 変換前に既存のテーブルに付ける範囲のCHECK制約（ATTACH PARTITION での全件スキャンを省くため）
+LEGACY_RANGE_CONSTRAINT = "line_bot_logs_legacy_range"
+
+
+def enable_partitioning(connection):
+    """line_bot_logs を timestamp の月単位レンジパーティションに変換する。
+
+    既存のテーブルは来月初めまでを範囲とするパーティションとしてそのまま取り込むので、
+    データのコピーは発生しない。範囲外の行はデフォルトパーティションに入る。
+
+    ATTACH PARTITION はパーティションの範囲を満たすかを確かめるため、ACCESS EXCLUSIVE ロックを
+    持ったまま全行を読む。これを避けるため、先に同じ範囲のCHECK制約を NOT VALID で付けて
+    書き込みを止めずに検証しておく（パーティションの範囲には NULL が入らないので、
+    timestamp が NULL の古い行は '-infinity' で埋める）。
+    """
+    boundary = _month_start(datetime.date.today(), 1)
+    with connection.cursor() as cursor:
+        if _is_partitioned(cursor, "line_bot_logs"):
+            logger.info("line_bot_logs is already partitioned")
+            return False
+        cursor.execute(
+            "SELECT 1 FROM pg_constraint WHERE conname = %s AND conrelid = 'line_bot_logs'::regclass;",
+            (LEGACY_RANGE_CONSTRAINT,),
+        )
+        if cursor.fetchone():
+            # 前回の変換が途中で終わった場合（境界が変わっているかもしれないので付け直す）
+            cursor.execute(f"ALTER TABLE line_bot_logs DROP CONSTRAINT {LEGACY_RANGE_CONSTRAINT};")
+        # どの時間のウィンドウにも入らない点は NULL と同じ
+        cursor.execute("UPDATE line_bot_logs SET timestamp = '-infinity' WHERE timestamp IS NULL;")
+        if cursor.rowcount:
+            logger.info(f"Filled {cursor.rowcount} NULL timestamps with -infinity")
+        cursor.execute(
+            f"ALTER TABLE line_bot_logs ADD CONSTRAINT {LEGACY_RANGE_CONSTRAINT} "
+            "CHECK (timestamp IS NOT NULL AND timestamp < %s) NOT VALID;",
+            (boundary,),
+        )
+        connection.commit()
+        # VALIDATE は SHARE UPDATE EXCLUSIVE ロックなので、検証中も読み書きできる
+        cursor.execute(f"ALTER TABLE line_bot_logs VALIDATE CONSTRAINT {LEGACY_RANGE_CONSTRAINT};")
+        connection.commit()
+
+        cursor.execute("LOCK TABLE line_bot_logs IN ACCESS EXCLUSIVE MODE;")
+        cursor.execute("ALTER TABLE line_bot_logs RENAME TO line_bot_logs_legacy;")
+        cursor.execute(
+            "CREATE TABLE line_bot_logs (LIKE line_bot_logs_legacy INCLUDING DEFAULTS) "
+            "PARTITION BY RANGE (timestamp);"
+        )
+        cursor.execute(
+            "ALTER TABLE line_bot_logs ATTACH PARTITION line_bot_logs_legacy "
+            "FOR VALUES FROM (MINVALUE) TO (%s);",
+            (boundary,),
+        )
+        # 取り込んだ後はパーティションの範囲と同じなので不要
+        cursor.execute(f"ALTER TABLE line_bot_logs_legacy DROP CONSTRAINT {LEGACY_RANGE_CONSTRAINT};")
+        cursor.execute("CREATE TABLE line_bot_logs_default PARTITION OF line_bot_logs DEFAULT;")
+        # 既存のパーティションにある同じ定義のインデックスはそのまま取り込まれる
+        for name, definition in HOT_QUERY_INDEXES.items():
+            cursor.execute(f"ALTER INDEX IF EXISTS {name} RENAME TO {name}_legacy;")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} {definition};")
+        ensure_partitions(cursor)
+    connection.commit()
+    logger.info(f"line_bot_logs converted to a partitioned table (legacy rows before {boundary})")
+    return True
+
+
+def ensure_partitions(cursor, months_ahead=3):
+    """今月から months_ahead か月先までの月次パーティションを用意する。"""
+    today = datetime.date.today()
+    created = []
+    for offset in range(months_ahead + 1):
+        start = _month_start(today, offset)
+        end = _month_start(today, offset + 1)
+        name = f"line_bot_logs_y{start.year}m{start.month:02d}"
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (name,))
+        if cursor.fetchone()[0]:
+            continue
+        cursor.execute("SAVEPOINT ensure_partition;")
+        try:
+            cursor.execute(
+                f"CREATE TABLE {name} PARTITION OF line_bot_logs FOR VALUES FROM (%s) TO (%s);",
+                (start, end),
+            )
+            cursor.execute("RELEASE SAVEPOINT ensure_partition;")
+            created.append(name)
+        except Exception as e:
+            # 既存のパーティション（変換前のテーブルなど）と範囲が重なる月は作らない
+            cursor.execute("ROLLBACK TO SAVEPOINT ensure_partition;")
+            logger.debug(f"Skipped partition {name}: {e}")
+    if created:
+        logger.info(f"Created log partitions: {', '.join(created)}")
+    return created
+
+
+def dsn_from_env():
+    """DATABASE_URL、なければ DB_HOST などの環境変数から接続文字列を作る。"""
+    database_url = os.environ.get('DATABASE_URL')
+    if database_url:
+        return database_url
+    return f"host={os.environ['DB_HOST']} " \
+           f"port=5432 " \
+           f"dbname={os.environ['DB_NAME']} " \
+           f"user={os.environ['DB_USER']} " \
+           f"password={os.environ['DB_PASS']}"
+
+
+def main(argv):
+    import psycopg2
+
+    logging.basicConfig(level=logging.INFO)
+    connection = psycopg2.connect(dsn_from_env())
+    try:
+        applied = run_migrations(connection)
+        logger.info(f"Applied migrations: {applied or 'none'}")
+        if argv[1:] == ["partition"]:
+            enable_partitioning(connection)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,362 @@
+"""
+トークン予算に基づくプロンプトの組み立て
+
+tiktokenでトークン数を数え、システムプロンプト・要約・最新のメッセージを除いた
+残りの予算に収まるだけ新しい順に会話履歴を入れる。
+予算に入らなかった古い会話は捨てずに、ユーザーごとの要約（digest）にまとめて保存する。
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS conversation_digests (
+    line_id VARCHAR(50) PRIMARY KEY,
+    summary TEXT NOT NULL,
+    covered TEXT[] NOT NULL DEFAULT '{}',
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+"""
+
+# メッセージごとの固定オーバーヘッドと、応答の開始に使われるトークン数
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# 要約済みとして覚えておく会話の数
+MAX_COVERED = 40
+
+DIGEST_HEADER = "これまでの会話の要約:\n"
+
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+
+def get_encoder(model):
+    """モデルに対応するtiktokenのエンコーダーを返す。読み込めない場合はNone（結果はキャッシュする）。"""
+    with _encoders_lock:
+        if model in _encoders:
+            return _encoders[model]
+        try:
+            import tiktoken
+
+            try:
+                encoder = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoder = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            logger.warning(f"tiktoken encoder for {model} is unavailable, using an estimate: {e}")
+            encoder = None
+        _encoders[model] = encoder
+        return encoder
+
+
+def estimate_tokens(text):
+    """エンコーダーが使えない場合の概算（非ASCII文字は1文字1トークン、ASCIIは4文字1トークン）"""
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text, model="gpt-4o"):
+    encoder = get_encoder(model)
+    if encoder is None:
+        return estimate_tokens(text)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def fingerprint(turn):
+    return hashlib.sha1(f"{turn['role']}\0{turn['content']}".encode("utf-8")).hexdigest()[:16]
+
+
+class MemoryDigestStore:
+    """プロセス内のLRUに要約を保持するストア（ttl 秒で期限切れ、Noneなら期限なし）
+
+    リセットのたびにユーザーごとのリセット番号を進め、要約中にリセットされた場合は
+    古い会話の要約を書き戻さない（set の generation）。
+    """
+
+    def __init__(self, max_users=10000, ttl=None):
+        self._max_users = max_users
+        self._ttl = ttl
+        self._digests = OrderedDict()
+        self._resets = OrderedDict()
+        self._reset_count = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            return self._cached(user_id)
+
+    def generation(self, user_id):
+        """最後のリセットの番号（リセットされていなければ0）"""
+        with self._lock:
+            return self._resets.get(user_id, 0)
+
+    def set(self, user_id, summary, covered, generation=None):
+        """要約を保存する。generation が今のリセット番号と違う場合は保存せずにFalseを返す。"""
+        with self._lock:
+            if not self._is_current(user_id, generation):
+                return False
+            self._remember(user_id, (summary, tuple(covered)))
+        return True
+
+    def clear(self, user_id):
+        with self._lock:
+            self._advance(user_id)
+            self._digests.pop(user_id, None)
+
+    # 以下は self._lock を持って呼ぶ
+
+    def _cached(self, user_id):
+        entry = self._digests.get(user_id)
+        if entry is None:
+            return None
+        expires, digest = entry
+        if expires is not None and expires <= time.monotonic():
+            del self._digests[user_id]
+            return None
+        self._digests.move_to_end(user_id)
+        return digest
+
+    def _remember(self, user_id, digest):
+        expires = None if self._ttl is None else time.monotonic() + self._ttl
+        self._digests[user_id] = (expires, digest)
+        self._digests.move_to_end(user_id)
+        while len(self._digests) > self._max_users:
+            self._digests.popitem(last=False)
+
+    def _is_current(self, user_id, generation):
+        return generation is None or self._resets.get(user_id, 0) == generation
+
+    def _advance(self, user_id):
+        # 番号は全ユーザーで通しにするので、古いリセットが追い出されても同じ番号には戻らない
+        self._reset_count += 1
+        self._resets[user_id] = self._reset_count
+        self._resets.move_to_end(user_id)
+        while len(self._resets) > self._max_users:
+            self._resets.popitem(last=False)
+
+
+class PostgresDigestStore(MemoryDigestStore):
+    """conversation_digestsテーブルに保存し、読み込んだ要約はプロセス内に ttl 秒保持する
+
+    他のワーカーでの更新やリセットは、キャッシュの期限が切れてから反映される。
+    """
+
+    _MISSING = (None, ())
+
+    def __init__(self, get_connection, put_connection, max_users=10000, ttl=60):
+        super().__init__(max_users, ttl)
+        self._get_connection = get_connection
+        self._put_connection = put_connection
+        # リセット番号の確認とDBへの書き込みを、リセット（DELETE）と順に行うためのロック
+        self._write_lock = threading.Lock()
+
+    def get(self, user_id):
+        cached = super().get(user_id)
+        if cached is not None:
+            return None if cached is self._MISSING else cached
+        generation = self.generation(user_id)
+        with stage("db.digest"):
+            connection = self._get_connection()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT summary, covered FROM conversation_digests WHERE line_id=%s;",
+                        (user_id,),
+                    )
+                    row = cursor.fetchone()
+                connection.rollback()
+            finally:
+                self._put_connection(connection)
+        digest = (row[0], tuple(row[1])) if row else None
+        with self._lock:
+            # 読んでいる間にリセットされた場合はキャッシュしない
+            if self._is_current(user_id, generation):
+                self._remember(user_id, digest or self._MISSING)
+        return digest
+
+    def set(self, user_id, summary, covered, generation=None):
+        with self._write_lock:
+            with self._lock:
+                if not self._is_current(user_id, generation):
+                    return False
+            connection = self._get_connection()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        """
+                        INSERT INTO conversation_digests (line_id, summary, covered) VALUES (%s, %s, %s)
+                        ON CONFLICT (line_id) DO UPDATE SET
+                            summary = EXCLUDED.summary, covered = EXCLUDED.covered, updated_at = NOW();
+                        """,
+                        (user_id, summary, list(covered)),
+                    )
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                self._put_connection(connection)
+            return super().set(user_id, summary, covered, generation)
+
+    def clear(self, user_id):
+        # 番号を先に進め、書き込み中の要約があればそれが終わってから消す
+        super().clear(user_id)
+        with self._write_lock:
+            connection = self._get_connection()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("DELETE FROM conversation_digests WHERE line_id=%s;", (user_id,))
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                self._put_connection(connection)
+            with self._lock:
+                self._remember(user_id, self._MISSING)
+
+
+class PromptBuilder:
+    """会話履歴をトークン予算に収めてChat Completionsのmessagesを組み立てる
+
+    summarizer(previous_summary, turns) は要約文を返す関数で、バックグラウンドで呼ばれる。
+    Noneの場合、予算に入らなかった会話は要約せずに捨て、digest_store は読み書きしない（DBを往復しない）。
+    """
+
+    def __init__(self, system_prompt, budget, model="gpt-4o", digest_store=None, summarizer=None,
+                 token_counter=None):
+        self._system_prompt = system_prompt
+        self._budget = budget
+        self._model = model
+        self._digest_store = digest_store or MemoryDigestStore()
+        self._summarizer = summarizer
+        self._count = token_counter or (lambda text: count_tokens(text, model))
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="digest") if summarizer else None
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._totals = {"requests": 0, "prompt_tokens": 0, "history_tokens": 0,
+                        "turns_included": 0, "turns_dropped": 0, "summaries": 0, "summary_errors": 0}
+
+    def build(self, user_id, history, prompt, window_full=False):
+        """(messages, stats) を返す。
+
+        window_full は履歴が取得件数の上限に達していることを表し、その場合は
+        次回の取得で外れる最も古いやり取り（2件）も要約の対象にする。
+        """
+        system_tokens = self._message_tokens(self._system_prompt)
+        prompt_tokens = self._message_tokens(prompt)
+        digest = None
+        if user_id and self._summarizer is not None:
+            try:
+                digest = self._digest_store.get(user_id)
+            except Exception as e:
+                logger.error(f"Failed to load conversation digest for {user_id}: {e}")
+        digest_message = None
+        digest_tokens = 0
+        if digest:
+            digest_message = {"role": "system", "content": DIGEST_HEADER + digest[0]}
+            digest_tokens = self._message_tokens(digest_message["content"])
+
+        remaining = self._budget - system_tokens - prompt_tokens - digest_tokens - TOKENS_PER_REPLY
+        included = []
+        history_tokens = 0
+        for turn in reversed(history):
+            tokens = self._message_tokens(turn["content"])
+            if tokens > remaining:
+                break
+            included.append(turn)
+            remaining -= tokens
+            history_tokens += tokens
+        included.reverse()
+
+        dropped = history[:len(history) - len(included)]
+        summarize = list(dropped)
+        if window_full:
+            summarize.extend(included[:max(0, 2 - len(dropped))])
+        if summarize and user_id:
+            self._schedule_summary(user_id, digest, summarize)
+
+        messages = [{"role": "system", "content": self._system_prompt}]
+        if digest_message:
+            messages.append(digest_message)
+        messages.extend(included)
+        messages.append({"role": "user", "content": prompt})
+
+        stats = {
+            "system_tokens": system_tokens,
+            "digest_tokens": digest_tokens,
+            "history_tokens": history_tokens,
+            "user_tokens": prompt_tokens,
+            "prompt_tokens": system_tokens + digest_tokens + history_tokens + prompt_tokens + TOKENS_PER_REPLY,
+            "turns_included": len(included),
+            "turns_dropped": len(dropped),
+        }
+        with self._lock:
+            self._totals["requests"] += 1
+            for key in ("prompt_tokens", "history_tokens", "turns_included", "turns_dropped"):
+                self._totals[key] += stats[key]
+        return messages, stats
+
+    def reset(self, user_id):
+        """会話のリセット時に要約も消す。"""
+        if self._summarizer is None:
+            return
+        try:
+            self._digest_store.clear(user_id)
+        except Exception as e:
+            logger.error(f"Failed to clear conversation digest for {user_id}: {e}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._totals)
+        requests = stats["requests"]
+        stats["avg_prompt_tokens"] = stats["prompt_tokens"] / requests if requests else 0.0
+        return stats
+
+    def _message_tokens(self, text):
+        return self._count(text) + TOKENS_PER_MESSAGE
+
+    def _schedule_summary(self, user_id, digest, turns):
+        if self._executor is None:
+            return
+        covered = set(digest[1]) if digest else set()
+        new_turns = [turn for turn in turns if fingerprint(turn) not in covered]
+        if not new_turns:
+            return
+        with self._lock:
+            if user_id in self._pending:
+                return
+            self._pending.add(user_id)
+        # 要約している間に「スタート」でリセットされたら書き戻さない
+        generation = self._digest_store.generation(user_id)
+        self._executor.submit(self._summarize, user_id, digest, new_turns, generation)
+
+    def _summarize(self, user_id, digest, turns, generation):
+        try:
+            previous_summary = digest[0] if digest else ""
+            summary = self._summarizer(previous_summary, turns)
+            covered = list(digest[1]) if digest else []
+            covered.extend(fingerprint(turn) for turn in turns)
+            if not self._digest_store.set(user_id, summary, covered[-MAX_COVERED:], generation):
+                logger.info(f"Discarded conversation summary for {user_id} after a reset")
+                return
+            with self._lock:
+                self._totals["summaries"] += 1
+        except Exception as e:
+            logger.error(f"Failed to summarize conversation for {user_id}: {e}")
+            with self._lock:
+                self._totals["summary_errors"] += 1
+        finally:
+            with self._lock:
+                self._pending.discard(user_id)
@@ -0,0 +1,220 @@
+"""
+利用回数制限（スライディングウィンドウ）
+
+ユーザーごとに直近のシステム応答の時刻を保持し、ウィンドウ内の回数で判定する。
+起動時にDBから作り直し（未読み込みのユーザーはその場でDBから読み込む）、
+システム応答をログに記録するたびに更新するので、判定にDBの集計は不要になる。
+"""
+
+import bisect
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_WINDOW = 24 * 60 * 60
+
+
+@dataclass(frozen=True)
+class QuotaPolicy:
+    """limitがNoneの場合は無制限"""
+    name: str
+    limit: Optional[int]
+
+
+@dataclass(frozen=True)
+class QuotaDecision:
+    allowed: bool
+    used: int
+    limit: Optional[int]
+    # 拒否された場合、次に利用できるようになるまでの秒数
+    retry_after: float = 0.0
+
+
+class MemoryQuotaBackend:
+    """プロセス内でユーザーごとの時刻のソート済みリストを持つバックエンド"""
+
+    def __init__(self, sweep_every=1000):
+        self._times = {}
+        self._loaded = set()
+        self._complete = False
+        self._lock = threading.Lock()
+        self._sweep_every = sweep_every
+        self._operations = 0
+
+    def is_loaded(self, user_id):
+        with self._lock:
+            return self._complete or user_id in self._loaded
+
+    def merge(self, user_id, timestamps):
+        with self._lock:
+            self._merge(user_id, timestamps)
+            self._loaded.add(user_id)
+
+    def merge_all(self, timestamps_by_user):
+        with self._lock:
+            for user_id, timestamps in timestamps_by_user.items():
+                self._merge(user_id, timestamps)
+            self._complete = True
+
+    def add(self, user_id, timestamp):
+        with self._lock:
+            times = self._times.setdefault(user_id, [])
+            if timestamp not in times:
+                bisect.insort(times, timestamp)
+
+    def window(self, user_id, since):
+        """since より後の時刻を古い順に返す。"""
+        with self._lock:
+            times = self._times.get(user_id)
+            if not times:
+                return []
+            del times[:bisect.bisect_right(times, since)]
+            self._operations += 1
+            if self._operations % self._sweep_every == 0:
+                self._sweep(since)
+            return list(times)
+
+    def size(self):
+        with self._lock:
+            return len(self._times)
+
+    def _merge(self, user_id, timestamps):
+        times = self._times.setdefault(user_id, [])
+        times[:] = sorted(set(times).union(timestamps))
+
+    def _sweep(self, since):
+        # 期限切れの時刻しか持たないユーザーを捨てる（全体を読み込み済みなら0回とみなせる）
+        for user_id in [u for u, times in self._times.items() if not times or times[-1] <= since]:
+            del self._times[user_id]
+            self._loaded.discard(user_id)
+
+
+class RedisQuotaBackend:
+    """Redis互換サーバーのソート済みセットに時刻を持つバックエンド（ワーカー間で共有）"""
+
+    def __init__(self, client, window=DEFAULT_WINDOW, prefix="line-bot:quota:"):
+        self._client = client
+        self._window = window
+        self._prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis
+
+        return cls(redis.Redis.from_url(url, decode_responses=True), **kwargs)
+
+    def _key(self, user_id):
+        return f"{self._prefix}{user_id}"
+
+    def is_loaded(self, user_id):
+        return bool(self._client.exists(f"{self._prefix}complete", f"{self._key(user_id)}:loaded"))
+
+    def merge(self, user_id, timestamps):
+        pipe = self._client.pipeline(transaction=True)
+        self._zadd(pipe, user_id, timestamps)
+        pipe.set(f"{self._key(user_id)}:loaded", 1, ex=int(self._window))
+        pipe.execute()
+
+    def merge_all(self, timestamps_by_user):
+        pipe = self._client.pipeline(transaction=False)
+        for user_id, timestamps in timestamps_by_user.items():
+            self._zadd(pipe, user_id, timestamps)
+        pipe.set(f"{self._prefix}complete", 1)
+        pipe.execute()
+
+    def add(self, user_id, timestamp):
+        pipe = self._client.pipeline(transaction=False)
+        self._zadd(pipe, user_id, [timestamp])
+        pipe.execute()
+
+    def window(self, user_id, since):
+        key = self._key(user_id)
+        pipe = self._client.pipeline(transaction=True)
+        pipe.zremrangebyscore(key, "-inf", since)
+        pipe.zrange(key, 0, -1, withscores=True)
+        return [score for _, score in pipe.execute()[1]]
+
+    def size(self):
+        return None
+
+    def _zadd(self, pipe, user_id, timestamps):
+        if not timestamps:
+            return
+        key = self._key(user_id)
+        pipe.zadd(key, {repr(ts): ts for ts in timestamps})
+        pipe.expire(key, int(self._window))
+
+
+class QuotaLimiter:
+    """ポリシーごとの回数制限を判定し、結果を数える
+
+    ウィンドウ（秒）は全ポリシー共通。
+    loader(user_id, since) はDBから since 以降のシステム応答時刻（epoch秒）を返す。
+    """
+
+    def __init__(self, backend, policies, loader, window=DEFAULT_WINDOW, clock=time.time):
+        self._backend = backend
+        self._policies = {policy.name: policy for policy in policies}
+        self.window = window
+        self._loader = loader
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def check(self, user_id, policy_name):
+        policy = self._policies[policy_name]
+        if policy.limit is None:
+            self._count(policy_name, "allowed")
+            return QuotaDecision(True, 0, None)
+
+        now = self._clock()
+        since = now - self.window
+        if not self._backend.is_loaded(user_id):
+            try:
+                self._backend.merge(user_id, self._loader(user_id, since))
+            except Exception as e:
+                # DBに問題がある場合はこれまでどおり利用を許可する
+                logger.error(f"Failed to load quota usage for {user_id}: {e}")
+                self._count(policy_name, "load_errors")
+
+        times = self._backend.window(user_id, since)
+        used = len(times)
+        if used < policy.limit:
+            self._count(policy_name, "allowed")
+            return QuotaDecision(True, used, policy.limit)
+
+        # ウィンドウ内で limit 番目に新しい応答が期限切れになれば再び利用できる
+        retry_after = max(0.0, times[used - policy.limit] + self.window - now)
+        self._count(policy_name, "denied")
+        return QuotaDecision(False, used, policy.limit, retry_after)
+
+    def is_loaded(self, user_id):
+        return self._backend.is_loaded(user_id)
+
+    def prime(self, user_id, timestamps):
+        """他のデータとまとめてDBから読み込んだ応答時刻を入れる（loaderの代わり）。"""
+        self._backend.merge(user_id, timestamps)
+
+    def record(self, user_id, timestamp=None):
+        """システム応答を記録する。"""
+        self._backend.add(user_id, self._clock() if timestamp is None else timestamp)
+
+    def warm(self, timestamps_by_user):
+        """起動時にDBから読み込んだ全ユーザーの応答時刻で作り直す。"""
+        self._backend.merge_all(timestamps_by_user)
+
+    def stats(self):
+        with self._lock:
+            stats = {f"{policy}_{outcome}": count for (policy, outcome), count in self._counters.items()}
+        stats["tracked_users"] = self._backend.size()
+        return stats
+
+    def _count(self, policy_name, outcome):
+        with self._lock:
+            key = (policy_name, outcome)
+            self._counters[key] = self._counters.get(key, 0) + 1
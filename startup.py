@@ -0,0 +1,201 @@
+"""
+起動時の初期化とヘルスチェック
+
+ワーカーの起動（Herokuのdynoの再起動やスケールアウト）の直後のリクエストが、重いモジュールの
+importやDB接続の確立を待たされないよう、
+
+  - 起動時に使わないモジュール（stripe など）は LazyModule で最初に使うときに import する
+  - DB接続プール・外部APIへのkeep-alive接続・キャッシュは Startup がバックグラウンドで温める
+
+ようにし、温め終わるまでは /readyz が503を返す。必須の環境変数がない場合もimportで落とさず、
+/readyz にない変数の名前を出す。
+"""
+
+import asyncio
+import importlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+OK = "ok"
+FAILED = "failed"
+
+
+class LazyModule:
+    """最初に属性を参照したときに import するモジュール（configure は import したモジュールを受け取って設定する）"""
+
+    def __init__(self, name, configure=None):
+        self._name = name
+        self._configure = configure
+        self._module = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    module = importlib.import_module(self._name)
+                    if self._configure:
+                        self._configure(module)
+                    self._module = module
+        return self._module
+
+    async def load_async(self):
+        """load のasyncio版。まだ読み込んでいなければイベントループを止めないようスレッドで import する。"""
+        if self._module is None:
+            await asyncio.to_thread(self.load)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+
+def warm_http(session, url, connections=1, timeout=(3.05, 5)):
+    """url のホストへの接続を connections 本開いてSessionのプールに入れ、開けた数を返す。
+
+    接続を並行して開くために同時にHEADを送る（応答のステータスは問わない）。
+    """
+    def open_connection(_):
+        response = session.head(url, timeout=timeout, allow_redirects=False)
+        response.close()
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        list(executor.map(open_connection, range(connections)))
+    return connections
+
+
+class Startup:
+    """起動時の初期化の進み具合と依存先の状態
+
+    step() で登録した処理を start() でバックグラウンドのスレッドで順に実行する。
+    required の処理がすべて成功し、必須の環境変数がそろうと ready になる。
+    失敗した required の処理は retry_interval 秒ごとにやり直す（起動時にDBが一時的に落ちていた場合など）。
+    """
+
+    def __init__(self, retry_interval=5.0, clock=time.monotonic, sleep=time.sleep):
+        self._retry_interval = retry_interval
+        self._clock = clock
+        self._sleep = sleep
+        self._started_at = clock()
+        self._steps = []
+        self._states = OrderedDict()
+        self._probes = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._done = threading.Event()
+        self.missing_env = []
+
+    def require_env(self, *names, environ=None):
+        """必須の環境変数を {名前: 値} で返す。ない変数は空文字にし、missing_env に記録する。"""
+        environ = os.environ if environ is None else environ
+        values = {}
+        for name in names:
+            value = environ.get(name)
+            if not value:
+                self.missing_env.append(name)
+                logger.error(f"Required environment variable {name} is not set")
+            values[name] = value or ""
+        return values
+
+    def step(self, name, function, required=True):
+        """start() で実行する処理を登録する。"""
+        self._steps.append((name, function, required))
+        with self._lock:
+            self._states[name] = {"state": PENDING, "required": required}
+
+    def probe(self, name, function):
+        """/readyz で毎回呼ぶ依存先の状態（dictなど）を登録する（ready の判定には使わない）。"""
+        self._probes[name] = function
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.run, name="startup", daemon=True)
+        self._thread.start()
+
+    def run(self, max_rounds=None):
+        """登録した処理を順に実行し（失敗しても次の処理に進む）、失敗した required の処理をやり直す。"""
+        steps = list(self._steps)
+        rounds = 0
+        while steps:
+            failed = [(name, function, required) for name, function, required in steps
+                      if not self._run_step(name, function, required) and required]
+            rounds += 1
+            if not self._done.is_set():
+                logger.info(f"Startup finished in {self._clock() - self._started_at:.2f}s (ready={self.ready})")
+                self._done.set()
+            if not failed or (max_rounds is not None and rounds >= max_rounds):
+                break
+            self._sleep(self._retry_interval)
+            steps = failed
+
+    def _run_step(self, name, function, required):
+        try:
+            with self.track(name, required):
+                function()
+        except Exception:
+            return False
+        return True
+
+    @contextmanager
+    def track(self, name, required=True):
+        """with の中の処理を name の処理として記録する（asyncio版で await する処理など）。例外はそのまま送出する。"""
+        with self._lock:
+            self._states.setdefault(name, {"state": PENDING, "required": required})
+        started = self._clock()
+        try:
+            yield
+        except Exception as e:
+            log = logger.error if required else logger.warning
+            log(f"Startup step {name} failed: {e}")
+            self._record(name, FAILED, started, error=str(e))
+            raise
+        self._record(name, OK, started)
+
+    def wait(self, timeout=None):
+        """最初の1回の実行が終わるまで待つ。"""
+        return self._done.wait(timeout)
+
+    @property
+    def ready(self):
+        if self.missing_env:
+            return False
+        with self._lock:
+            return all(state["state"] == OK for state in self._states.values() if state["required"])
+
+    def status(self):
+        with self._lock:
+            steps = {name: dict(state) for name, state in self._states.items()}
+        dependencies = {}
+        for name, function in self._probes.items():
+            try:
+                dependencies[name] = function()
+            except Exception as e:
+                dependencies[name] = {"error": str(e)}
+        return {
+            "ready": self.ready,
+            "uptime": round(self._clock() - self._started_at, 3),
+            "missing_env": list(self.missing_env),
+            "steps": steps,
+            "dependencies": dependencies,
+        }
+
+    def _record(self, name, state, started, error=None):
+        with self._lock:
+            entry = self._states[name]
+            entry["state"] = state
+            entry["seconds"] = round(self._clock() - started, 3)
+            entry.pop("error", None)
+            if error is not None:
+                entry["error"] = error
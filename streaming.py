@@ -0,0 +1,194 @@
+"""
+GPT応答のストリーミング配信
+
+Chat CompletionsのSSEストリームを文の区切りで切り、最初の文ができた時点で
+reply tokenで返信し、残りはpushメッセージで送る。
+1回の応答で送るメッセージはLINEの上限（5件）を超えない。
+"""
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# LINEで1回の応答として送るメッセージ数の上限
+LINE_MAX_MESSAGES = 5
+
+# 文の区切りとみなす文字
+SENTENCE_ENDINGS = "。！？!?．\n"
+
+
+# ストリームの終わり（data: [DONE]）を表す値
+SSE_DONE = object()
+
+
+def parse_sse_line(line, on_usage=None):
+    """SSEの1行（bytesまたはstr）を解釈し、choices[0].delta.content（なければNone）を返す。
+
+    data: [DONE] の場合は SSE_DONE を返す。
+    stream_options.include_usage を指定した場合の最後のチャンクの usage は on_usage(usage) に渡す。
+    """
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    line = line.strip()
+    if not line.startswith("data:"):
+        return None
+    payload = line[len("data:"):].strip()
+    if payload == "[DONE]":
+        return SSE_DONE
+    chunk = json.loads(payload)
+    if on_usage is not None and chunk.get("usage"):
+        on_usage(chunk["usage"])
+    choices = chunk.get("choices") or []
+    if not choices:
+        return None
+    return (choices[0].get("delta") or {}).get("content") or None
+
+
+def iter_sse_deltas(lines, on_usage=None):
+    """SSEの行からchoices[0].delta.contentを順に取り出す。"""
+    for line in lines:
+        content = parse_sse_line(line, on_usage)
+        if content is SSE_DONE:
+            return
+        if content:
+            yield content
+
+
+async def aiter_sse_deltas(lines, on_usage=None):
+    """iter_sse_deltas のasyncio版（lines は aiohttp の response.content などの非同期イテレータ）"""
+    async for line in lines:
+        content = parse_sse_line(line, on_usage)
+        if content is SSE_DONE:
+            return
+        if content:
+            yield content
+
+
+class SentenceChunker:
+    """トークン列を受け取り、文の区切りごとに完成した文を返す"""
+
+    def __init__(self, endings=SENTENCE_ENDINGS):
+        self._endings = endings
+        self._buffer = ""
+
+    def feed(self, text):
+        self._buffer += text
+        sentences = []
+        start = 0
+        for i, char in enumerate(self._buffer):
+            if char in self._endings:
+                sentences.append(self._buffer[start:i + 1])
+                start = i + 1
+        self._buffer = self._buffer[start:]
+        return sentences
+
+    def flush(self):
+        rest, self._buffer = self._buffer, ""
+        return rest if rest.strip() else None
+
+
+class StreamAssembler:
+    """差分を受け取り、送るべきメッセージを返す（送信はしない）
+
+    最初の文ができた時点で1件目を返し、以降は push_min_chars 以上たまるごとに返す。
+    最後の1件は残りの全文用に取っておくので、返すメッセージは max_messages 件を超えない。
+    """
+
+    def __init__(self, max_messages=LINE_MAX_MESSAGES, push_min_chars=60):
+        self._max_messages = max_messages
+        self._push_min_chars = push_min_chars
+        self._chunker = SentenceChunker()
+        self._parts = []
+        self._pending = ""
+        self.sent = 0
+
+    @property
+    def text(self):
+        """受け取った全文"""
+        return "".join(self._parts).strip()
+
+    def feed(self, delta):
+        self._parts.append(delta)
+        messages = []
+        for sentence in self._chunker.feed(delta):
+            if self.sent == 0 and sentence.strip():
+                messages.extend(self._emit(self._pending + sentence))
+                self._pending = ""
+                continue
+            self._pending += sentence
+            if len(self._pending) >= self._push_min_chars and self.sent < self._max_messages - 1:
+                messages.extend(self._emit(self._pending))
+                self._pending = ""
+        return messages
+
+    def finish(self):
+        rest = self._chunker.flush()
+        if rest:
+            self._pending += rest
+        messages = self._emit(self._pending)
+        self._pending = ""
+        return messages
+
+    def _emit(self, text):
+        text = text.strip()
+        if not text:
+            return []
+        self.sent += 1
+        return [text]
+
+
+def deliver_stream(deltas, send_reply, send_push, max_messages=LINE_MAX_MESSAGES, push_min_chars=60):
+    """ストリームを文単位で返信・pushし、組み立てた全文を返す。
+
+    send_reply(text) は最初の1件だけ、send_push(text) は2件目以降に使う。
+    最初の返信前にストリームが失敗した（または空だった）場合は例外を送出するので、
+    呼び出し側はreply tokenでフォールバックの文言を返せる。
+    """
+    assembler = StreamAssembler(max_messages, push_min_chars)
+    delivered = 0
+
+    def send(messages):
+        nonlocal delivered
+        for text in messages:
+            (send_reply if delivered == 0 else send_push)(text)
+            delivered += 1
+
+    try:
+        for delta in deltas:
+            send(assembler.feed(delta))
+    except Exception as e:
+        if delivered == 0:
+            raise
+        # 返信済みの場合は、受け取れた分だけを送って終える
+        logger.error(f"Streaming response interrupted after {delivered} messages: {e}")
+
+    send(assembler.finish())
+    if delivered == 0:
+        raise ValueError("Empty response stream")
+    return assembler.text
+
+
+async def deliver_stream_async(deltas, send_reply, send_push, max_messages=LINE_MAX_MESSAGES, push_min_chars=60):
+    """deliver_stream のasyncio版。deltas は非同期イテレータ、send_reply/send_push はコルーチン関数。"""
+    assembler = StreamAssembler(max_messages, push_min_chars)
+    delivered = 0
+
+    async def send(messages):
+        nonlocal delivered
+        for text in messages:
+            await (send_reply if delivered == 0 else send_push)(text)
+            delivered += 1
+
+    try:
+        async for delta in deltas:
+            await send(assembler.feed(delta))
+    except Exception as e:
+        if delivered == 0:
+            raise
+        logger.error(f"Streaming response interrupted after {delivered} messages: {e}")
+
+    await send(assembler.finish())
+    if delivered == 0:
+        raise ValueError("Empty response stream")
+    return assembler.text
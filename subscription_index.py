@@ -0,0 +1,320 @@
+"""
+Stripeサブスクリプションのローカルインデックス
+
+LINEユーザーIDをキーにサブスクリプション状態をPostgresへ保存し、
+その前段にプロセス内のTTLキャッシュを置く。
+インデックスはStripeの一括同期（auto_paging_iterによるページング）で構築し、
+Stripe Webhookで随時更新する。
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS stripe_subscriptions (
+    line_user_id VARCHAR(50) PRIMARY KEY,
+    subscription_id VARCHAR(255) NOT NULL,
+    stripe_customer_id VARCHAR(255),
+    price_id VARCHAR(255),
+    status VARCHAR(32) NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+"""
+
+# Webhookで受け取るサブスクリプション関連イベント
+SUBSCRIPTION_EVENT_TYPES = (
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+    "customer.subscription.paused",
+    "customer.subscription.resumed",
+)
+
+# 同じユーザーに複数のサブスクリプションがある場合の優先順位
+_STATUS_RANK = {"active": 2, "trialing": 1}
+
+# キャッシュ上で「サブスクリプションなし」を表す値
+_MISSING = object()
+
+
+def subscription_to_row(subscription, price_id):
+    """StripeのSubscriptionオブジェクトをインデックスの行に変換する。
+
+    対象の価格IDでない、またはline_userメタデータがない場合はNoneを返す。
+    """
+    items = subscription["items"]["data"]
+    if not items or items[0]["price"]["id"] != price_id:
+        return None
+    line_user = (subscription.get("metadata") or {}).get("line_user")
+    if not line_user:
+        return None
+    return {
+        "line_user_id": line_user,
+        "subscription_id": subscription["id"],
+        "stripe_customer_id": subscription["customer"],
+        "price_id": price_id,
+        "status": subscription["status"],
+    }
+
+
+def should_replace(current, row):
+    """既存の行をrowで置き換えるべきか判定する。"""
+    if current is None or current["subscription_id"] == row["subscription_id"]:
+        return True
+    return _STATUS_RANK.get(row["status"], 0) >= _STATUS_RANK.get(current["status"], 0)
+
+
+def latest_rows(subscriptions, price_id):
+    """一覧（新しい順）のSubscriptionから、ユーザーごとに優先する行を選ぶ。
+
+    (行の辞書 {line_user_id: row}, 走査した件数) を返す。
+    """
+    rows = {}
+    scanned = 0
+    for subscription in subscriptions:
+        scanned += 1
+        row = subscription_to_row(subscription, price_id)
+        if row is None:
+            continue
+        # 同順位なら先に見つかったもの（新しいもの）を優先する
+        current = rows.get(row["line_user_id"])
+        if current is None or _STATUS_RANK.get(row["status"], 0) > _STATUS_RANK.get(current["status"], 0):
+            rows[row["line_user_id"]] = row
+    return rows, scanned
+
+
+class PostgresSubscriptionStore:
+    """stripe_subscriptionsテーブルへの読み書き"""
+
+    def __init__(self, get_connection, put_connection, batch_size=500):
+        self._get_connection = get_connection
+        self._put_connection = put_connection
+        self._batch_size = batch_size
+
+    def fetch(self, line_user_id):
+        with stage("db.subscription"):
+            connection = self._get_connection()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        """
+                        SELECT line_user_id, subscription_id, stripe_customer_id, price_id, status
+                        FROM stripe_subscriptions WHERE line_user_id=%s;
+                        """,
+                        (line_user_id,),
+                    )
+                    result = cursor.fetchone()
+            finally:
+                self._put_connection(connection)
+        if result is None:
+            return None
+        keys = ("line_user_id", "subscription_id", "stripe_customer_id", "price_id", "status")
+        return dict(zip(keys, result))
+
+    def fetch_many(self, line_user_ids):
+        """{LINEユーザーID: 行} を返す（行がないユーザーは含まない）。"""
+        rows = {}
+        keys = ("line_user_id", "subscription_id", "stripe_customer_id", "price_id", "status")
+        connection = self._get_connection()
+        try:
+            with connection.cursor() as cursor:
+                for start in range(0, len(line_user_ids), self._batch_size):
+                    cursor.execute(
+                        """
+                        SELECT line_user_id, subscription_id, stripe_customer_id, price_id, status
+                        FROM stripe_subscriptions WHERE line_user_id = ANY(%s);
+                        """,
+                        (list(line_user_ids[start:start + self._batch_size]),),
+                    )
+                    for result in cursor.fetchall():
+                        rows[result[0]] = dict(zip(keys, result))
+            connection.commit()
+        finally:
+            self._put_connection(connection)
+        return rows
+
+    def upsert_many(self, rows):
+        from psycopg2.extras import execute_values
+
+        connection = self._get_connection()
+        try:
+            with connection.cursor() as cursor:
+                for start in range(0, len(rows), self._batch_size):
+                    batch = rows[start:start + self._batch_size]
+                    execute_values(
+                        cursor,
+                        """
+                        INSERT INTO stripe_subscriptions
+                            (line_user_id, subscription_id, stripe_customer_id, price_id, status)
+                        VALUES %s
+                        ON CONFLICT (line_user_id) DO UPDATE SET
+                            subscription_id = EXCLUDED.subscription_id,
+                            stripe_customer_id = EXCLUDED.stripe_customer_id,
+                            price_id = EXCLUDED.price_id,
+                            status = EXCLUDED.status,
+                            updated_at = NOW();
+                        """,
+                        [
+                            (r["line_user_id"], r["subscription_id"], r["stripe_customer_id"],
+                             r["price_id"], r["status"])
+                            for r in batch
+                        ],
+                    )
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            self._put_connection(connection)
+
+
+class SubscriptionIndex:
+    """LINEユーザーID -> サブスクリプション状態 のインデックス
+
+    lookupはTTLキャッシュ、なければストア（Postgres）の1行参照のみで、
+    Stripe APIは呼ばない。
+    """
+
+    def __init__(self, store, stripe_client, price_id, ttl=300, max_entries=10000):
+        self._store = store
+        self._stripe = stripe_client
+        self._price_id = price_id
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._sync_thread = None
+        self.last_synced_at = None
+
+    def lookup(self, line_user_id):
+        """{'status', 'stripeId'} を返す。サブスクリプションがなければNone。"""
+        hit, details = self.cached(line_user_id)
+        if hit:
+            return details
+        try:
+            row = self._store.fetch(line_user_id)
+        except Exception as e:
+            # DBに問題がある場合は応答を止めず、期限切れのキャッシュか無料ユーザーとして扱う（キャッシュはしない）
+            logger.error(f"Failed to fetch subscription for {line_user_id}: {e}")
+            return self.stale(line_user_id)
+        return self.prime(line_user_id, row)
+
+    async def lookup_async(self, line_user_id, fetch):
+        """lookup のasyncio版。ストアの代わりに fetch(line_user_id)（行かNoneを返すコルーチン関数）で読む。"""
+        hit, details = self.cached(line_user_id)
+        if hit:
+            return details
+        try:
+            with stage("db.subscription"):
+                row = await fetch(line_user_id)
+        except Exception as e:
+            logger.error(f"Failed to fetch subscription for {line_user_id}: {e}")
+            return self.stale(line_user_id)
+        return self.prime(line_user_id, row)
+
+    def cached(self, line_user_id):
+        """キャッシュにあれば (True, 状態)、なければ（期限切れを含む） (False, None) を返す。ストアは読まない。"""
+        with self._lock:
+            entry = self._cache.get(line_user_id)
+            if entry is None or entry[0] <= time.monotonic():
+                return False, None
+            self._cache.move_to_end(line_user_id)
+            row = entry[1]
+        return True, (None if row is _MISSING else _to_details(row))
+
+    def stale(self, line_user_id):
+        """期限切れでもキャッシュに残っている状態を返す（ストアが読めないとき用）。なければNone。"""
+        with self._lock:
+            entry = self._cache.get(line_user_id)
+        if entry is None or entry[1] is _MISSING:
+            return None
+        return _to_details(entry[1])
+
+    def is_cached(self, line_user_id):
+        with self._lock:
+            entry = self._cache.get(line_user_id)
+            return entry is not None and entry[0] > time.monotonic()
+
+    def prime(self, line_user_id, row):
+        """他のデータとまとめてストアから読み込んだ行（なければNone）をキャッシュに入れ、その状態を返す。"""
+        self._remember(line_user_id, row)
+        return _to_details(row) if row else None
+
+    def warm(self, line_user_ids):
+        """最近のユーザー（最大 max_entries 人）の行をまとめて読み込み、キャッシュに入れる。"""
+        line_user_ids = list(line_user_ids)[:self._max_entries]
+        rows = self._store.fetch_many(line_user_ids) if line_user_ids else {}
+        for line_user_id in line_user_ids:
+            self._remember(line_user_id, rows.get(line_user_id))
+        return len(line_user_ids)
+
+    def invalidate(self, line_user_id=None):
+        with self._lock:
+            if line_user_id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(line_user_id, None)
+
+    def sync(self):
+        """Stripeの全サブスクリプションをページングで取得し、インデックスを作り直す。"""
+        started = time.monotonic()
+        subscriptions = self._stripe.Subscription.list(limit=100, status="all")
+        rows, scanned = latest_rows(subscriptions.auto_paging_iter(), self._price_id)
+
+        self._store.upsert_many(list(rows.values()))
+        for line_user_id, row in rows.items():
+            self._remember(line_user_id, row)
+        self.last_synced_at = time.time()
+        logger.info(
+            f"Subscription index synced: {len(rows)} users from {scanned} subscriptions "
+            f"in {time.monotonic() - started:.2f}s"
+        )
+        return len(rows)
+
+    def apply_subscription(self, subscription):
+        """Webhookで受け取ったSubscriptionをインデックスに反映する。"""
+        row = subscription_to_row(subscription, self._price_id)
+        if row is None:
+            return False
+        current = self._store.fetch(row["line_user_id"])
+        if not should_replace(current, row):
+            return False
+        self._store.upsert_many([row])
+        self._remember(row["line_user_id"], row)
+        return True
+
+    def start_periodic_sync(self, interval):
+        """バックグラウンドで interval 秒ごとに一括同期する（Webhook取りこぼしの保険）。
+
+        起動時の最初の同期は呼び出し側が sync() で行う（テーブルはマイグレーションで作る）。
+        """
+        if self._sync_thread is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sync()
+                except Exception as e:
+                    logger.error(f"Subscription index sync failed: {e}")
+
+        self._sync_thread = threading.Thread(target=run, name="subscription-sync", daemon=True)
+        self._sync_thread.start()
+
+    def _remember(self, line_user_id, row):
+        with self._lock:
+            self._cache[line_user_id] = (time.monotonic() + self._ttl, row or _MISSING)
+            self._cache.move_to_end(line_user_id)
+            while len(self._cache) > self._max_entries:
+                self._cache.popitem(last=False)
+
+
+def _to_details(row):
+    return {"status": row["status"], "stripeId": row["stripe_customer_id"]}
@@ -0,0 +1,44 @@
+"""
+asyncio版サーバーの補助関数のテスト（aiohttp・asyncpg がない環境ではスキップ）
+"""
+
+import time
+
+import pytest
+
+pytest.importorskip("aiohttp")
+pytest.importorskip("asyncpg")
+
+from async_app import RecentEventIds, pool_params_from_env, server_settings_from_pgoptions  # noqa: E402
+
+
+def test_server_settings_from_pgoptions():
+    assert server_settings_from_pgoptions("-c search_path=bench_load") == {"search_path": "bench_load"}
+    assert server_settings_from_pgoptions("-c statement_timeout=5000 -c 'application_name=line bot'") == {
+        "statement_timeout": "5000", "application_name": "line bot",
+    }
+    assert server_settings_from_pgoptions(None) == {}
+
+
+def test_pool_params_from_env(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "postgresql://localhost/linebot")
+    assert pool_params_from_env() == {"dsn": "postgresql://localhost/linebot"}
+    monkeypatch.delenv("DATABASE_URL")
+    for key, value in (("DB_HOST", "db"), ("DB_NAME", "linebot"), ("DB_USER", "bot"), ("DB_PASS", "secret")):
+        monkeypatch.setenv(key, value)
+    assert pool_params_from_env() == {"host": "db", "port": 5432, "database": "linebot", "user": "bot",
+                                      "password": "secret"}
+
+
+def test_recent_event_ids_drop_redeliveries_until_ttl():
+    seen = RecentEventIds(ttl=0.05)
+    assert seen.add("E1")
+    assert not seen.add("E1")
+    assert seen.add("E2")
+
+    time.sleep(0.06)
+    assert seen.add("E1")
+
+    # 受け付けなかったイベントは再送を処理できる
+    seen.discard("E2")
+    assert seen.add("E2")
@@ -0,0 +1,108 @@
+"""
+asyncio版の外部API呼び出しのテスト（aiohttp がない環境ではスキップ）
+同期版と同じ疑似OpenAIサーバーに対して、リトライ・サーキットブレーカー・接続の使い回しを確認する
+"""
+
+import asyncio
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from async_clients import AsyncLLMClient  # noqa: E402
+from llm_client import CircuitBreaker, CircuitOpenError  # noqa: E402
+from test_llm_client import server  # noqa: E402,F401
+
+
+def run_client(server, calls, **kwargs):
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+
+    async def run():
+        client = AsyncLLMClient("key", base_url=server.url, sleep=sleep, read_timeout=1.0, **kwargs)
+        await client.start()
+        try:
+            return [await call(client) for call in calls], client
+        finally:
+            await client.close()
+
+    results, client = asyncio.run(run())
+    return results, client, sleeps
+
+
+def chat(client):
+    return client.chat([{"role": "user", "content": "hi"}])
+
+
+def test_retries_on_5xx_and_honors_retry_after(server):
+    server.script = [(503, {"Retry-After": "0.5"}, 0), (500, {}, 0)]
+    (reply,), client, sleeps = run_client(server, [chat], max_retries=2, backoff=0.1)
+    assert reply == "ok"
+    assert server.requests == 3
+    assert sleeps[0] == 0.5
+    assert client.stats()["retries"] == 2
+
+
+def test_client_errors_are_not_retried(server):
+    server.script = [(400, {}, 0)]
+
+    async def failing_chat(client):
+        with pytest.raises(aiohttp.ClientResponseError):
+            await chat(client)
+
+    run_client(server, [failing_chat], max_retries=2)
+    assert server.requests == 1
+
+
+def test_circuit_opens_and_short_circuits(server):
+    server.script = [(500, {}, 0)] * 2
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+
+    async def failing_chat(client):
+        with pytest.raises(aiohttp.ClientResponseError):
+            await chat(client)
+
+    async def short_circuited_chat(client):
+        with pytest.raises(CircuitOpenError):
+            await chat(client)
+
+    run_client(server, [failing_chat, short_circuited_chat], max_retries=1, backoff=0, breaker=breaker)
+    assert server.requests == 2
+
+
+def test_connections_are_reused(server):
+    run_client(server, [chat] * 5)
+    assert server.requests == 5
+    assert len(server.connections) == 1
+
+
+def test_half_open_trial_is_released_on_unexpected_error_and_cancellation():
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=lambda: now[0])
+
+    class Session:
+        def __init__(self, error):
+            self.error = error
+
+        async def post(self, *args, **kwargs):
+            raise self.error
+
+    async def run():
+        client = AsyncLLMClient("key", session=Session(aiohttp.ClientPayloadError("broken")), breaker=breaker,
+                                max_retries=0)
+        breaker.record_failure()
+        now[0] = 31
+        with pytest.raises(aiohttp.ClientPayloadError):
+            await chat(client)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        # 取り消された試行も残らない
+        now[0] = 62
+        client.session = Session(asyncio.CancelledError())
+        with pytest.raises(asyncio.CancelledError):
+            await chat(client)
+        assert breaker.allow()
+
+    asyncio.run(run())
@@ -0,0 +1,157 @@
+"""
+line_bot_logs のアーカイブと圧縮のテスト
+DBを使うテストは DATABASE_URL のPostgres上に専用スキーマを作って実行する（未設定の場合はスキップ）
+"""
+
+import datetime
+import gzip
+import json
+import os
+
+import pytest
+
+from compaction import ArchiveRun, LogCompactor, RateLimiter, read_chunk, relation_size
+
+SCHEMA = "test_compaction"
+needs_database = pytest.mark.skipif(not os.environ.get("DATABASE_URL"), reason="DATABASE_URL is not set")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_rate_limiter_keeps_rows_per_second():
+    clock = FakeClock()
+    limiter = RateLimiter(100, clock=clock, sleep=clock.sleep)
+    assert limiter.wait(50) == pytest.approx(0.5)
+    clock.now += 1.0
+    # 処理に時間がかかった分は待たない
+    assert limiter.wait(50) == 0.0
+    assert limiter.wait(100) == pytest.approx(0.5)
+    assert RateLimiter(0, clock=clock, sleep=clock.sleep).wait(10 ** 6) == 0.0
+
+
+@pytest.fixture
+def database():
+    psycopg2 = pytest.importorskip("psycopg2")
+    import migrations
+
+    connection = psycopg2.connect(os.environ["DATABASE_URL"], options=f"-c search_path={SCHEMA}")
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA};")
+    connection.commit()
+    migrations.run_migrations(connection)
+    yield connection
+    connection.rollback()
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+    connection.commit()
+    connection.close()
+
+
+NOW = datetime.datetime(2024, 6, 1, 12, 0)
+
+
+def seed(connection):
+    rows = [
+        # 保持期間より古い行はすべて対象
+        (NOW - datetime.timedelta(days=200), "user", "U1", "old", True),
+        (NOW - datetime.timedelta(days=200), "system", "U1", "old reply", True),
+        # 無効な行は回数制限のウィンドウより古ければ対象
+        (NOW - datetime.timedelta(days=3), "user", "U2", "inactive", False),
+        (NOW - datetime.timedelta(hours=1), "system", "U2", "inactive in window", False),
+        # リセットより前の行
+        (NOW - datetime.timedelta(days=3), "user", "U3", "before reset", True),
+        (NOW - datetime.timedelta(days=1, hours=1), "user", "U3", "after reset", True),
+        (NOW - datetime.timedelta(days=2), "user", "U4", "active", True),
+    ]
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO line_bot_logs (timestamp, sender, lineId, message, is_active, sys_prompt) "
+            "VALUES (%s, %s, %s, %s, %s, 'prompt');",
+            rows,
+        )
+        cursor.execute("INSERT INTO conversation_resets (line_id, reset_at) VALUES ('U3', %s);",
+                       (NOW - datetime.timedelta(days=2),))
+    connection.commit()
+
+
+def remaining_messages(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT message FROM line_bot_logs ORDER BY id;")
+        messages = [row[0] for row in cursor.fetchall()]
+    connection.commit()
+    return messages
+
+
+def archived_messages(run):
+    messages = []
+    for chunk in run.manifest["chunks"]:
+        with gzip.open(os.path.join(run.path, chunk["file"]), "rt", encoding="utf-8") as f:
+            messages += [json.loads(line)["message"] for line in f]
+    return messages
+
+
+def create_run(tmp_path):
+    return ArchiveRun.create(str(tmp_path), retain_before=NOW - datetime.timedelta(days=180),
+                             inactive_before=NOW - datetime.timedelta(days=1))
+
+
+@needs_database
+def test_compaction_archives_rows_the_bot_no_longer_reads(database, tmp_path):
+    seed(database)
+    size_before = relation_size(database)
+    run = create_run(tmp_path)
+    compactor = LogCompactor(database, run, chunk_size=2, fetch_size=1, pause=0)
+    report = compactor.compact()
+
+    assert remaining_messages(database) == ["inactive in window", "after reset", "active"]
+    assert archived_messages(run) == ["old", "old reply", "inactive", "before reset"]
+    assert report["rows"] == 4 and report["chunks"] == 2
+    assert report["row_bytes"] > 0 and report["archive_bytes"] > 0
+    assert size_before > 0
+    # チャンクのファイルには行の大きさも記録する
+    chunk = os.path.join(run.path, run.manifest["chunks"][0]["file"])
+    assert [size > 0 for _, size in read_chunk(chunk)] == [True, True]
+
+
+@needs_database
+def test_compaction_resumes_and_adopts_committed_chunk(database, tmp_path):
+    seed(database)
+    run = create_run(tmp_path)
+    compactor = LogCompactor(database, run, chunk_size=2, pause=0)
+    assert compactor.compact(max_chunks=1)["rows"] == 2
+
+    # 削除をコミットした後、manifest に載せる前に中断した場合
+    run.manifest["chunks"].pop()
+    run.save()
+    resumed = ArchiveRun.latest_unfinished(str(tmp_path))
+    assert resumed.path == run.path and resumed.last_id == 0
+    report = LogCompactor(database, resumed, chunk_size=2, pause=0).compact()
+    assert report["adopted_chunks"] == 1
+    assert archived_messages(resumed) == ["old", "old reply", "inactive", "before reset"]
+    assert remaining_messages(database) == ["inactive in window", "after reset", "active"]
+
+    resumed.finish(report)
+    assert ArchiveRun.latest_unfinished(str(tmp_path)) is None
+
+
+@needs_database
+def test_rolled_back_chunk_is_rewritten(database, tmp_path):
+    seed(database)
+    run = create_run(tmp_path)
+    # 書き出したが削除がコミットされなかったチャンク
+    with gzip.open(run.next_chunk_path(), "wt", encoding="utf-8") as f:
+        f.write(json.dumps({"id": 1, "_bytes": 10}) + "\n")
+    report = LogCompactor(database, run, chunk_size=10, pause=0).compact()
+    assert report["adopted_chunks"] == 0
+    assert archived_messages(run) == ["old", "old reply", "inactive", "before reset"]
@@ -0,0 +1,213 @@
+"""
+データアクセス層のテスト
+ConversationStore は DATABASE_URL のPostgres上に専用スキーマを作って実行する（未設定の場合はスキップ）
+"""
+
+import datetime
+import os
+import time
+
+import pytest
+
+from data_access import CONTEXT_SQL, ContextPrefetcher, MessageContext, context_from_rows, numbered_query
+from history_cache import HistoryCache, MemoryHistoryBackend
+from quota import MemoryQuotaBackend, QuotaLimiter, QuotaPolicy
+
+SCHEMA = "test_data_access"
+needs_database = pytest.mark.skipif(not os.environ.get("DATABASE_URL"), reason="DATABASE_URL is not set")
+
+
+class FakeStore:
+    def __init__(self, context=None, error=None):
+        self.context = context or MessageContext()
+        self.error = error
+        self.calls = []
+
+    def load_context(self, line_id, since=None, history=True, reply_times=True, subscription=True):
+        self.calls.append((history, reply_times, subscription))
+        if self.error:
+            raise self.error
+        return self.context
+
+
+class FakeSubscriptionIndex:
+    def __init__(self):
+        self.rows = {}
+
+    def is_cached(self, line_id):
+        return line_id in self.rows
+
+    def prime(self, line_id, row):
+        self.rows[line_id] = row
+
+
+def make_prefetcher(store):
+    history_cache = HistoryCache(MemoryHistoryBackend())
+    quota_limiter = QuotaLimiter(MemoryQuotaBackend(), [QuotaPolicy("free", 5)], loader=None)
+    subscription_index = FakeSubscriptionIndex()
+    prefetcher = ContextPrefetcher(store, history_cache, quota_limiter, subscription_index)
+    return prefetcher, history_cache, quota_limiter, subscription_index
+
+
+def test_prefetch_loads_cold_items_once_and_skips_warm_users():
+    now = time.time()
+    store = FakeStore(MessageContext(
+        history=[{"role": "user", "content": "hi"}],
+        reply_times=[now - 10],
+        subscription=None,
+        subscription_loaded=True,
+    ))
+    prefetcher, history_cache, quota_limiter, subscription_index = make_prefetcher(store)
+
+    prefetcher.prefetch("U1")
+    assert store.calls == [(True, True, True)]
+    assert history_cache.get("U1", loader=None) == [{"role": "user", "content": "hi"}]
+    assert quota_limiter.check("U1", "free").used == 1
+    assert subscription_index.rows == {"U1": None}
+
+    prefetcher.prefetch("U1")
+    assert len(store.calls) == 1
+    assert prefetcher.stats() == {"prefetches": 1, "skipped": 1, "errors": 0}
+
+
+def test_prefetch_only_requests_missing_items():
+    store = FakeStore(MessageContext(reply_times=[]))
+    prefetcher, history_cache, _, subscription_index = make_prefetcher(store)
+    history_cache.prime("U1", [])
+    subscription_index.prime("U1", None)
+
+    prefetcher.prefetch("U1")
+    assert store.calls == [(False, True, False)]
+
+
+def test_prefetch_errors_fall_back_to_lazy_loading():
+    prefetcher, history_cache, quota_limiter, _ = make_prefetcher(FakeStore(error=RuntimeError("db down")))
+    assert prefetcher.prefetch("U1") is None
+    assert prefetcher.stats()["errors"] == 1
+    assert not history_cache.contains("U1")
+    assert not quota_limiter.is_loaded("U1")
+
+
+
+def test_numbered_query_reuses_positions_for_repeated_names():
+    sql, names = numbered_query(CONTEXT_SQL)
+    assert names == ("load_history", "line_id", "history_limit", "load_reply_times", "since", "load_subscription")
+    assert "%(" not in sql
+    # line_id は4か所で使われるが、同じ $2 を指す
+    assert sql.count("$2") == 4
+    assert numbered_query("SELECT %(a)s, '100%%', %(b)s, %(a)s") == ("SELECT $1, '100%', $2, $1", ("a", "b"))
+
+
+def test_context_from_rows_orders_history_and_reads_subscription():
+    t = datetime.datetime(2024, 1, 1, 12, 0)
+    rows = [
+        (1, 8, t + datetime.timedelta(seconds=1), "system", "reply", None, None),
+        (1, 7, t, "user", "hello", None, None),
+        (2, None, t + datetime.timedelta(seconds=1), None, None, None, None),
+        (3, None, None, "sub_1", "cus_1", "price_1", "active"),
+    ]
+    context = context_from_rows(rows, "U1", history=True, reply_times=True, subscription=True)
+    assert context.history == [{"role": "user", "content": "hello"}, {"role": "assistant", "content": "reply"}]
+    assert context.reply_times == [(t + datetime.timedelta(seconds=1)).timestamp()]
+    assert context.subscription == {"line_user_id": "U1", "subscription_id": "sub_1", "stripe_customer_id": "cus_1",
+                                    "price_id": "price_1", "status": "active"}
+    assert context_from_rows([], "U1", history=False, reply_times=False, subscription=True).subscription_loaded
+
+
+@pytest.fixture
+def database():
+    psycopg2 = pytest.importorskip("psycopg2")
+    import migrations
+
+    connection = psycopg2.connect(os.environ["DATABASE_URL"], options=f"-c search_path={SCHEMA}")
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA};")
+    connection.commit()
+    migrations.run_migrations(connection)
+    yield connection
+    connection.rollback()
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+    connection.commit()
+    connection.close()
+
+
+def make_store(connection, **kwargs):
+    from data_access import ConversationStore
+    from log_writer import LogWriter
+
+    writer = LogWriter(lambda: connection, lambda conn: None, **kwargs)
+    return ConversationStore(lambda: connection, lambda conn: None, writer, history_limit=4), writer
+
+
+@needs_database
+def test_load_context_reads_everything_in_one_statement(database):
+    store, writer = make_store(database)
+    now = datetime.datetime.now()
+    for i in range(3):
+        store.record_exchange("U1", "cus_1", now + datetime.timedelta(seconds=i), f"q{i}",
+                              now + datetime.timedelta(seconds=i), f"a{i}")
+    with database.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO stripe_subscriptions (line_user_id, subscription_id, stripe_customer_id, price_id, status) "
+            "VALUES ('U1', 'sub_1', 'cus_1', 'price_1', 'active');"
+        )
+    database.commit()
+
+    # バッファに残っている行も読み込みの前に書き込まれる
+    context = store.load_context("U1", since=time.time() - 3600)
+    assert [turn["content"] for turn in context.history] == ["q1", "a1", "q2", "a2"]
+    assert [turn["role"] for turn in context.history] == ["user", "assistant"] * 2
+    assert len(context.reply_times) == 3
+    assert context.subscription["status"] == "active"
+    assert store.stats()["round_trips"] == 1
+    # 1回のやり取りの2行は同じバッチで書き込まれる
+    assert writer.stats()["batches"] == 1
+
+
+@needs_database
+def test_skipped_items_are_not_loaded_and_deactivate_clears_history(database):
+    store, _ = make_store(database, synchronous=True)
+    now = datetime.datetime.now()
+    store.record_exchange("U1", None, now, "q", now, "a")
+
+    context = store.load_context("U1", history=False, reply_times=False, subscription=True)
+    assert context.history is None and context.reply_times is None
+    assert context.subscription is None and context.subscription_loaded
+
+    store.deactivate("U1")
+    assert store.fetch_history("U1") == []
+    assert len(store.fetch_reply_times("U1", time.time() - 3600)) == 1
+
+
+@needs_database
+def test_user_turns_are_recorded_without_a_reply(database):
+    store, _ = make_store(database, synchronous=True)
+    now = datetime.datetime.now()
+    store.record_turns("U1", None, [(now, "q0"), (now + datetime.timedelta(seconds=1), "q1")])
+
+    assert store.fetch_history("U1") == [{"role": "user", "content": "q0"}, {"role": "user", "content": "q1"}]
+    # 応答の行がないので利用回数には数えない
+    assert store.fetch_reply_times("U1", time.time() - 3600) == []
+
+
+@needs_database
+def test_reset_hides_earlier_turns_without_rewriting_rows(database):
+    store, writer = make_store(database)
+    t = datetime.datetime.now()
+    store.record_exchange("U1", None, t, "q0", t + datetime.timedelta(seconds=1), "a0")
+    store.record_exchange("U2", None, t, "other", t + datetime.timedelta(seconds=1), "reply")
+
+    # バッファに残っている行もリセット時刻より前なので隠れる
+    store.deactivate("U1", t + datetime.timedelta(seconds=2))
+    assert writer.stats()["batches"] == 0
+    store.record_exchange("U1", None, t + datetime.timedelta(seconds=2), "q1", t + datetime.timedelta(seconds=3), "a1")
+    assert [turn["content"] for turn in store.fetch_history("U1")] == ["q1", "a1"]
+    assert len(store.fetch_history("U2")) == 2
+
+    # 古いリセット時刻で上書きされない
+    store.deactivate("U1", t)
+    assert [turn["content"] for turn in store.fetch_history("U1")] == ["q1", "a1"]
+    with database.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM line_bot_logs WHERE is_active;")
+        assert cursor.fetchone()[0] == 6
@@ -0,0 +1,86 @@
+"""
+イベントディスパッチャのテスト
+"""
+
+import queue
+import threading
+import time
+
+import pytest
+
+from dispatcher import EventDispatcher
+
+
+def test_duplicate_event_ids_are_processed_once():
+    handled = []
+    dispatcher = EventDispatcher(handled.append, workers=2, queue_size=10)
+    dispatcher.start()
+
+    assert dispatcher.submit("evt-1", "a")
+    assert not dispatcher.submit("evt-1", "a")
+    assert dispatcher.submit("evt-2", "b")
+    dispatcher.shutdown()
+
+    assert sorted(handled) == ["a", "b"]
+    stats = dispatcher.stats()
+    assert stats["duplicates"] == 1
+    assert stats["processed"] == 2
+
+
+def test_full_queue_rejects_and_allows_redelivery():
+    release = threading.Event()
+    dispatcher = EventDispatcher(lambda event: release.wait(), workers=1, queue_size=1, enqueue_timeout=0.01)
+    dispatcher.start()
+
+    dispatcher.submit("evt-1", "busy")
+    # ワーカーがevt-1を取り出すのを待つ
+    deadline = time.monotonic() + 1
+    while dispatcher.stats()["in_flight"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    dispatcher.submit("evt-2", "queued")
+    with pytest.raises(queue.Full):
+        dispatcher.submit("evt-3", "overflow")
+    assert dispatcher.stats()["rejected"] == 1
+
+    release.set()
+    # 拒否されたイベントはLINEの再送時に受け付けられる
+    deadline = time.monotonic() + 1
+    while dispatcher.stats()["queue_depth"] and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert dispatcher.submit("evt-3", "overflow")
+    dispatcher.shutdown()
+    assert dispatcher.stats()["processed"] == 3
+
+
+def test_shutdown_drains_queued_events():
+    handled = []
+
+    def slow_handler(event):
+        time.sleep(0.01)
+        handled.append(event)
+
+    dispatcher = EventDispatcher(slow_handler, workers=1, queue_size=20)
+    dispatcher.start()
+    for i in range(10):
+        dispatcher.submit(f"evt-{i}", i)
+    dispatcher.shutdown()
+
+    assert handled == list(range(10))
+    with pytest.raises(queue.Full):
+        dispatcher.submit("evt-late", "late")
+
+
+def test_handler_errors_are_counted_and_do_not_stop_workers():
+    def flaky(event):
+        if event == "bad":
+            raise RuntimeError("boom")
+
+    dispatcher = EventDispatcher(flaky, workers=1, queue_size=10)
+    dispatcher.start()
+    dispatcher.submit(None, "bad")
+    dispatcher.submit(None, "good")
+    dispatcher.shutdown()
+
+    stats = dispatcher.stats()
+    assert stats["failed"] == 1
+    assert stats["processed"] == 1
@@ -0,0 +1,65 @@
+"""
+I/Oなしの振り分けと、回数制限を超えたユーザーのキャッシュのテスト
+"""
+
+from fast_path import FastPath, OverQuotaCache
+from message_flow import INVALID_INPUT_REPLY, QUOTA_EXCEEDED_REPLY, RESET_COMMAND, decide
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_over_quota_users_are_blocked_until_retry_after():
+    clock = FakeClock()
+    cache = OverQuotaCache(ttl=300, clock=clock)
+    cache.add("U1", 60)
+    assert cache.blocked("U1")
+    assert not cache.blocked("U2")
+
+    clock.now += 60
+    assert not cache.blocked("U1")
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["expired"] == 1
+    assert stats["users"] == 0
+
+
+def test_over_quota_cache_is_bounded_by_ttl_and_size():
+    clock = FakeClock()
+    cache = OverQuotaCache(max_users=2, ttl=10, clock=clock)
+    # 制限が解けるのが先でも、ttl 秒で忘れる（別のワーカーで有料プランに変わった場合など）
+    cache.add("U1", 3600)
+    clock.now += 10
+    assert not cache.blocked("U1")
+
+    for user_id in ("U1", "U2", "U3"):
+        cache.add(user_id, 5)
+    assert not cache.blocked("U1")
+    assert cache.blocked("U2") and cache.blocked("U3")
+    assert cache.stats()["evicted"] == 1
+
+    cache.discard("U2")
+    assert not cache.blocked("U2")
+    # 制限されていない判定やユーザーIDがない場合は覚えない
+    cache.add("U4", 0)
+    cache.add(None, 5)
+    assert cache.stats()["users"] == 1
+
+
+def test_fast_path_routes_replies_known_without_io():
+    clock = FakeClock()
+    fast_path = FastPath(OverQuotaCache(clock=clock))
+    assert fast_path.route("U1", decide("   ", "U1")) == INVALID_INPUT_REPLY
+    assert fast_path.route("U1", decide("こんにちは", "U1")) is None
+    # リセットは会話履歴の書き込みが必要なので通常の処理に回す
+    assert fast_path.route("U1", decide(RESET_COMMAND, "U1")) is None
+
+    fast_path.over_quota.add("U1", 60)
+    assert fast_path.route("U1", decide("こんにちは", "U1")) == QUOTA_EXCEEDED_REPLY
+    assert fast_path.route("U2", decide("こんにちは", "U2")) is None
+    assert fast_path.stats() == {"canned": 1, "over_quota": 1, "slow": 3}
@@ -0,0 +1,105 @@
+"""
+会話履歴キャッシュのテスト
+"""
+
+import time
+
+import pytest
+
+from history_cache import HistoryCache, MemoryHistoryBackend, RedisHistoryBackend
+
+
+class CountingLoader:
+    def __init__(self, histories=None):
+        self.histories = histories or {}
+        self.calls = 0
+
+    def __call__(self, user_id):
+        self.calls += 1
+        return list(self.histories.get(user_id, []))
+
+
+def turn(role, content):
+    return {"role": role, "content": content}
+
+
+@pytest.fixture(params=["memory", "redis"])
+def backend(request):
+    if request.param == "memory":
+        return MemoryHistoryBackend(max_users=10, ttl=60)
+    # Redisバックエンドはfakeredis（Redis互換のインメモリ実装）で確認する
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisHistoryBackend(fakeredis.FakeRedis(decode_responses=True), ttl=60)
+
+
+def test_miss_loads_once_then_hits(backend):
+    loader = CountingLoader({"U1": [turn("user", "こんにちは"), turn("assistant", "こんにちは。")]})
+    cache = HistoryCache(backend, limit=10)
+
+    first = cache.get("U1", loader)
+    second = cache.get("U1", loader)
+
+    assert first == second == loader.histories["U1"]
+    assert loader.calls == 1
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+
+def test_write_through_keeps_last_turns(backend):
+    loader = CountingLoader()
+    cache = HistoryCache(backend, limit=3)
+    assert cache.get("U1", loader) == []
+
+    for i in range(5):
+        cache.append("U1", "user", f"m{i}")
+
+    assert cache.get("U1", loader) == [turn("user", "m2"), turn("user", "m3"), turn("user", "m4")]
+    assert loader.calls == 1
+
+
+def test_append_to_uncached_user_is_ignored(backend):
+    loader = CountingLoader({"U2": [turn("user", "from db")]})
+    cache = HistoryCache(backend, limit=10)
+
+    cache.append("U2", "assistant", "not cached")
+    assert cache.get("U2", loader) == [turn("user", "from db")]
+    assert cache.stats()["appends"] == 0
+
+
+def test_reset_caches_empty_history(backend):
+    loader = CountingLoader({"U1": [turn("user", "old")]})
+    cache = HistoryCache(backend, limit=10)
+    cache.get("U1", loader)
+
+    cache.reset("U1")
+    assert cache.get("U1", loader) == []
+    cache.append("U1", "user", "スタート後")
+    assert cache.get("U1", loader) == [turn("user", "スタート後")]
+    assert loader.calls == 1
+
+
+def test_loader_errors_are_not_cached():
+    cache = HistoryCache(MemoryHistoryBackend(), limit=10)
+
+    def failing_loader(user_id):
+        raise RuntimeError("db down")
+
+    with pytest.raises(RuntimeError):
+        cache.get("U1", failing_loader)
+    assert cache.get("U1", CountingLoader({"U1": [turn("user", "ok")]})) == [turn("user", "ok")]
+
+
+def test_memory_backend_evicts_by_size_and_ttl():
+    backend = MemoryHistoryBackend(max_users=2, ttl=0.05)
+    backend.set("U1", [], 10)
+    backend.set("U2", [], 10)
+    backend.get("U1")
+    backend.set("U3", [], 10)
+
+    # 最も使われていないU2が追い出される
+    assert backend.get("U2") is None
+    assert backend.get("U1") == []
+
+    time.sleep(0.06)
+    assert backend.get("U1") is None
+    assert backend.size() == 1
@@ -0,0 +1,152 @@
+"""
+LLMクライアントのテスト
+ローカルの疑似OpenAIサーバーに対して、リトライ・タイムアウト・接続の使い回しを確認する
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from llm_client import CircuitBreaker, CircuitOpenError, LLMClient, SessionHttpClient, create_session, parse_retry_after
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        server.requests += 1
+        server.connections.add(self.client_address)
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status, headers, delay = server.script.pop(0) if server.script else (200, {}, 0)
+        time.sleep(delay)
+        body = json.dumps({"choices": [{"message": {"content": " ok "}}]}).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.requests = 0
+    server.connections = set()
+    server.script = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    yield server
+    server.shutdown()
+
+
+def make_client(server, **kwargs):
+    sleeps = []
+    kwargs.setdefault("read_timeout", 1.0)
+    client = LLMClient("key", base_url=server.url, sleep=sleeps.append, **kwargs)
+    return client, sleeps
+
+
+def test_retries_on_5xx_and_honors_retry_after(server):
+    server.script = [(503, {}, 0), (429, {"Retry-After": "2"}, 0)]
+    client, sleeps = make_client(server, backoff=0.01)
+
+    assert client.chat([{"role": "user", "content": "hi"}]) == "ok"
+    assert server.requests == 3
+    assert len(sleeps) == 2
+    assert sleeps[0] <= 0.01
+    assert sleeps[1] >= 2
+    assert client.stats()["retries"] == 2
+
+
+def test_client_errors_are_not_retried(server):
+    server.script = [(400, {}, 0)]
+    client, sleeps = make_client(server)
+    with pytest.raises(requests.HTTPError):
+        client.chat([])
+    assert server.requests == 1
+    assert sleeps == []
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_read_timeout_fails_within_deadline(server):
+    server.script = [(200, {}, 0.5)] * 3
+    client, _ = make_client(server, read_timeout=0.1, max_retries=1, backoff=0)
+    started = time.monotonic()
+    with pytest.raises(requests.Timeout):
+        client.chat([])
+    assert time.monotonic() - started < 0.5
+
+
+def test_circuit_opens_and_short_circuits_until_reset(server):
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=lambda: now[0])
+    client, _ = make_client(server, max_retries=0, breaker=breaker)
+    server.script = [(500, {}, 0)] * 2
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            client.chat([])
+
+    with pytest.raises(CircuitOpenError):
+        client.chat([])
+    assert server.requests == 2
+    assert client.stats()["short_circuited"] == 1
+
+    # reset_timeout後は1件だけ試し、成功すれば閉じる
+    now[0] = 31
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert client.chat([]) == "ok"
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_trial_failing_unexpectedly_reopens_and_recovers(server):
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=lambda: now[0])
+    client, _ = make_client(server, max_retries=0, breaker=breaker)
+    server.script = [(500, {}, 0)]
+    with pytest.raises(requests.HTTPError):
+        client.chat([])
+
+    def broken_post(*args, **kwargs):
+        raise requests.exceptions.ChunkedEncodingError("connection broken")
+
+    now[0] = 31
+    post = client.session.post
+    client.session.post = broken_post
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        client.chat([])
+    # 試行の失敗として記録され、次の reset_timeout 後にまた試せる
+    assert breaker.state == CircuitBreaker.OPEN
+    client.session.post = post
+    now[0] = 62
+    assert client.chat([]) == "ok"
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_connections_are_reused(server):
+    client, _ = make_client(server)
+    for _ in range(5):
+        client.chat([])
+    line_client = SessionHttpClient(create_session(), timeout=1)
+    for _ in range(3):
+        assert line_client.post(server.url + "/chat/completions", data="{}").status_code == 200
+    # LLMクライアントとLINE用クライアントで1本ずつ
+    assert len(server.connections) == 2
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("1.5") == 1.5
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:10 GMT", now=1445412480) == pytest.approx(10)
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
@@ -0,0 +1,169 @@
+"""
+ログライターのテスト
+DB接続はSQLを記録するだけのフェイクに置き換える
+"""
+
+import time
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from log_writer import LogWriter, prompt_hash  # noqa: E402
+
+SYS_PROMPT = "You will be playing the role of a supportive counselor." * 50
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def mogrify(self, template, args):
+        return repr(args).encode()
+
+    def execute(self, query, params=None):
+        if self.connection.fail:
+            raise RuntimeError("db down")
+        if isinstance(query, bytes):
+            query = query.decode()
+        self.connection.pending.append(query)
+
+
+class FakeConnection:
+    encoding = "UTF8"
+
+    def __init__(self):
+        self.fail = False
+        self.pending = []
+        self.committed = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.committed.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+    def log_inserts(self):
+        return [q for q in self.committed if "INSERT INTO line_bot_logs" in q]
+
+    def prompt_inserts(self):
+        return [q for q in self.committed if "INSERT INTO prompts" in q]
+
+
+@pytest.fixture
+def connection():
+    return FakeConnection()
+
+
+def make_writer(connection, **kwargs):
+    return LogWriter(lambda: connection, lambda conn: None, **kwargs)
+
+
+def write_rows(writer, count):
+    for i in range(count):
+        writer.write(f"2024-01-01 00:00:{i:02d}", "user", "U1", None, f"message {i}", True, SYS_PROMPT)
+
+
+def test_rows_are_written_in_batches(connection):
+    writer = make_writer(connection, batch_size=10, synchronous=False)
+    write_rows(writer, 25)
+    assert connection.committed == []
+
+    assert writer.flush()
+    assert len(connection.log_inserts()) == 3
+    assert writer.stats()["written"] == 25
+    # スキーマは migrations.py が作るので、ログテーブルをロックするDDLは実行しない
+    assert not [q for q in connection.committed if "ALTER TABLE" in q or "CREATE TABLE" in q]
+
+
+def test_prompt_is_stored_once_and_referenced_by_hash(connection):
+    writer = make_writer(connection, batch_size=5)
+    write_rows(writer, 20)
+    writer.flush()
+
+    assert len(connection.prompt_inserts()) == 1
+    digest = prompt_hash(SYS_PROMPT)
+    assert all(digest in q for q in connection.log_inserts())
+    # ログ行そのものにはプロンプト本文を入れない
+    assert all(SYS_PROMPT not in q for q in connection.log_inserts())
+
+
+def test_synchronous_mode_writes_immediately(connection):
+    writer = make_writer(connection, synchronous=True)
+    write_rows(writer, 2)
+    assert len(connection.log_inserts()) == 2
+    assert writer.stats()["buffered"] == 0
+
+
+def test_background_thread_flushes_on_interval_and_close(connection):
+    writer = make_writer(connection, batch_size=100, flush_interval=0.02)
+    writer.start()
+    write_rows(writer, 3)
+    deadline = time.monotonic() + 1
+    while not connection.log_inserts() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert writer.stats()["written"] == 3
+
+    write_rows(writer, 2)
+    writer.close()
+    assert writer.stats()["written"] == 5
+
+
+def test_failed_flush_keeps_rows_and_bounds_buffer(connection):
+    writer = make_writer(connection, batch_size=5, max_buffer=8)
+    connection.fail = True
+    write_rows(writer, 10)
+
+    stats = writer.stats()
+    assert stats["buffered"] == 8
+    assert stats["dropped"] == 2
+
+    assert not writer.flush()
+    stats = writer.stats()
+    assert stats["buffered"] == 8
+    assert stats["failed_flushes"] == 1
+
+    connection.fail = False
+    assert writer.flush()
+    assert writer.stats()["written"] == 8
+
+
+def test_rows_written_together_are_not_split_across_batches(connection):
+    writer = make_writer(connection, batch_size=3)
+    write_rows(writer, 2)
+    writer.write_many([
+        ("2024-01-01 00:01:00", "user", "U2", None, "question", True, SYS_PROMPT),
+        ("2024-01-01 00:01:01", "system", "U2", None, "answer", True, SYS_PROMPT),
+    ])
+    assert writer.has_pending("U2")
+    writer.flush()
+
+    inserts = connection.log_inserts()
+    assert len(inserts) == 1
+    assert "question" in inserts[0] and "answer" in inserts[0]
+    assert not writer.has_pending("U2")
+
+
+def test_full_buffer_does_not_block_writes_on_a_failing_database():
+    def slow_failing_connection():
+        time.sleep(0.5)
+        raise RuntimeError("connection timed out")
+
+    writer = LogWriter(slow_failing_connection, lambda conn: None, batch_size=5, max_buffer=8)
+    started = time.monotonic()
+    write_rows(writer, 20)
+    # 呼び出し元のスレッドではDBに接続しない
+    assert time.monotonic() - started < 0.3
+    stats = writer.stats()
+    assert stats["buffered"] == 8
+    assert stats["dropped"] == 12
@@ -0,0 +1,90 @@
+"""
+メッセージ処理の判定（Flask版・asyncio版で共通）のテスト
+"""
+
+import datetime
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from message_flow import (
+    INVALID_INPUT_REPLY, NO_USER_REPLY, RESET_COMMAND, RESET_REPLY, Decision, coalesce, decide, digest_messages,
+    order_events, parse_text_message_events, select_policy, superseded, validate_message,
+)
+
+
+def test_decide_routes_reset_conversation_and_errors():
+    assert decide(f"  {RESET_COMMAND} ", "U1") == Decision("reset", RESET_REPLY)
+    assert decide("こんにちは ", "U1") == Decision("converse", "こんにちは")
+    assert decide("こんにちは", None) == Decision("reply", NO_USER_REPLY)
+    # ユーザーIDがない場合はリセットもしない
+    assert decide(RESET_COMMAND, None) == Decision("reply", NO_USER_REPLY)
+    assert decide("   ", "U1") == Decision("reply", INVALID_INPUT_REPLY, error="validation")
+    assert decide("<script>alert(1)</script>", "U1").error == "validation"
+
+
+def test_coalesce_joins_messages_after_the_last_reset():
+    decisions = [decide(text, "U1") for text in ("前の話", RESET_COMMAND, "眠れません", "   ", "仕事が忙しくて")]
+    reset, decision, included = coalesce(decisions)
+    assert reset
+    assert decision == Decision("converse", "眠れません\n仕事が忙しくて")
+    assert included == [2, 4]
+    assert superseded(decisions, included) == [0]
+
+    assert coalesce([decide("こんにちは", "U1")]) == (False, Decision("converse", "こんにちは"), [0])
+    assert coalesce([decide("こんにちは", "U1"), decide(RESET_COMMAND, "U1")]) == (
+        True, Decision("reset", RESET_REPLY), [])
+    assert coalesce([decide("", "U1"), decide(" ", "U1")]) == (
+        False, Decision("reply", INVALID_INPUT_REPLY, error="validation"), [])
+
+
+def test_order_events_follows_line_timestamps_with_increasing_times():
+    first = SimpleNamespace(timestamp=1000, text="1")
+    second = SimpleNamespace(timestamp=2000, text="2")
+    t = datetime.datetime(2024, 1, 1, 12, 0)
+    # 2通目のリクエストが先に届いた場合
+    ordered = order_events([(t, second), (t + datetime.timedelta(milliseconds=5), first)])
+    assert [event.text for _, event in ordered] == ["1", "2"]
+    assert [timestamp for timestamp, _ in ordered] == [t, t + datetime.timedelta(milliseconds=5)]
+
+
+def test_validate_message_rejects_bad_input():
+    assert validate_message(" ok ") == "ok"
+    for message in ("", None, "x" * 2001, "JavaScript:alert(1)"):
+        with pytest.raises(ValueError):
+            validate_message(message)
+
+
+def test_select_policy():
+    assert select_policy("Uowner", None, "Uowner") == "owner"
+    assert select_policy("U1", {"status": "active", "stripeId": "cus_1"}, "Uowner") == "paid"
+    assert select_policy("U1", {"status": "canceled", "stripeId": "cus_1"}, "Uowner") == "free"
+    assert select_policy("U1", None, None) == "free"
+
+
+def test_digest_messages_include_previous_summary_and_turns():
+    messages = digest_messages("前回の要約", [
+        {"role": "user", "content": "眠れません"},
+        {"role": "assistant", "content": "眠れないのですね"},
+    ])
+    assert messages[0]["role"] == "system"
+    assert "前回の要約" in messages[1]["content"]
+    assert "ユーザー: 眠れません\nカウンセラー: 眠れないのですね" in messages[1]["content"]
+    assert "なし" in digest_messages(None, [])[1]["content"]
+
+
+def test_parse_text_message_events_skips_other_events():
+    body = json.dumps({"destination": "U0", "events": [
+        {"type": "message", "webhookEventId": "E1", "replyToken": "r1", "timestamp": 0, "mode": "active",
+         "source": {"type": "user", "userId": "U1"}, "message": {"id": "1", "type": "text", "text": "hi"}},
+        {"type": "message", "webhookEventId": "E2", "replyToken": "r2", "timestamp": 0, "mode": "active",
+         "source": {"type": "user", "userId": "U1"}, "message": {"id": "2", "type": "sticker",
+                                                                 "packageId": "1", "stickerId": "1"}},
+        {"type": "follow", "webhookEventId": "E3", "replyToken": "r3", "timestamp": 0, "mode": "active",
+         "source": {"type": "user", "userId": "U1"}},
+    ]})
+    events = parse_text_message_events(body)
+    assert [event_id for event_id, _ in events] == ["E1"]
+    assert events[0][1].message.text == "hi"
+    assert events[0][1].source.user_id == "U1"
@@ -0,0 +1,79 @@
+"""
+メトリクスと処理段階の計測のテスト
+"""
+
+import logging
+import time
+
+import pytest
+
+from metrics import Registry, STAGE_SECONDS, current_trace, stage, trace
+
+
+def test_render_counters_gauges_and_histograms():
+    registry = Registry()
+    requests = registry.counter("app_requests", "Requests", ("path",))
+    requests.inc(path="/callback")
+    requests.inc(2, path='say "hi"\n')
+    registry.gauge("app_in_flight", "In flight").set(3)
+    latency = registry.histogram("app_latency_seconds", "Latency", buckets=(0.1, 1.0))
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    lines = registry.render().splitlines()
+    assert "# TYPE app_requests counter" in lines
+    assert 'app_requests_total{path="/callback"} 1' in lines
+    assert 'app_requests_total{path="say \\"hi\\"\\n"} 2' in lines
+    assert "app_in_flight 3" in lines
+    assert 'app_latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'app_latency_seconds_bucket{le="1.0"} 2' in lines
+    assert 'app_latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert "app_latency_seconds_sum 5.55" in lines
+    assert "app_latency_seconds_count 3" in lines
+
+    with pytest.raises(ValueError):
+        requests.inc(method="GET")
+    with pytest.raises(ValueError):
+        registry.counter("app_requests", "Duplicate")
+
+
+def test_stats_collectors_export_numeric_values_only():
+    registry = Registry()
+    registry.register_stats("app_cache", lambda: {"hits": 4, "hit_ratio": 0.8, "open": True, "state": "closed"})
+    registry.register_stats("app_broken", lambda: 1 / 0)
+
+    lines = registry.render().splitlines()
+    assert "app_cache_hits 4" in lines
+    assert "app_cache_hit_ratio 0.8" in lines
+    assert "app_cache_open 1" in lines
+    assert not any(line.startswith("app_cache_state") or line.startswith("app_broken") for line in lines)
+
+
+def test_trace_collects_stages_and_logs_slow_requests(caplog):
+    before, _ = STAGE_SECONDS.snapshot(stage="test.slow_step")
+    with caplog.at_level(logging.INFO, logger="metrics"):
+        with trace("test_request", slow_ms=0) as current:
+            assert current_trace() is current
+            with stage("test.slow_step"):
+                time.sleep(0.01)
+            with pytest.raises(RuntimeError):
+                with stage("test.failing_step"):
+                    raise RuntimeError("boom")
+    assert current_trace() is None
+
+    assert [name for name, _ in current.spans] == ["test.slow_step", "test.failing_step"]
+    assert current.spans[0][1] >= 0.01
+    assert STAGE_SECONDS.snapshot(stage="test.slow_step")[0] == before + 1
+    assert STAGE_SECONDS.snapshot(stage="test_request")[0] >= 1
+    assert "test_request total=" in caplog.text and "test.slow_step=" in caplog.text
+
+
+def test_stage_overhead_is_small():
+    iterations = 20000
+    started = time.perf_counter()
+    for _ in range(iterations):
+        with stage("test.overhead"):
+            pass
+    per_stage = (time.perf_counter() - started) / iterations
+    assert per_stage < 20e-6
@@ -0,0 +1,82 @@
+"""
+マイグレーションのテスト
+DATABASE_URL のPostgres上に専用スキーマを作って実行する（未設定の場合はスキップ）
+"""
+
+import os
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+import migrations  # noqa: E402
+
+SCHEMA = "test_migrations"
+
+pytestmark = pytest.mark.skipif(not os.environ.get("DATABASE_URL"), reason="DATABASE_URL is not set")
+
+
+@pytest.fixture
+def connection():
+    connection = psycopg2.connect(os.environ["DATABASE_URL"], options=f"-c search_path={SCHEMA}")
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE; CREATE SCHEMA {SCHEMA};")
+    connection.commit()
+    yield connection
+    connection.rollback()
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+    connection.commit()
+    connection.close()
+
+
+def test_migrations_are_applied_once(connection):
+    versions = [version for version, _, _, _ in migrations.MIGRATIONS]
+    assert migrations.run_migrations(connection) == versions
+    assert migrations.run_migrations(connection) == []
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'line_bot_logs';")
+        indexes = {row[0] for row in cursor.fetchall()}
+    assert set(migrations.HOT_QUERY_INDEXES) <= indexes
+
+
+def test_hot_queries_use_indexes(connection):
+    migrations.run_migrations(connection)
+    with connection.cursor() as cursor:
+        cursor.execute("SET enable_seqscan = off;")
+        cursor.execute(
+            "EXPLAIN SELECT COUNT(*) FROM line_bot_logs "
+            "WHERE sender='system' AND lineId='U1' AND timestamp > NOW() - INTERVAL '24 HOURS';"
+        )
+        plan = "\n".join(row[0] for row in cursor.fetchall())
+    assert "idx_line_bot_logs_system_recent" in plan
+
+
+def test_enable_partitioning_keeps_existing_rows(connection):
+    migrations.run_migrations(connection)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO line_bot_logs (timestamp, sender, lineId, message) VALUES "
+            "(NOW(), 'user', 'U1', 'now'), (NOW() - INTERVAL '400 days', 'user', 'U1', 'old'), "
+            "(NULL, 'user', 'U1', 'no timestamp');"
+        )
+        # ATTACH PARTITION が全行を読まずに済んだことは DEBUG1 のメッセージでわかる
+        cursor.execute("SET client_min_messages = debug1;")
+    connection.commit()
+
+    assert migrations.enable_partitioning(connection)
+    assert any('table "line_bot_logs_legacy" is implied by existing constraints' in notice for notice in connection.notices)
+    assert not migrations.enable_partitioning(connection)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO line_bot_logs (timestamp, sender, lineId, message) "
+            "VALUES (NOW() + INTERVAL '40 days', 'user', 'U1', 'future');"
+        )
+        cursor.execute("SELECT COUNT(*) FROM line_bot_logs;")
+        assert cursor.fetchone()[0] == 4
+        cursor.execute("SELECT COUNT(*) FROM line_bot_logs WHERE timestamp = '-infinity';")
+        assert cursor.fetchone()[0] == 1
+        cursor.execute("SELECT COUNT(*) FROM pg_inherits WHERE inhparent = 'line_bot_logs'::regclass;")
+        assert cursor.fetchone()[0] >= 3
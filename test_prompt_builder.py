@@ -0,0 +1,158 @@
+"""
+プロンプトビルダーのテスト
+トークン数はエンコーダーのダウンロードに依存しないよう概算で数える
+"""
+
+import threading
+
+from prompt_builder import (
+    DIGEST_HEADER,
+    TOKENS_PER_MESSAGE,
+    MemoryDigestStore,
+    PromptBuilder,
+    estimate_tokens,
+)
+
+SYSTEM_PROMPT = "You are a supportive counselor."
+
+
+def turn(role, content):
+    return {"role": role, "content": content}
+
+
+def conversation(count, length):
+    return [turn("user" if i % 2 == 0 else "assistant", f"{i}" + "あ" * length) for i in range(count)]
+
+
+class RecordingSummarizer:
+    def __init__(self):
+        self.calls = []
+        self.done = threading.Event()
+
+    def __call__(self, previous_summary, turns):
+        self.calls.append((previous_summary, [t["content"] for t in turns]))
+        self.done.set()
+        return f"summary of {len(turns)} turns"
+
+
+def make_builder(budget, **kwargs):
+    return PromptBuilder(SYSTEM_PROMPT, budget, token_counter=estimate_tokens, **kwargs)
+
+
+def test_history_is_trimmed_to_budget_keeping_newest_turns():
+    history = conversation(10, 500)
+    builder = make_builder(1600)
+
+    messages, stats = builder.build("U1", history, "こんにちは")
+
+    assert messages[0] == {"role": "system", "content": SYSTEM_PROMPT}
+    assert messages[-1] == {"role": "user", "content": "こんにちは"}
+    assert messages[1:-1] == history[-stats["turns_included"]:]
+    assert stats["turns_included"] == 3
+    assert stats["turns_dropped"] == 7
+    assert stats["prompt_tokens"] <= 1600
+
+
+def test_short_history_fits_entirely():
+    history = conversation(10, 5)
+    messages, stats = make_builder(4000).build("U1", history, "はい")
+    assert messages[1:-1] == history
+    assert stats["turns_dropped"] == 0
+    assert stats["history_tokens"] == sum(estimate_tokens(t["content"]) + TOKENS_PER_MESSAGE for t in history)
+
+
+def test_dropped_turns_are_summarized_once_and_digest_is_included():
+    summarizer = RecordingSummarizer()
+    store = MemoryDigestStore()
+    builder = make_builder(1100, digest_store=store, summarizer=summarizer)
+    history = conversation(6, 400)
+
+    builder.build("U1", history, "次へ")
+    assert summarizer.done.wait(1)
+    builder._executor.shutdown(wait=True)
+    assert len(summarizer.calls) == 1
+    assert store.get("U1")[0] == "summary of 4 turns"
+
+    # 要約済みの会話は再び要約しない
+    summarizer.done.clear()
+    messages, stats = builder.build("U1", history, "次へ")
+    assert messages[1] == {"role": "system", "content": DIGEST_HEADER + "summary of 4 turns"}
+    assert stats["digest_tokens"] > 0
+    assert len(summarizer.calls) == 1
+
+
+def test_oldest_turns_are_summarized_before_leaving_a_full_window():
+    summarizer = RecordingSummarizer()
+    builder = make_builder(100000, summarizer=summarizer)
+    history = conversation(10, 5)
+
+    _, stats = builder.build("U1", history, "はい", window_full=True)
+    builder._executor.shutdown(wait=True)
+    assert stats["turns_dropped"] == 0
+    assert summarizer.calls[0][1] == [history[0]["content"], history[1]["content"]]
+
+
+def test_reset_clears_digest_and_stats_are_aggregated():
+    store = MemoryDigestStore()
+    store.set("U1", "old", ["x"])
+    builder = make_builder(4000, digest_store=store, summarizer=RecordingSummarizer())
+    builder.reset("U1")
+    builder.build("U1", [], "a")
+    builder.build("U1", [], "b")
+
+    assert store.get("U1") is None
+    stats = builder.stats()
+    assert stats["requests"] == 2
+    assert stats["avg_prompt_tokens"] > 0
+
+
+def test_summary_started_before_a_reset_is_not_written_back():
+    release = threading.Event()
+
+    def summarizer(previous_summary, turns):
+        release.wait(1)
+        return "summary of the old conversation"
+
+    store = MemoryDigestStore()
+    builder = make_builder(1100, digest_store=store, summarizer=summarizer)
+    builder.build("U1", conversation(6, 400), "次へ")
+    builder.reset("U1")
+    release.set()
+    builder._executor.shutdown(wait=True)
+
+    assert store.get("U1") is None
+    assert builder.stats()["summaries"] == 0
+
+
+def test_digest_store_is_bounded_and_expires():
+    store = MemoryDigestStore(max_users=2, ttl=60)
+    for user_id in ("U1", "U2", "U3"):
+        store.set(user_id, f"summary {user_id}", [])
+    assert store.get("U1") is None
+    assert store.get("U3") == ("summary U3", ())
+
+    expired = MemoryDigestStore(ttl=0)
+    expired.set("U1", "summary", [])
+    assert expired.get("U1") is None
+
+
+def test_digest_store_is_not_used_when_summaries_are_disabled():
+    class CountingStore(MemoryDigestStore):
+        def __init__(self):
+            super().__init__()
+            self.calls = []
+
+        def get(self, user_id):
+            self.calls.append("get")
+            return super().get(user_id)
+
+        def clear(self, user_id):
+            self.calls.append("clear")
+            super().clear(user_id)
+
+    store = CountingStore()
+    builder = make_builder(1100, digest_store=store)
+    _, stats = builder.build("U1", conversation(6, 400), "次へ", window_full=True)
+    builder.reset("U1")
+    assert store.calls == []
+    assert stats["digest_tokens"] == 0
@@ -0,0 +1,135 @@
+"""
+起動時の初期化とヘルスチェックのテスト
+"""
+
+import asyncio
+import sys
+import threading
+
+import pytest
+
+from startup import FAILED, OK, PENDING, LazyModule, Startup, warm_http
+
+
+def test_lazy_module_imports_and_configures_once():
+    sys.modules.pop("colorsys", None)
+    configured = []
+    module = LazyModule("colorsys", configure=configured.append)
+    assert not module.loaded
+    assert "colorsys" not in sys.modules
+
+    assert module.rgb_to_hsv(1.0, 0.0, 0.0) == (0.0, 1.0, 1.0)
+    assert module.loaded
+    assert module.hsv_to_rgb(0.0, 0.0, 1.0) == (1.0, 1.0, 1.0)
+    assert configured == [sys.modules["colorsys"]]
+
+
+def test_lazy_module_load_async_imports_off_the_event_loop():
+    sys.modules.pop("colorsys", None)
+    threads = []
+    module = LazyModule("colorsys", configure=lambda m: threads.append(threading.current_thread()))
+
+    async def load_twice():
+        return await module.load_async(), await module.load_async()
+
+    first, second = asyncio.run(load_twice())
+    assert first is second is sys.modules["colorsys"]
+    assert len(threads) == 1 and threads[0] is not threading.main_thread()
+
+
+def test_missing_env_keeps_worker_unready():
+    startup = Startup()
+    values = startup.require_env("A", "B", environ={"A": "1", "B": ""})
+    assert values == {"A": "1", "B": ""}
+    assert startup.missing_env == ["B"]
+    startup.run()
+    assert not startup.ready
+    assert startup.status()["missing_env"] == ["B"]
+
+
+def test_steps_run_in_order_and_failed_required_steps_are_retried():
+    calls = []
+    sleeps = []
+    attempts = {"db": 0}
+
+    def db():
+        calls.append("db")
+        attempts["db"] += 1
+        if attempts["db"] < 3:
+            raise ConnectionError("database is starting up")
+
+    def http():
+        calls.append("http")
+        raise ConnectionError("unreachable")
+
+    startup = Startup(retry_interval=2.0, sleep=sleeps.append)
+    startup.step("db", db)
+    startup.step("cache", lambda: calls.append("cache"))
+    startup.step("http", http, required=False)
+    assert startup.status()["steps"]["db"]["state"] == PENDING
+    assert not startup.ready
+
+    startup.run()
+    # 必須でない処理はやり直さない
+    assert calls == ["db", "cache", "http", "db", "db"]
+    assert sleeps == [2.0, 2.0]
+    assert startup.ready
+    steps = startup.status()["steps"]
+    assert steps["db"]["state"] == OK and "error" not in steps["db"]
+    assert steps["http"] == {"state": FAILED, "required": False, "seconds": steps["http"]["seconds"],
+                             "error": "unreachable"}
+
+
+def test_status_reports_probes_and_tracked_steps():
+    startup = Startup()
+    startup.probe("db_pool", lambda: {"in_use": 1})
+    startup.probe("broken", lambda: 1 / 0)
+    with startup.track("migrations"):
+        pass
+    with pytest.raises(RuntimeError):
+        with startup.track("stripe"):
+            raise RuntimeError("import failed")
+    status = startup.status()
+    assert status["dependencies"]["db_pool"] == {"in_use": 1}
+    assert "error" in status["dependencies"]["broken"]
+    assert status["steps"]["migrations"]["state"] == OK
+    assert status["steps"]["stripe"]["state"] == FAILED
+    assert not status["ready"]
+
+
+def test_start_runs_steps_in_background():
+    release = threading.Event()
+    startup = Startup()
+    startup.step("slow", release.wait)
+    startup.start()
+    assert not startup.wait(0.05)
+    assert not startup.ready
+    release.set()
+    assert startup.wait(1.0)
+    assert startup.ready
+
+
+def test_warm_http_opens_connections_in_parallel():
+    class Response:
+        def close(self):
+            pass
+
+    class Session:
+        def __init__(self):
+            self.active = 0
+            self.max_active = 0
+            self.barrier = threading.Barrier(3, timeout=1.0)
+            self.lock = threading.Lock()
+
+        def head(self, url, timeout=None, allow_redirects=True):
+            with self.lock:
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            self.barrier.wait()
+            with self.lock:
+                self.active -= 1
+            return Response()
+
+    session = Session()
+    assert warm_http(session, "https://api.example.com", connections=3) == 3
+    assert session.max_active == 3
@@ -0,0 +1,173 @@
+"""
+ストリーミング配信のテスト
+ローカルの疑似SSEサーバーを立てて、最初のメッセージまでの時間を計測する
+"""
+
+import asyncio
+import json
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from streaming import (
+    LINE_MAX_MESSAGES, SentenceChunker, aiter_sse_deltas, deliver_stream, deliver_stream_async, iter_sse_deltas,
+)
+
+RESPONSE_TEXT = (
+    "毎日忙しくて眠る時間もないと感じていらっしゃるのですね。"
+    "それはとてもお辛い状況だと思います。"
+    "睡眠が足りないと、心にも体にも負担がかかりますよね。"
+    "少しでも休める時間を見つけたいというお気持ちが伝わってきます。"
+    "今いちばん困っていることは何でしょうか？"
+    "お話しできる範囲で構いませんので、教えてください。"
+    "ゆっくりで大丈夫です。"
+)
+TOKEN_DELAY = 0.005
+
+
+def split_tokens(text, size=3):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class FakeSSEHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        assert json.loads(self.rfile.read(length))["stream"] is True
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for token in split_tokens(RESPONSE_TEXT):
+            chunk = {"choices": [{"delta": {"content": token}}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(TOKEN_DELAY)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def sse_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSSEHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    server.shutdown()
+
+
+def open_stream(url):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps({"stream": True}).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    return urllib.request.urlopen(request)
+
+
+def test_first_message_is_sent_before_generation_finishes(sse_server):
+    sent = []
+    started = time.monotonic()
+
+    def send_reply(text):
+        sent.append(("reply", time.monotonic() - started, text))
+
+    def send_push(text):
+        sent.append(("push", time.monotonic() - started, text))
+
+    with open_stream(sse_server) as response:
+        full_text = deliver_stream(iter_sse_deltas(response), send_reply, send_push)
+    total = time.monotonic() - started
+
+    assert full_text == RESPONSE_TEXT
+    assert sent[0][0] == "reply"
+    assert all(kind == "push" for kind, _, _ in sent[1:])
+    assert len(sent) <= LINE_MAX_MESSAGES
+    assert "".join(text for _, _, text in sent) == RESPONSE_TEXT
+    # 最初のメッセージは生成全体の時間の半分より前に届く
+    time_to_first_message = sent[0][1]
+    assert time_to_first_message < total / 2
+
+
+def test_message_count_stays_within_limit_for_long_responses():
+    sentences = ["これは長い応答の一文です。"] * 100
+    sent = []
+    full_text = deliver_stream(iter(sentences), sent.append, sent.append, push_min_chars=10)
+    assert len(sent) == LINE_MAX_MESSAGES
+    assert full_text == "".join(sentences)
+    assert "".join(sent) == full_text
+
+
+def test_stream_failure_before_first_reply_raises():
+    def broken():
+        yield "途中で"
+        raise ConnectionError("reset")
+
+    with pytest.raises(ConnectionError):
+        deliver_stream(broken(), lambda text: None, lambda text: None)
+
+
+def test_stream_failure_after_first_reply_sends_what_was_received():
+    def broken():
+        yield "最初の文です。"
+        yield "続きの"
+        raise ConnectionError("reset")
+
+    sent = []
+    full_text = deliver_stream(broken(), sent.append, sent.append)
+    assert sent == ["最初の文です。", "続きの"]
+    assert full_text == "最初の文です。続きの"
+
+
+def test_sentence_chunker_and_sse_parsing():
+    chunker = SentenceChunker()
+    assert chunker.feed("こんにちは。元気") == ["こんにちは。"]
+    assert chunker.feed("ですか？\nは") == ["元気ですか？", "\n"]
+    assert chunker.flush() == "は"
+
+    lines = [
+        b": keep-alive",
+        b'data: {"choices": [{"delta": {"role": "assistant"}}]}',
+        b'data: {"choices": [{"delta": {"content": "\\u3042"}}]}',
+        b"data: [DONE]",
+        b'data: {"choices": [{"delta": {"content": "ignored"}}]}',
+    ]
+    assert list(iter_sse_deltas(lines)) == ["あ"]
+
+
+def test_sse_usage_chunk_is_passed_to_callback():
+    usages = []
+    lines = [
+        b'data: {"choices": [{"delta": {"content": "ok"}}], "usage": null}',
+        b'data: {"choices": [], "usage": {"prompt_tokens": 12, "completion_tokens": 3}}',
+        b"data: [DONE]",
+    ]
+    assert list(iter_sse_deltas(lines, on_usage=usages.append)) == ["ok"]
+    assert usages == [{"prompt_tokens": 12, "completion_tokens": 3}]
+
+
+def test_async_delivery_matches_sync_delivery():
+    sentences = ["これは長い応答の一文です。"] * 100
+    lines = [f"data: {json.dumps({'choices': [{'delta': {'content': s}}]}, ensure_ascii=False)}".encode()
+             for s in sentences] + [b"data: [DONE]"]
+
+    async def line_stream():
+        for line in lines:
+            yield line
+
+    async def run():
+        sent = []
+
+        async def send(text):
+            sent.append(text)
+
+        full_text = await deliver_stream_async(aiter_sse_deltas(line_stream()), send, send, push_min_chars=10)
+        return sent, full_text
+
+    sent, full_text = asyncio.run(run())
+    expected = []
+    assert full_text == deliver_stream(iter(sentences), expected.append, expected.append, push_min_chars=10)
+    assert sent == expected
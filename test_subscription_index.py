@@ -0,0 +1,189 @@
+"""
+サブスクリプションインデックスのテスト
+Stripeクライアントとストアをスタブに置き換えて動作を確認する
+"""
+
+import asyncio
+
+from subscription_index import SubscriptionIndex
+
+PRICE_ID = "price_test"
+
+
+def make_subscription(n, status="active", price_id=PRICE_ID, line_user=None):
+    return {
+        "id": f"sub_{n}",
+        "customer": f"cus_{n}",
+        "status": status,
+        "metadata": {"line_user": line_user or f"U{n}"},
+        "items": {"data": [{"price": {"id": price_id}}]},
+    }
+
+
+class StubListResult:
+    def __init__(self, client, params):
+        self._client = client
+        self._params = params
+
+    def auto_paging_iter(self):
+        subscriptions = self._client.subscriptions
+        page_size = self._params["limit"]
+        for start in range(0, len(subscriptions), page_size):
+            self._client.page_requests += 1
+            yield from subscriptions[start:start + page_size]
+
+
+class StubStripe:
+    """stripe.Subscription.list(...).auto_paging_iter() だけを持つスタブ"""
+
+    def __init__(self, subscriptions):
+        self.subscriptions = subscriptions
+        self.page_requests = 0
+        client = self
+
+        class Subscription:
+            @staticmethod
+            def list(**params):
+                return StubListResult(client, params)
+
+        self.Subscription = Subscription
+
+
+class MemoryStore:
+    def __init__(self):
+        self.rows = {}
+        self.fetches = 0
+
+    def fetch(self, line_user_id):
+        self.fetches += 1
+        return self.rows.get(line_user_id)
+
+    def fetch_many(self, line_user_ids):
+        self.fetches += 1
+        return {line_user_id: self.rows[line_user_id] for line_user_id in line_user_ids if line_user_id in self.rows}
+
+    def upsert_many(self, rows):
+        for row in rows:
+            self.rows[row["line_user_id"]] = dict(row)
+
+
+def test_sync_indexes_thousands_of_subscriptions():
+    subscriptions = [make_subscription(n) for n in range(5000)]
+    subscriptions.append(make_subscription(9001, price_id="price_other"))
+    stripe_client = StubStripe(subscriptions)
+    store = MemoryStore()
+    index = SubscriptionIndex(store, stripe_client, PRICE_ID)
+
+    assert index.sync() == 5000
+    assert stripe_client.page_requests == 51
+
+    # 100件を超えた後ろの方のユーザーも見つかる
+    assert index.lookup("U4999") == {"status": "active", "stripeId": "cus_4999"}
+    assert index.lookup("U9001") is None
+    # 同期直後はキャッシュに載っているのでストアを引かない
+    assert store.fetches == 1
+
+
+def test_lookup_caches_store_results_and_misses():
+    store = MemoryStore()
+    store.upsert_many([{
+        "line_user_id": "U1", "subscription_id": "sub_1",
+        "stripe_customer_id": "cus_1", "price_id": PRICE_ID, "status": "active",
+    }])
+    index = SubscriptionIndex(store, StubStripe([]), PRICE_ID)
+
+    for _ in range(3):
+        assert index.lookup("U1")["status"] == "active"
+        assert index.lookup("U2") is None
+    assert store.fetches == 2
+
+
+def test_lookup_falls_back_when_store_fails():
+    store = MemoryStore()
+    store.upsert_many([{
+        "line_user_id": "U1", "subscription_id": "sub_1",
+        "stripe_customer_id": "cus_1", "price_id": PRICE_ID, "status": "active",
+    }])
+    index = SubscriptionIndex(store, StubStripe([]), PRICE_ID, ttl=0)
+    assert index.lookup("U1")["status"] == "active"
+
+    def fail(line_user_id):
+        raise ConnectionError("database is down")
+
+    store.fetch = fail
+    # 期限切れでもキャッシュに残っている状態を使い、なければ無料ユーザーとして扱う
+    assert index.lookup("U1") == {"status": "active", "stripeId": "cus_1"}
+    assert index.lookup("U2") is None
+    assert not index.is_cached("U2")
+
+
+def test_lookup_async_refetches_expired_entries_without_the_store():
+    rows = {"U1": {
+        "line_user_id": "U1", "subscription_id": "sub_1",
+        "stripe_customer_id": "cus_1", "price_id": PRICE_ID, "status": "active",
+    }}
+    fetched = []
+
+    async def fetch(line_user_id):
+        fetched.append(line_user_id)
+        if line_user_id in rows:
+            return rows[line_user_id]
+        raise ConnectionError("database is down")
+
+    # asyncio版（async_app.py）はストアなしで作る。期限切れでも None.fetch を呼ばず fetch で読み直す
+    index = SubscriptionIndex(None, None, PRICE_ID, ttl=0)
+
+    async def scenario():
+        first = await index.lookup_async("U1", fetch)
+        second = await index.lookup_async("U1", fetch)
+        del rows["U1"]
+        # 読めなければ期限切れのキャッシュを使い、なければ無料ユーザーとして扱う
+        return first, second, await index.lookup_async("U1", fetch), await index.lookup_async("U2", fetch)
+
+    first, second, fallback, missing = asyncio.run(scenario())
+    assert first == second == fallback == {"status": "active", "stripeId": "cus_1"}
+    assert missing is None
+    assert fetched == ["U1", "U1", "U1", "U2"]
+
+
+def test_warm_caches_recent_users_in_one_read():
+    store = MemoryStore()
+    store.upsert_many([{
+        "line_user_id": "U1", "subscription_id": "sub_1",
+        "stripe_customer_id": "cus_1", "price_id": PRICE_ID, "status": "active",
+    }])
+    index = SubscriptionIndex(store, StubStripe([]), PRICE_ID, max_entries=2)
+    assert index.warm(["U1", "U2", "U3"]) == 2
+    assert store.fetches == 1
+    assert index.lookup("U1")["status"] == "active"
+    # 行がないユーザーもキャッシュされる
+    assert index.lookup("U2") is None
+    assert store.fetches == 1
+    assert not index.is_cached("U3")
+
+
+def test_sync_prefers_active_subscription_for_same_user():
+    subscriptions = [
+        make_subscription(2, status="canceled", line_user="U1"),
+        make_subscription(1, status="active", line_user="U1"),
+    ]
+    index = SubscriptionIndex(MemoryStore(), StubStripe(subscriptions), PRICE_ID)
+    index.sync()
+    assert index.lookup("U1") == {"status": "active", "stripeId": "cus_1"}
+
+
+def test_webhook_updates_replace_cached_state():
+    store = MemoryStore()
+    index = SubscriptionIndex(store, StubStripe([]), PRICE_ID)
+    assert index.lookup("U7") is None
+
+    assert index.apply_subscription(make_subscription(7, status="active"))
+    assert index.lookup("U7")["status"] == "active"
+
+    assert index.apply_subscription(make_subscription(7, status="canceled"))
+    assert index.lookup("U7")["status"] == "canceled"
+
+    # 別の解約済みサブスクリプションは有効なものを上書きしない
+    index.apply_subscription(make_subscription(8, status="active", line_user="U7"))
+    assert not index.apply_subscription(make_subscription(9, status="canceled", line_user="U7"))
+    assert index.lookup("U7") == {"status": "active", "stripeId": "cus_8"}
@@ -0,0 +1,137 @@
+"""
+ユーザーごとのメールボックスのテスト
+同じユーザーのメッセージが直列に処理され、続けて届いたものがまとめられること、
+別のユーザーは並行して処理されることを確認する
+"""
+
+import asyncio
+import threading
+import time
+
+from user_mailbox import AsyncUserMailbox, UserMailbox
+
+
+class Recorder:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.batches = []
+        self.active = {}
+        self.max_active_per_user = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, user_id, batch):
+        with self._lock:
+            self.active[user_id] = self.active.get(user_id, 0) + 1
+            self.max_active_per_user = max(self.max_active_per_user, self.active[user_id])
+            self.max_active = max(self.max_active, sum(self.active.values()))
+        time.sleep(self.delay)
+        with self._lock:
+            self.active[user_id] -= 1
+            self.batches.append((user_id, list(batch)))
+
+
+def submit_all(mailbox, items, interval=0.0):
+    threads = []
+    for user_id, item in items:
+        thread = threading.Thread(target=mailbox.submit, args=(user_id, item))
+        thread.start()
+        threads.append(thread)
+        time.sleep(interval)
+    for thread in threads:
+        thread.join()
+
+
+def test_first_message_is_not_delayed():
+    recorder = Recorder()
+    mailbox = UserMailbox(recorder, window=1.0, max_delay=3.0)
+    started = time.monotonic()
+    assert mailbox.submit("U1", "a") is True
+    assert time.monotonic() - started < 0.5
+    assert recorder.batches == [("U1", ["a"])]
+
+
+def test_burst_during_processing_is_coalesced_into_one_batch():
+    recorder = Recorder(delay=0.1)
+    mailbox = UserMailbox(recorder, window=0.2, max_delay=2.0)
+    submit_all(mailbox, [("U1", i) for i in range(3)], interval=0.02)
+    assert recorder.batches == [("U1", [0]), ("U1", [1, 2])]
+    stats = mailbox.stats()
+    assert stats["messages"] == 3
+    assert stats["batches"] == 2
+    assert stats["coalesced"] == 1
+    assert stats["active_users"] == 0
+
+
+def test_messages_arriving_during_processing_are_handled_after_in_order():
+    recorder = Recorder(delay=0.2)
+    mailbox = UserMailbox(recorder, window=0.0)
+    owner = threading.Thread(target=mailbox.submit, args=("U1", "a"))
+    owner.start()
+    time.sleep(0.05)
+    # 処理中に届いたメッセージは積むだけですぐに戻る
+    started = time.monotonic()
+    assert mailbox.submit("U1", "b") is False
+    assert mailbox.submit("U1", "c") is False
+    assert time.monotonic() - started < 0.1
+    owner.join()
+    assert recorder.batches == [("U1", ["a"]), ("U1", ["b", "c"])]
+    assert recorder.max_active_per_user == 1
+
+
+def test_users_are_processed_in_parallel():
+    recorder = Recorder(delay=0.2)
+    mailbox = UserMailbox(recorder, window=0.0)
+    started = time.monotonic()
+    submit_all(mailbox, [(f"U{i}", i) for i in range(4)])
+    assert time.monotonic() - started < 0.6
+    assert recorder.max_active == 4
+    assert sorted(recorder.batches) == [(f"U{i}", [i]) for i in range(4)]
+
+
+def test_batch_size_and_delay_are_bounded():
+    recorder = Recorder(delay=0.05)
+    mailbox = UserMailbox(recorder, window=1.0, max_delay=0.3, max_batch=2)
+    started = time.monotonic()
+    submit_all(mailbox, [("U1", i) for i in range(4)], interval=0.01)
+    # 処理中に届いたメッセージの最初のものから max_delay を超えて待たない
+    assert time.monotonic() - started < 0.8
+    assert [batch for _, batch in recorder.batches] == [[0], [1, 2], [3]]
+
+
+def test_failed_batch_does_not_block_later_messages():
+    handled = []
+
+    def handle(user_id, batch):
+        handled.append(batch)
+        if len(handled) == 1:
+            raise RuntimeError("boom")
+
+    mailbox = UserMailbox(handle, window=0.0)
+    mailbox.submit("U1", "a")
+    mailbox.submit("U1", "b")
+    assert handled == [["a"], ["b"]]
+    assert mailbox.stats()["failed"] == 1
+
+
+def test_async_mailbox_coalesces_per_user():
+    batches = []
+
+    async def handle(user_id, batch):
+        await asyncio.sleep(0.05)
+        batches.append((user_id, batch))
+
+    async def run():
+        mailbox = AsyncUserMailbox(handle, window=0.1, max_delay=1.0)
+        tasks = []
+        for user_id, item in [("U1", 1), ("U2", 1), ("U1", 2), ("U1", 3)]:
+            tasks.append(asyncio.create_task(mailbox.submit(user_id, item)))
+            await asyncio.sleep(0.01)
+        owners = await asyncio.gather(*tasks)
+        return owners, mailbox.stats()
+
+    owners, stats = asyncio.run(run())
+    assert owners == [True, True, False, False]
+    assert sorted(batches) == [("U1", [1]), ("U1", [2, 3]), ("U2", [1])]
+    assert stats["coalesced"] == 1
+    assert stats["active_users"] == 0
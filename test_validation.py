@@ -0,0 +1,109 @@
+"""
+入力検証のテスト
+以前の実装（4つの正規表現を順に適用）とランダムな入力で判定が一致することと、
+意図的に作った最悪ケースの入力でも検証時間が一定以内に収まることを確認する
+"""
+
+import random
+import re
+import time
+
+import pytest
+
+from validation import MessageValidator, ValidationError, ValidationRules, validate_message
+
+MAX_LENGTH = 2000
+# 以前の '<script.*?>.*?</script>' で長さの2乗の時間がかかっていた入力
+ADVERSARIAL_INPUTS = {
+    "open_tags": "<script>" * (MAX_LENGTH // 8),
+    "open_prefixes": "<script" * (MAX_LENGTH // 7),
+    "tag_ends": "<script" + ">" * (MAX_LENGTH - 7),
+    "close_prefixes": "<script>" + "</scrip" * ((MAX_LENGTH - 8) // 7),
+    "mixed_case": "<ScRiPt>" * (MAX_LENGTH // 8),
+    "markers": "javascript" * (MAX_LENGTH // 10),
+    "full_width": "＜ｓｃｒｉｐｔ＞" * (MAX_LENGTH // 8),
+}
+FUZZ_TOKENS = ("<script", "<SCRIPT", ">", "</script>", "</Script>", "javascript:", "vbscript", ":", "data:",
+               "text/html", "a", " ", "\n", "あ", "こんにちは", "<", "/")
+
+
+def legacy_is_dangerous(message):
+    dangerous_patterns = [
+        r'<script.*?>.*?</script>',
+        r'javascript:',
+        r'vbscript:',
+        r'data:text/html',
+    ]
+    message_lower = message.lower()
+    return any(re.search(pattern, message_lower, re.IGNORECASE | re.DOTALL) for pattern in dangerous_patterns)
+
+
+def test_valid_messages_are_stripped():
+    assert validate_message("  こんにちは\n") == "こんにちは"
+    # 正規化は判定にだけ使い、全角文字はそのまま返す
+    assert validate_message("ＡＢＣ１２３") == "ＡＢＣ１２３"
+
+
+@pytest.mark.parametrize("message, rule", [
+    (None, "format"),
+    ("", "format"),
+    (123, "format"),
+    ("x" * (MAX_LENGTH + 1), "length"),
+    (" \n\t", "empty"),
+    ("<script>alert(1)</script>", "pattern"),
+    ("<SCRIPT src=x>\n</Script>", "pattern"),
+    ("click JavaScript:alert(1)", "pattern"),
+    ("VBScript:msgbox", "pattern"),
+    ("data:text/html;base64,xxx", "pattern"),
+    # 全角文字による回避
+    ("ｊａｖａｓｃｒｉｐｔ：alert(1)", "pattern"),
+    ("＜ｓｃｒｉｐｔ＞alert(1)＜／ｓｃｒｉｐｔ＞", "pattern"),
+])
+def test_invalid_messages_are_rejected(message, rule):
+    with pytest.raises(ValidationError) as excinfo:
+        validate_message(message)
+    assert excinfo.value.rule == rule
+    # 呼び出し側は ValueError として扱う
+    assert isinstance(excinfo.value, ValueError)
+
+
+def test_script_tag_needs_open_tag_end_and_close_tag_in_order():
+    assert validate_message("<script") == "<script"
+    assert validate_message("</script><script>") == "</script><script>"
+    assert validate_message("<script</script>") == "<script</script>"
+    with pytest.raises(ValidationError):
+        validate_message("<script</script></script>")
+
+
+def test_rules_are_configurable():
+    validator = MessageValidator(ValidationRules(max_length=20, normalize=False, blocked_markers=("ftp:",),
+                                                 block_script_tags=False))
+    assert validator.validate("<script>x</script>") == "<script>x</script>"
+    assert validator.validate("ｊａｖａｓｃｒｉｐｔ：") == "ｊａｖａｓｃｒｉｐｔ："
+    with pytest.raises(ValidationError):
+        validator.validate("FTP://host")
+    with pytest.raises(ValidationError):
+        validator.validate("x" * 21)
+    assert MessageValidator(ValidationRules(blocked_markers=(), block_script_tags=False)).validate("javascript:")
+
+
+def test_fuzz_matches_legacy_patterns():
+    rng = random.Random(0)
+    validator = MessageValidator(ValidationRules(normalize=False))
+    for _ in range(5000):
+        message = "".join(rng.choice(FUZZ_TOKENS) for _ in range(rng.randint(1, 30)))
+        assert validator.is_dangerous(message) == legacy_is_dangerous(message), message
+
+
+@pytest.mark.parametrize("name", sorted(ADVERSARIAL_INPUTS))
+def test_worst_case_inputs_are_validated_in_bounded_time(name):
+    message = ADVERSARIAL_INPUTS[name]
+    assert len(message) <= MAX_LENGTH
+    started = time.perf_counter()
+    for _ in range(10):
+        try:
+            validate_message(message)
+        except ValidationError:
+            pass
+    # 以前の実装では open_tags の1回で数百ミリ秒かかっていた
+    assert (time.perf_counter() - started) / 10 < 0.01
@@ -0,0 +1,156 @@
+"""
+ユーザーごとのメールボックス
+
+同じユーザーのメッセージは1つずつ順番に処理し、短い間隔で続けて届いたメッセージは
+まとめて1回で処理する（LLMの呼び出しと返信を1回にする）。別のユーザーのメッセージは並行して処理する。
+
+処理用のスレッドは持たない。あるユーザーのメッセージを最初に積んだ呼び出し元
+（Webhookのリクエストやディスパッチャのワーカー）がそのユーザーの処理を受け持ち、
+最初のメッセージは待たずに handle_batch(user_id, items) を呼ぶ。処理中に届いたメッセージは
+同じ呼び出し元が続けて処理し、最後のメッセージから window 秒（最初のメッセージからは最大 max_delay 秒）
+待ってからまとめて渡す。他の呼び出し元は積むだけですぐに戻る。
+（1件だけ届いたメッセージの応答は遅らせず、連投されたときだけまとめる）
+
+プロセス内での直列化なので、複数のワーカープロセスに分かれて届いたメッセージはまとめられない。
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class _Box:
+    def __init__(self, wakeup):
+        self.items = deque()  # (積んだ時刻, item)
+        self.last_arrival = None
+        self.wakeup = wakeup
+        # まだ1回も処理していない（最初のメッセージは待たずに処理する）
+        self.idle = True
+
+
+class _MailboxBase:
+    def __init__(self, handle_batch, window=1.0, max_delay=3.0, max_batch=5, clock=time.monotonic):
+        self._handle_batch = handle_batch
+        self._window = window
+        self._max_delay = max_delay
+        self._max_batch = max_batch
+        self._clock = clock
+        self._boxes = {}
+        self._counters = {"messages": 0, "batches": 0, "coalesced": 0, "failed": 0, "max_batch_size": 0}
+
+    def _push(self, user_id, item, make_wakeup):
+        """item を積む。このユーザーの処理を受け持つ場合は箱を返す（処理中ならNone）。"""
+        now = self._clock()
+        self._counters["messages"] += 1
+        box = self._boxes.get(user_id)
+        owner = box is None
+        if owner:
+            box = self._boxes[user_id] = _Box(make_wakeup())
+        box.items.append((now, item))
+        box.last_arrival = now
+        return box if owner else None
+
+    def _wait_time(self, box):
+        """まとめて処理するまでの残り時間（秒）。0以下ならすぐに処理する。"""
+        if box.idle or len(box.items) >= self._max_batch:
+            return 0.0
+        deadline = min(box.last_arrival + self._window, box.items[0][0] + self._max_delay)
+        return deadline - self._clock()
+
+    def _take(self, user_id, box):
+        """処理するメッセージを取り出す。残っていなければ箱を片付けてNoneを返す。"""
+        if not box.items:
+            del self._boxes[user_id]
+            return None
+        box.idle = False
+        count = min(self._max_batch, len(box.items))
+        batch = [box.items.popleft()[1] for _ in range(count)]
+        self._counters["batches"] += 1
+        self._counters["coalesced"] += count - 1
+        self._counters["max_batch_size"] = max(self._counters["max_batch_size"], count)
+        return batch
+
+    def _stats(self):
+        stats = dict(self._counters)
+        stats["active_users"] = len(self._boxes)
+        stats["pending"] = sum(len(box.items) for box in self._boxes.values())
+        return stats
+
+
+class UserMailbox(_MailboxBase):
+    """スレッド（gthread・gevent・ディスパッチャのワーカー）から使うメールボックス"""
+
+    def __init__(self, handle_batch, window=1.0, max_delay=3.0, max_batch=5, clock=time.monotonic):
+        super().__init__(handle_batch, window, max_delay, max_batch, clock)
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, item):
+        """item を積む。呼び出し元が処理した場合はTrue、処理中の呼び出し元に任せた場合はFalseを返す。"""
+        with self._lock:
+            box = self._push(user_id, item, lambda: threading.Condition(self._lock))
+            if box is None:
+                self._boxes[user_id].wakeup.notify()
+                return False
+        self._drain(user_id, box)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return self._stats()
+
+    def _drain(self, user_id, box):
+        while True:
+            with self._lock:
+                while box.items:
+                    wait = self._wait_time(box)
+                    if wait <= 0:
+                        break
+                    box.wakeup.wait(wait)
+                batch = self._take(user_id, box)
+            if batch is None:
+                return
+            try:
+                self._handle_batch(user_id, batch)
+            except Exception as e:
+                logger.error(f"Unhandled error while processing messages for {user_id}: {e}")
+                with self._lock:
+                    self._counters["failed"] += 1
+
+
+class AsyncUserMailbox(_MailboxBase):
+    """asyncio版（イベントループのスレッドからだけ使う）。handle_batch はコルーチン関数"""
+
+    async def submit(self, user_id, item):
+        box = self._push(user_id, item, asyncio.Event)
+        if box is None:
+            self._boxes[user_id].wakeup.set()
+            return False
+        await self._drain(user_id, box)
+        return True
+
+    def stats(self):
+        return self._stats()
+
+    async def _drain(self, user_id, box):
+        while True:
+            while box.items:
+                wait = self._wait_time(box)
+                if wait <= 0:
+                    break
+                box.wakeup.clear()
+                try:
+                    await asyncio.wait_for(box.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self._take(user_id, box)
+            if batch is None:
+                return
+            try:
+                await self._handle_batch(user_id, batch)
+            except Exception as e:
+                logger.error(f"Unhandled error while processing messages for {user_id}: {e}")
+                self._counters["failed"] += 1
@@ -0,0 +1,105 @@
+"""
+ユーザーのメッセージの入力検証
+
+すべてのイベントで呼ばれるので、検出パターンは1つの正規表現にまとめて事前にコンパイルし、
+メッセージを1回なめるだけで判定する。パターンはリテラル（大文字小文字は区別しない）に限り、
+<script ...>...</script> は開始タグの位置から文字列検索で閉じタグを探すので、
+どんな入力でも長さに比例した時間で終わる（以前の '<script.*?>.*?</script>' は
+'<script>' を繰り返した入力で長さの2乗の時間がかかっていた）。
+
+全角文字などによる回避（'ｊａｖａｓｃｒｉｐｔ：' など）を防ぐため、ASCII以外を含むメッセージは
+NFKC正規化した文字列で判定する。返すのは正規化前のメッセージ（前後の空白を除いたもの）。
+"""
+
+import re
+import unicodedata
+from dataclasses import dataclass
+
+DEFAULT_BLOCKED_MARKERS = (
+    "javascript:",  # JavaScript injection
+    "vbscript:",  # VBScript injection
+    "data:text/html",  # Data URI XSS
+)
+
+_SCRIPT_OPEN = "<script"
+_SCRIPT_CLOSE = re.compile(re.escape("</script>"), re.IGNORECASE)
+
+
+class ValidationError(ValueError):
+    """入力検証に失敗した。rule は該当したルール（format / length / empty / pattern）"""
+
+    def __init__(self, message, rule):
+        super().__init__(message)
+        self.rule = rule
+
+
+@dataclass(frozen=True)
+class ValidationRules:
+    """検証ルール
+
+    blocked_markers は含まれていたら拒否する文字列（大文字小文字は区別しない）。
+    block_script_tags は '<script' の後に '>' と '</script>' がこの順に現れるメッセージを拒否する。
+    normalize はASCII以外を含むメッセージをNFKC正規化してから判定する。
+    """
+    max_length: int = 2000
+    normalize: bool = True
+    blocked_markers: tuple = DEFAULT_BLOCKED_MARKERS
+    block_script_tags: bool = True
+
+
+class MessageValidator:
+    def __init__(self, rules=None):
+        self.rules = rules or ValidationRules()
+        markers = [re.escape(marker) for marker in self.rules.blocked_markers]
+        if self.rules.block_script_tags:
+            markers.append(re.escape(_SCRIPT_OPEN))
+        # 長い順に並べて、前方一致する短いマーカーに先に当たらないようにする
+        markers.sort(key=len, reverse=True)
+        self._pattern = re.compile("|".join(markers), re.IGNORECASE) if markers else None
+
+    def validate(self, message):
+        """前後の空白を除いたメッセージを返す。問題があれば ValidationError を送出する。"""
+        if not message or not isinstance(message, str):
+            raise ValidationError("Invalid message format", "format")
+
+        # メッセージ長制限
+        if len(message) > self.rules.max_length:
+            raise ValidationError("Message too long", "length")
+
+        # 空文字やスペースのみのチェック
+        stripped = message.strip()
+        if not stripped:
+            raise ValidationError("Empty message", "empty")
+
+        # 危険な文字列パターンのチェック
+        if self.is_dangerous(message):
+            raise ValidationError("Potentially dangerous content detected", "pattern")
+
+        return stripped
+
+    def is_dangerous(self, message):
+        if self._pattern is None:
+            return False
+        text = message
+        if self.rules.normalize and not text.isascii():
+            text = unicodedata.normalize("NFKC", text)
+        script_checked = False
+        for match in self._pattern.finditer(text):
+            if match.group().lower() != _SCRIPT_OPEN:
+                return True
+            if script_checked:
+                continue
+            # 最初の開始タグで判定すれば十分（後ろの開始タグの方が '>' と閉じタグを探す範囲が狭い）
+            script_checked = True
+            tag_end = text.find(">", match.end())
+            if tag_end != -1 and _SCRIPT_CLOSE.search(text, tag_end + 1):
+                return True
+        return False
+
+
+DEFAULT_VALIDATOR = MessageValidator()
+
+
+def validate_message(message):
+    """既定のルールで検証する（MessageValidator.validate を参照）。"""
+    return DEFAULT_VALIDATOR.validate(message)